@@ -46,6 +46,7 @@ for submodule in '''
  best_of_pheno
  manhattan
  qq
+ manhattan_qq
  matrix
  top_hits
  phenotypes
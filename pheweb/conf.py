@@ -5,7 +5,8 @@ from .utils import PheWebError, load_module_from_filepath
 from . import parse_utils
 
 import os, boltons.fileutils
-from typing import Optional,Any,Dict,Tuple,List
+import types
+from typing import Optional,Any,Dict,Tuple,List,NamedTuple,Mapping
 
 
 # All state lives in this dictionary.
@@ -143,10 +144,23 @@ def get_num_procs(cmd:Optional[str] = None) -> int:
     n_cpus = multiprocessing.cpu_count()
     return 1 if n_cpus==1 else int(n_cpus * 3/4)
 
+def should_write_binary_variant_files() -> bool: return _get_config_bool('binary_variant_files', False)
+def get_matrix_num_shards() -> int: return _get_config_int('matrix_num_shards', 0)
+def should_write_variant_store() -> bool: return _get_config_bool('variant_store', False)
+def should_approximate_qq() -> bool: return _get_config_bool('approximate_qq', False)
+def should_use_build_manifest() -> bool: return _get_config_bool('build_manifest', False)
+def get_sites_file() -> Optional[str]:
+    key = 'sites_file'
+    if not overrides.get(key):
+        return None
+    return os.path.join(get_data_dir(), os.path.expanduser(_get_config_str(key)))
 
 
 ## Parsing config
 def get_assoc_min_maf() -> float: return _get_config_float('assoc_min_maf', 0)
+def should_parse_columnar() -> bool: return _get_config_bool('columnar_parsing', True)
+def get_num_decompression_threads() -> int: return _get_config_int('num_decompression_threads', 0)
+def get_num_compression_threads() -> int: return _get_config_int('num_compression_threads', 1)
 def get_field_aliases() -> Dict[str,str]:
     return overrides.get('field_aliases', parse_utils.default_field_aliases)
 
@@ -168,6 +182,37 @@ def pval_is_neglog10() -> bool: return _get_config_bool('pval_is_neglog10', Fals
 def get_pheno_correlations_pvalue_threshold() -> float: return _get_config_float('pheno_correlations_pvalue_threshold', 0.05)
 
 
+## Snapshot of the config used for each variant
+class LoadingConfig(NamedTuple):
+    '''
+    The config that's used while loading each variant, looked up once (by `get_loading_config()`) instead of once per variant.
+    Code that handles many variants (like `Binner` and `AssocFileReader`) takes one of these, or makes one when it's created.
+    '''
+    pval_is_neglog10: bool
+    field_aliases: Mapping[str,str]
+    manhattan_num_unbinned: int
+    manhattan_peak_max_count: int
+    manhattan_peak_pval_threshold: float
+    manhattan_peak_sprawl_dist: int
+    manhattan_peak_variant_counting_pval_threshold: float
+    def __reduce__(self):
+        # `MappingProxyType` can't be pickled, so `field_aliases` is pickled as a dict (eg, to return a `Binner` from a child process).
+        return (_unpickle_loading_config, (tuple(self._replace(field_aliases=dict(self.field_aliases))),))
+def _unpickle_loading_config(values:tuple) -> LoadingConfig:
+    config = LoadingConfig(*values)
+    return config._replace(field_aliases=types.MappingProxyType(config.field_aliases))
+def get_loading_config() -> LoadingConfig:
+    return LoadingConfig(
+        pval_is_neglog10 = pval_is_neglog10(),
+        field_aliases = types.MappingProxyType(dict(get_field_aliases())),
+        manhattan_num_unbinned = get_manhattan_num_unbinned(),
+        manhattan_peak_max_count = get_manhattan_peak_max_count(),
+        manhattan_peak_pval_threshold = get_manhattan_peak_pval_threshold(),
+        manhattan_peak_sprawl_dist = get_manhattan_peak_sprawl_dist(),
+        manhattan_peak_variant_counting_pval_threshold = get_manhattan_peak_variant_counting_pval_threshold(),
+    )
+
+
 ## Serving config
 def get_lzjs_version() -> str: return _get_config_str('lzjs_version', '0.13.0')
 def should_allow_variant_json_cors() -> bool: return _get_config_bool('allow_variant_json_cors', True)
@@ -198,3 +243,9 @@ def get_google_analytics_id() -> Optional[str]: return _get_config_optional_str(
 def get_sentry_id() -> Optional[str]: return _get_config_optional_str('SENTRY_DSN')
 def should_show_manhattan_filter_button() -> bool: return _get_config_bool('show_manhattan_filter_button', False)
 def should_show_manhattan_filter_consequence() -> bool: return _get_config_bool('show_manhattan_filter_consequence', False)
+def get_manhattan_filter_maf_boundaries() -> List[float]:
+    key = 'manhattan_filter_maf_boundaries'
+    _check_overrides_type(key, list)
+    return overrides.get(key, [0.01, 0.05])  # type: ignore
+def get_server_cache_megabytes() -> int: return _get_config_int('server_cache_megabytes', 100)
+def get_max_num_open_tabix_files() -> int: return _get_config_int('max_num_open_tabix_files', 64)
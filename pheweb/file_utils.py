@@ -1,20 +1,25 @@
 
-from .utils import PheWebError, get_phenolist, chrom_order
+from .utils import PheWebError, get_phenolist, chrom_order, chrom_order_list, round_sig_array
 from . import conf
 from . import parse_utils
 
 import io
+import math
+import shutil
 import os
 import csv
-from contextlib import contextmanager
+from contextlib import contextmanager, ExitStack
 import json
 import gzip
+import zlib
+import struct
 import datetime
 from boltons.fileutils import AtomicSaver, mkdir_p
 import pysam
 import itertools, random
+import threading
 from pathlib import Path
-from typing import List, Callable, Dict, Union, Iterator, Optional, Any
+from typing import List, Callable, Dict, Union, Iterator, Iterable, Optional, Any, Tuple
 
 
 def get_generated_path(*path_parts:str) -> str:
@@ -46,12 +51,14 @@ _single_filepaths: Dict[str,Callable[[],str]] = {
     # simple:
     'unanno': (lambda: get_generated_path('sites/sites-unannotated.tsv')),
     'sites-rsids': (lambda: get_generated_path('sites/sites-rsids.tsv')),
-    'sites': (lambda: get_generated_path('sites/sites.tsv')),
+    'sites': (lambda: conf.get_sites_file() or get_generated_path('sites/sites.tsv')),
     'best-phenos-by-gene-sqlite3': (lambda: get_generated_path('best-phenos-by-gene.sqlite3')),
     'best-phenos-by-gene-old-json': (lambda: get_generated_path('best-phenos-by-gene.json')),
     'correlations': (lambda: get_generated_path('pheno-correlations.txt')),
     'cpras-rsids-sqlite3': (lambda: get_generated_path('sites/cpras-rsids.sqlite3')),
     'matrix': (lambda: get_generated_path('matrix.tsv.gz')),
+    'matrix_sharded': (lambda: get_generated_path('matrix_sharded')),
+    'variant_store': (lambda: get_generated_path('variant_store')),
     'top-hits': (lambda: get_generated_path('top_hits.json')),
     'top-hits-1k': (lambda: get_generated_path('top_hits_1k.json')),
     'top-hits-tsv': (lambda: get_generated_path('top_hits.tsv')),
@@ -59,9 +66,12 @@ _single_filepaths: Dict[str,Callable[[],str]] = {
     'top-loci-tsv': (lambda: get_generated_path('top_loci.tsv')),
     'phenotypes_summary': (lambda: get_generated_path('phenotypes.json')),
     'phenotypes_summary_tsv': (lambda: get_generated_path('phenotypes.tsv')),
+    'parallelizer-stats': (lambda: get_generated_path('parallelizer-stats.json')),
+    'build-manifest': (lambda: get_generated_path('build-manifest.json')),
     # directories for pheno filepaths:
     'parsed': (lambda: get_generated_path('parsed')),
     'pheno_gz': (lambda: get_generated_path('pheno_gz')),
+    'pheno_bin': (lambda: get_generated_path('pheno_bin')),
     'best_of_pheno': (lambda: get_generated_path('best_of_pheno')),
     'manhattan': (lambda: get_generated_path('manhattan')),
     'qq': (lambda: get_generated_path('qq')),
@@ -77,7 +87,10 @@ _pheno_filepaths: Dict[str,Callable[[str],str]] = {
     'parsed': (lambda phenocode: get_generated_path('parsed', phenocode)),
     'pheno_gz': (lambda phenocode: get_generated_path('pheno_gz', '{}.gz'.format(phenocode))),
     'pheno_gz_tbi': (lambda phenocode: get_generated_path('pheno_gz', '{}.gz.tbi'.format(phenocode))),
+    'pheno_bin': (lambda phenocode: get_generated_path('pheno_bin', '{}.bin'.format(phenocode))),
     'best_of_pheno': (lambda phenocode: get_generated_path('best_of_pheno', phenocode)),
+    'best_of_pheno_filters': (lambda phenocode: get_generated_path('best_of_pheno_filters', '{}.npz'.format(phenocode))),
+    'filtered_manhattan': (lambda phenocode: get_generated_path('filtered_manhattan', phenocode)),
     'manhattan': (lambda phenocode: get_generated_path('manhattan', '{}.json'.format(phenocode))),
     'qq': (lambda phenocode: get_generated_path('qq', '{}.json'.format(phenocode))),
 }
@@ -123,7 +136,7 @@ csv.register_dialect(
 ## Readers
 
 @contextmanager
-def VariantFileReader(filepath:Union[str,Path], only_per_variant_fields:bool = False):
+def VariantFileReader(filepath:Union[str,Path], only_per_variant_fields:bool = False, chroms:Optional[List[str]] = None):
     '''
     Reads variants (as dictionaries) from an internal file.  Iterable.  Exposes `.fields`.
 
@@ -131,8 +144,12 @@ def VariantFileReader(filepath:Union[str,Path], only_per_variant_fields:bool = F
             print(reader.fields)
             for variant in reader:
                 print(variant)
+
+    If `chroms` is given, only the variants on those chroms are read.  They must be contiguous in `chrom_order_list`.
+    If the file is bgzipped and has an up-to-date tabix index, reading starts at the first of those variants.
     '''
-    with read_maybe_gzip(filepath) as f:
+    with ExitStack() as stack:
+        f = stack.enter_context(read_maybe_gzip(filepath))
         reader:Iterator[List[str]] = csv.reader(f, dialect='pheweb-internal-dialect')
         try: fields = next(reader)
         except StopIteration: raise PheWebError("It looks like the file {} is empty".format(filepath))
@@ -140,6 +157,14 @@ def VariantFileReader(filepath:Union[str,Path], only_per_variant_fields:bool = F
             fields[0] = fields[0][1:]
         for field in fields:
             assert field in parse_utils.per_variant_fields or field in parse_utils.per_assoc_fields, field
+        if chroms is not None:
+            virtual_offset = get_virtual_offset(str(filepath), chroms)
+            if virtual_offset == -1:
+                reader = iter([])
+            elif virtual_offset > 0:
+                reader = csv.reader(stack.enter_context(read_bgzip_from(str(filepath), virtual_offset)), dialect='pheweb-internal-dialect')
+            chroms_set = set(chroms)
+            reader = itertools.takewhile(lambda row: row[0] in chroms_set, itertools.dropwhile(lambda row: row[0] not in chroms_set, reader))
         if only_per_variant_fields:
             yield _vfr_only_per_variant_fields(fields, reader)
         else:
@@ -156,6 +181,13 @@ class _vfr:
             assert len(unparsed_variant) == len(self.fields), (unparsed_variant, self.fields)
             variant = {field: parser(value) for parser,field,value in zip(parsers, self.fields, unparsed_variant)}
             yield variant
+    def get_selected_variants(self, is_selected:Iterable[bool]) -> Iterator[Dict[str,Any]]:
+        '''Like iterating, but only parses (and yields) the variants where `is_selected` is true.'''
+        parsers: List[Callable[[str],Any]] = [parse_utils.reader_for_field[field] for field in self.fields]
+        for unparsed_variant, is_variant_selected in zip(self._reader, is_selected):
+            if is_variant_selected:
+                assert len(unparsed_variant) == len(self.fields), (unparsed_variant, self.fields)
+                yield {field: parser(value) for parser,field,value in zip(parsers, self.fields, unparsed_variant)}
 class _vfr_only_per_variant_fields:
     def __init__(self, fields:List[str], reader:Iterator[List[str]]):
         self._all_fields = fields
@@ -171,18 +203,201 @@ class _vfr_only_per_variant_fields:
             yield variant
 
 
+# Binary variant files store variants as blocks of typed columns, so that loaders can read numpy arrays instead of parsing text into dicts.
+# Chrom is stored as its index in `chrom_order_list`.
+# Floats are stored as float32 when rounding that float32 to 7 significant digits gives back the same float64, and as float64 otherwise.
+# Almost all floats are rounded by `parse_utils`, so they fit in float32.
+# The file is `binary_variant_file_magic` followed by blocks.  Each block is:
+#   - the length of the block header (uint64)
+#   - the block header (json), like `{"num_variants": 3, "first": [chrom_idx, pos], "last": [chrom_idx, pos], "columns": [[field, dtype, num_bytes], ...], "new_strings": {field: [...]}}`
+#   - each column (zlib-compressed), in the order of "columns"
+# String fields (eg, ref and alt) are stored as ids into a per-file list of strings, and each block header has the strings that were first used in that block.
+binary_variant_file_magic = b'PHEWEB-BINARY-VARIANTS-1\n'
+BINARY_BLOCK_NUM_VARIANTS = 2**16
+
+def _is_binary_string_field(field:str) -> bool:
+    return field != 'chrom' and parse_utils.fields[field].get('type', str) is str
+def _is_binary_float_field(field:str) -> bool:
+    return parse_utils.fields[field].get('type', str) is float
+def _float32_to_float64(column:Any) -> Any:
+    import numpy as np
+    ret = column.astype(np.float64)
+    is_finite = np.isfinite(ret)
+    ret[is_finite] = round_sig_array(ret[is_finite], 7)
+    return ret
+
+@contextmanager
+def BinaryVariantFileReader(filepath:Union[str,Path]):
+    '''
+    Reads variants from a file made by `BinaryVariantFileWriter`.  Exposes `.fields`.
+
+        with BinaryVariantFileReader('a.bin') as reader:
+            for block in reader.get_blocks():
+                print(block['chrom_idx'], block['pos'], block['pval'])  # numpy arrays
+            for variant in reader:
+                print(variant)  # same dictionaries as `VariantFileReader`
+    '''
+    with open(filepath, 'rb') as f:
+        if f.read(len(binary_variant_file_magic)) != binary_variant_file_magic:
+            raise PheWebError("The file {} is not a binary variant file".format(filepath))
+        yield _bvfr(f)
+class _bvfr:
+    def __init__(self, f):
+        self._f = f
+        self._blocks:List[Dict[str,Any]] = []  # block headers, with the file offset of their columns
+        strings:Dict[str,List[str]] = {}
+        while True:
+            header_length_bytes = f.read(8)
+            if not header_length_bytes: break
+            header = json.loads(f.read(struct.unpack('<Q', header_length_bytes)[0]))
+            header['offset'] = f.tell()
+            self._blocks.append(header)
+            for field, new_strings in header['new_strings'].items():
+                strings.setdefault(field, []).extend(new_strings)
+            f.seek(sum(num_bytes for _, _, num_bytes in header['columns']), os.SEEK_CUR)
+        self.fields:List[str] = [field for field, _, _ in self._blocks[0]['columns']] if self._blocks else []
+        import numpy as np
+        self._strings = {field: np.array(strings.get(field, []), dtype=object) for field in self.fields if _is_binary_string_field(field)}
+
+    def get_blocks(self, chrom:Optional[str] = None, start:int = 0, end:Optional[int] = None, decode_strings:bool = False) -> Iterator[Dict[str,Any]]:
+        '''
+        Yields blocks of variants like `{'chrom_idx': array([0, 0, ...]), 'pos': array([869334, 869335, ...]), 'pval': array([...]), ...}`.
+        Float columns are float64, with `nan` for missing values.  String columns are ids unless `decode_strings` is set.
+        If `chrom` is given, only yields variants in that region (including `start`, not including `end`).
+        '''
+        import numpy as np
+        chrom_idx = None if chrom is None else chrom_order[chrom]
+        for header in self._blocks:
+            if chrom_idx is not None:
+                if header['last'] < [chrom_idx, start]: continue
+                if end is not None and header['first'] >= [chrom_idx, end]: break
+            self._f.seek(header['offset'])
+            block:Dict[str,Any] = {}
+            for field, dtype, num_bytes in header['columns']:
+                column = np.frombuffer(zlib.decompress(self._f.read(num_bytes)), dtype=dtype)
+                if field == 'chrom': field = 'chrom_idx'
+                elif column.dtype == np.float32: column = _float32_to_float64(column)
+                elif decode_strings and field in self._strings: column = self._strings[field][column]
+                block[field] = column
+            if chrom_idx is not None:
+                is_in_region = (block['chrom_idx'] == chrom_idx) & (block['pos'] >= start)
+                if end is not None: is_in_region &= (block['pos'] < end)
+                if not is_in_region.all():
+                    block = {field: column[is_in_region] for field, column in block.items()}
+            yield block
+
+    def __iter__(self) -> Iterator[Dict[str,Any]]:
+        for block in self.get_blocks(decode_strings=True):
+            columns = [self._column_to_list(field, block) for field in self.fields]
+            for values in zip(*columns):
+                yield dict(zip(self.fields, values))
+    def get_variant(self, block:Dict[str,Any], idx:int) -> Dict[str,Any]:
+        '''Returns variant `idx` of `block` (from `get_blocks(decode_strings=True)`), like `__iter__` would.'''
+        variant_block = {field: column[idx:idx+1] for field, column in block.items()}
+        return {field: self._column_to_list(field, variant_block)[0] for field in self.fields}
+    @staticmethod
+    def _column_to_list(field:str, block:Dict[str,Any]) -> List[Any]:
+        if field == 'chrom':
+            return [chrom_order_list[chrom_idx] for chrom_idx in block['chrom_idx'].tolist()]
+        column = block[field].tolist()
+        if block[field].dtype.kind == 'f':
+            column = ['' if math.isnan(value) else value for value in column]
+        return column
+
+def is_binary_variant_file(filepath:Union[str,Path]) -> bool:
+    with open(filepath, 'rb') as f:
+        return f.read(len(binary_variant_file_magic)) == binary_variant_file_magic
+
+
+class TabixFilePool:
+    '''
+    Keeps `pysam.TabixFile`s open between uses, so that each use doesn't have to re-open the file and re-read its index.
+    Each handle is only used by one thread (or greenlet) at a time.  A file's handles are dropped when its inode or mtime
+    (or its index's) changes, and idle handles are closed (least-recently-used first) to keep at most `max_num_files` open.
+    Handles are also dropped after a fork (eg, into gunicorn workers), since they can't be shared between processes.
+    '''
+    def __init__(self, max_num_files:int):
+        self.max_num_files = max_num_files
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._idle: List[Tuple[Tuple[Any,...],pysam.TabixFile]] = []  # [(file_id, tabix_file), ...], least-recently-used first
+        self._num_open = 0
+        self._header_fields: Dict[str,Tuple[Tuple[Any,...],List[str]]] = {}  # filepath -> (file_id, fields)
+
+    @staticmethod
+    def _get_file_id(filepath:str) -> Tuple[Any,...]:
+        stat, tbi_stat = os.stat(filepath), os.stat(filepath + '.tbi')
+        return (filepath, stat.st_ino, stat.st_mtime_ns, tbi_stat.st_ino, tbi_stat.st_mtime_ns)
+
+    def _check_pid(self) -> None:
+        if os.getpid() != self._pid:
+            self._pid = os.getpid()
+            self._idle, self._num_open, self._header_fields = [], 0, {}
+
+    @contextmanager
+    def open(self, filepath:str) -> Iterator[pysam.TabixFile]:
+        file_id = self._get_file_id(filepath)
+        tabix_file = None
+        with self._lock:
+            self._check_pid()
+            for idx in reversed(range(len(self._idle))):
+                if self._idle[idx][0] == file_id:
+                    tabix_file = self._idle.pop(idx)[1]
+                    break
+                elif self._idle[idx][0][0] == filepath:  # the file has changed since this handle was opened
+                    self._idle.pop(idx)[1].close()
+                    self._num_open -= 1
+            if tabix_file is None: self._num_open += 1
+        if tabix_file is None:
+            try:
+                tabix_file = pysam.TabixFile(filepath, parser=None)
+            except BaseException:
+                with self._lock: self._num_open -= 1
+                raise
+        try:
+            yield tabix_file
+        except BaseException:
+            with self._lock: self._num_open -= 1
+            tabix_file.close()
+            raise
+        with self._lock:
+            self._idle.append((file_id, tabix_file))
+            while self._idle and self._num_open > self.max_num_files:
+                self._idle.pop(0)[1].close()
+                self._num_open -= 1
+
+    def get_header_fields(self, filepath:str) -> List[str]:
+        '''Returns the fields in the header line of the gzipped file `filepath`, re-reading it only when the file changes.'''
+        file_id = self._get_file_id(filepath)
+        with self._lock:
+            self._check_pid()
+            cached = self._header_fields.get(filepath)
+        if cached is not None and cached[0] == file_id: return cached[1]
+        with read_gzip(filepath) as f:
+            reader:Iterator[List[str]] = csv.reader(f, dialect='pheweb-internal-dialect')
+            fields = next(reader)
+        if fields[0].startswith('#'): # previous version of PheWeb commented the header line
+            fields[0] = fields[0][1:]
+        with self._lock:
+            self._header_fields[filepath] = (file_id, fields)
+        return fields
+
+_tabix_file_pool: Optional[TabixFilePool] = None
+def get_tabix_file_pool() -> TabixFilePool:
+    global _tabix_file_pool
+    if _tabix_file_pool is None:
+        _tabix_file_pool = TabixFilePool(max_num_files=conf.get_max_num_open_tabix_files())
+    return _tabix_file_pool
+
+
 @contextmanager
 def IndexedVariantFileReader(phenocode:str):
     filepath = get_pheno_filepath('pheno_gz', phenocode)
-    with read_gzip(filepath) as f:
-        reader:Iterator[List[str]] = csv.reader(f, dialect='pheweb-internal-dialect')
-        fields = next(reader)
-    if fields[0].startswith('#'): # previous version of PheWeb commented the header line
-        fields[0] = fields[0][1:]
+    fields = get_tabix_file_pool().get_header_fields(filepath)
     for field in fields:
         assert field in parse_utils.per_variant_fields or field in parse_utils.per_assoc_fields, field
     colidxs = {field: idx for idx, field in enumerate(fields)}
-    with pysam.TabixFile(filepath, parser=None) as tabix_file:
+    with get_tabix_file_pool().open(filepath) as tabix_file:
         yield _ivfr(tabix_file, colidxs)
 class _ivfr:
     def __init__(self, _tabix_file:pysam.TabixFile, _colidxs:Dict[str,int]):
@@ -270,7 +485,7 @@ class MatrixReader:
 
     @contextmanager
     def context(self):
-        with pysam.TabixFile(self._filepath, parser=None) as tabix_file:
+        with get_tabix_file_pool().open(self._filepath) as tabix_file:
             yield _mr(tabix_file, self._colidxs, self._colidxs_for_pheno, self._info_for_pheno)
 class _mr(_ivfr):
     def __init__(self, _tabix_file:pysam.TabixFile, _colidxs:Dict[str,int], _colidxs_for_pheno:Dict[str,Dict[str,int]], _info_for_pheno:Dict[str,Dict[str,Any]]):
@@ -304,6 +519,150 @@ class _mr(_ivfr):
         return variant
 
 
+class ShardedMatrixReader:
+    '''
+    Reads the sharded matrix that `pheweb matrix` writes when `matrix_num_shards` is set.  It has the same interface as `MatrixReader`.
+    `matrix_sharded/sites.tsv.gz` has the per-variant fields and then a `row_id` for each variant.
+    Each `matrix_sharded/shard-<n>.tsv.gz` has lines like `chrom pos row_id phenocode_idx <per-assoc fields>`,
+    but only for the associations that exist, so reading a variant doesn't require parsing an empty column for every phenotype.
+    '''
+    def __init__(self):
+        self._dirpath = get_filepath('matrix_sharded')
+        with open(os.path.join(self._dirpath, 'shards.json')) as f:
+            self._shards_info = json.load(f)
+        self._info_for_pheno = {
+            pheno['phenocode']: {k: v for k,v in pheno.items() if k != 'assoc_files'}
+            for pheno in get_phenolist()
+        }
+
+    def get_phenocodes(self) -> List[str]:
+        return [pheno['phenocode'] for pheno in self._shards_info['phenos']]
+
+    @contextmanager
+    def context(self):
+        with ExitStack() as stack:
+            sites_file = stack.enter_context(get_tabix_file_pool().open(os.path.join(self._dirpath, 'sites.tsv.gz')))
+            shard_files = [stack.enter_context(get_tabix_file_pool().open(os.path.join(self._dirpath, 'shard-{}.tsv.gz'.format(shard_num))))
+                           for shard_num in range(self._shards_info['num_shards'])]
+            yield _smr(sites_file, shard_files, self._shards_info, self._info_for_pheno)
+class _smr(_ivfr):
+    def __init__(self, _sites_file:pysam.TabixFile, _shard_files:List[pysam.TabixFile], _shards_info:Dict[str,Any], _info_for_pheno:Dict[str,Dict[str,Any]]):
+        self._tabix_file=_sites_file
+        self._shard_files=_shard_files
+        self._sites_fields:List[str]=_shards_info['sites_fields']
+        self._phenos:List[Dict[str,Any]]=_shards_info['phenos']
+        self._info_for_pheno=_info_for_pheno
+
+    def _parse_values(self, fields:List[str], values:List[str], phenocode:Optional[str] = None) -> Dict[str,Any]:
+        ret = {}
+        for field, val in zip(fields, values):
+            try:
+                ret[field] = parse_utils.reader_for_field[field](val)
+            except Exception as exc:
+                error_message = 'ERROR: Failed to parse the value {!r} for field {!r}'.format(val, field)
+                if phenocode is not None: error_message += ' and phenocode {!r}'.format(phenocode)
+                raise PheWebError(error_message) from exc
+        return ret
+
+    def get_region(self, chrom:str, start:int, end:int) -> Iterator[Dict[str,Any]]:
+        '''includes `start`, does not include `end`.  Yields variants like `MatrixReader`.'''
+        if start < 1: start = 1
+        if start >= end: return
+        if chrom not in self._tabix_file.contigs: return
+
+        variant_for_row_id: Dict[int,Dict[str,Any]] = {}
+        sites_rows:Iterator[List[str]] = csv.reader(self._tabix_file.fetch(chrom, start-1, end-1, parser=None), dialect='pheweb-internal-dialect')
+        for row in sites_rows:
+            variant = self._parse_values(self._sites_fields, row)
+            variant['phenos'] = {}
+            variant_for_row_id[int(row[-1])] = variant
+        if not variant_for_row_id: return
+
+        for shard_file in self._shard_files:
+            if chrom not in shard_file.contigs: continue
+            shard_rows:Iterator[List[str]] = csv.reader(shard_file.fetch(chrom, start-1, end-1, parser=None), dialect='pheweb-internal-dialect')
+            for row in shard_rows:
+                row_variant = variant_for_row_id.get(int(row[2]))
+                if row_variant is None: continue
+                pheno = self._phenos[int(row[3])]
+                p = self._parse_values(pheno['fields'], row[4:], pheno['phenocode'])
+                p.update(self._info_for_pheno[pheno['phenocode']])
+                row_variant['phenos'][pheno['phenocode']] = p
+        yield from variant_for_row_id.values()
+
+class VariantStoreReader:
+    '''
+    Reads the variant store that `pheweb matrix` writes when `variant_store` is set.  It has the same interface as `MatrixReader`.
+    Each array in `variant_store/` is memory-mapped, so looking up a variant is a binary search on `chrompos.npy`
+    followed by reading only the records of the phenotypes that have that variant.
+    '''
+    def __init__(self):
+        import numpy as np
+        dirpath = get_filepath('variant_store')
+        with open(os.path.join(dirpath, 'store.json')) as f:
+            self._store_info = json.load(f)
+        self._arrays = {name: np.load(os.path.join(dirpath, name+'.npy'), mmap_mode='r')
+                        for name in ['chrompos', 'variant_offsets', 'variants', 'record_offsets', 'records']}
+        self._info_for_pheno = {
+            pheno['phenocode']: {k: v for k,v in pheno.items() if k != 'assoc_files'}
+            for pheno in get_phenolist()
+        }
+
+    def get_phenocodes(self) -> List[str]:
+        return [pheno['phenocode'] for pheno in self._store_info['phenos']]
+
+    @contextmanager
+    def context(self):
+        yield _vsr(self._arrays, self._store_info, self._info_for_pheno)
+class _vsr(_ivfr):
+    def __init__(self, _arrays:Dict[str,Any], _store_info:Dict[str,Any], _info_for_pheno:Dict[str,Dict[str,Any]]):
+        self._arrays=_arrays
+        self._sites_fields:List[str]=_store_info['sites_fields']
+        self._phenos:List[Dict[str,Any]]=_store_info['phenos']
+        self._info_for_pheno=_info_for_pheno
+        # for each phenotype, `[(field, index_in_record), ...]` for the fields that its matrix columns have.
+        self._record_idxs_for_pheno = [[(field, 1+_store_info['fields'].index(field)) for field in pheno['fields']] for pheno in self._phenos]
+
+    def _parse_field(self, val:str, field:str) -> Any:
+        try:
+            return parse_utils.reader_for_field[field](val)
+        except Exception as exc:
+            raise PheWebError('ERROR: Failed to parse the value {!r} for field {!r}'.format(val, field)) from exc
+
+    def get_region(self, chrom:str, start:int, end:int) -> Iterator[Dict[str,Any]]:
+        '''includes `start`, does not include `end`.  Yields variants like `MatrixReader`.'''
+        if start < 1: start = 1
+        if start >= end: return
+        if chrom not in chrom_order: return
+        chrompos, variant_offsets, variants, record_offsets, records = (
+            self._arrays[name] for name in ['chrompos', 'variant_offsets', 'variants', 'record_offsets', 'records'])
+        chrom_idx = chrom_order[chrom]
+        first, last = (int(chrompos.searchsorted(chrompos.dtype.type(chrom_idx << 32 | pos))) for pos in [start, end])
+        for variant_idx in range(first, last):
+            row = variants[variant_offsets[variant_idx]:variant_offsets[variant_idx+1]].tobytes().decode('utf8').split('\t')
+            variant:Dict[str,Any] = {'phenos': {}}
+            for field, val in zip(self._sites_fields, row):
+                variant[field] = self._parse_field(val, field)
+            for record in records[record_offsets[variant_idx]:record_offsets[variant_idx+1]].tolist():
+                pheno_idx = record[0]
+                p = {field: ('' if math.isnan(record[idx]) else record[idx]) for field, idx in self._record_idxs_for_pheno[pheno_idx]}
+                p.update(self._info_for_pheno[self._phenos[pheno_idx]['phenocode']])
+                variant['phenos'][self._phenos[pheno_idx]['phenocode']] = p
+            yield variant
+
+def get_matrix_reader() -> Union[MatrixReader, ShardedMatrixReader]:
+    '''Returns a `ShardedMatrixReader` if `pheweb matrix` wrote a sharded matrix, or else a `MatrixReader`.'''
+    if conf.get_matrix_num_shards() > 0 and os.path.exists(os.path.join(get_filepath('matrix_sharded', must_exist=False), 'shards.json')):
+        return ShardedMatrixReader()
+    return MatrixReader()
+
+def get_variant_reader() -> Union[VariantStoreReader, MatrixReader, ShardedMatrixReader]:
+    '''Returns a `VariantStoreReader` if `pheweb matrix` wrote a variant store, or else the same as `get_matrix_reader()`.'''
+    if conf.should_write_variant_store() and os.path.exists(os.path.join(get_filepath('variant_store', must_exist=False), 'store.json')):
+        return VariantStoreReader()
+    return get_matrix_reader()
+
+
 def with_chrom_idx(variants:Iterator[Dict[str,Any]]) -> Iterator[Dict[str,Any]]:
     for v in variants:
         v['chrom_idx'] = chrom_order[v['chrom']]
@@ -311,26 +670,189 @@ def with_chrom_idx(variants:Iterator[Dict[str,Any]]) -> Iterator[Dict[str,Any]]:
 
 
 @contextmanager
-def read_gzip(filepath):  # mypy doesn't like it
+def read_gzip(filepath, buffer_size:int = 2**18):  # mypy doesn't like it
     # hopefully faster than `gzip.open(filepath, 'rt')` -- TODO: find out whether it is
     with gzip.GzipFile(filepath, 'rb') as f: # leave in binary mode (default), let TextIOWrapper decode
-        with io.BufferedReader(f, buffer_size=2**18) as g: # 256KB buffer
+        with io.BufferedReader(f, buffer_size=buffer_size) as g: # 256KB buffer by default
             with io.TextIOWrapper(g) as h: # bytes -> unicode
                 yield h
 
 @contextmanager
-def read_maybe_gzip(filepath:Union[str,Path]):
+def read_bgzip_from(filepath:str, virtual_offset:int, buffer_size:int = 2**18):
+    '''Reads the bgzipped file `filepath` as text, starting at `virtual_offset` (like one from `get_virtual_offset()`).'''
+    # Each bgzip block is a gzip member, so `GzipFile` can start reading at any block.
+    with open(filepath, 'rb') as raw_f:
+        raw_f.seek(virtual_offset >> 16)
+        with gzip.GzipFile(fileobj=raw_f, mode='rb') as f:
+            f.read(virtual_offset & 0xFFFF)
+            with io.BufferedReader(f, buffer_size=buffer_size) as g:
+                with io.TextIOWrapper(g) as h:
+                    yield h
+
+@contextmanager
+def read_maybe_gzip(filepath:Union[str,Path], buffer_size:int = 2**18):
+    # Use a smaller `buffer_size` when reading many files at once.
     if isinstance(filepath, Path): filepath = str(filepath)
     is_gzip = False
     with open(filepath, 'rb', buffering=0) as raw_f: # no need for buffers
         if raw_f.read(3) == b'\x1f\x8b\x08':
             is_gzip = True
     if is_gzip:
-        with read_gzip(filepath) as f:
+        with read_gzip(filepath, buffer_size=buffer_size) as f:
             yield f
     else:
-        with open(filepath, 'rt', buffering=2**18) as f: # 256KB buffer
+        with open(filepath, 'rt', buffering=buffer_size) as f: # 256KB buffer by default
+            yield f
+
+@contextmanager
+def read_maybe_gzip_threaded(filepath:Union[str,Path], num_threads:int = 1, buffer_size:int = 2**18):
+    '''
+    Like `read_maybe_gzip()`, but a gzipped file is decompressed in background threads while the caller parses it.
+    (zlib releases the GIL while it inflates, so this works even though the caller is busy in python.)
+    A BGZF file (like the ones that tabix reads) is made of independent blocks, so `num_threads` threads inflate its blocks in parallel.
+    Any other gzip file is decompressed in order by a single thread.
+    '''
+    if isinstance(filepath, Path): filepath = str(filepath)
+    with open(filepath, 'rb', buffering=0) as raw_f:
+        is_gzip = raw_f.read(3) == b'\x1f\x8b\x08'
+    if not is_gzip:
+        with open(filepath, 'rt', buffering=buffer_size) as f:
             yield f
+        return
+    with _ThreadedGzipReader(filepath, num_threads=num_threads) as r:
+        with io.BufferedReader(r, buffer_size=buffer_size) as g:
+            with io.TextIOWrapper(g) as h:
+                yield h
+
+class _ThreadedGzipReader(io.RawIOBase):
+    '''
+    A raw binary stream of the decompressed contents of a gzip file.
+    A producer thread puts decompressed chunks (or, for BGZF, futures of decompressed chunks) into a bounded queue, in order.
+    '''
+    _READ_SIZE = 2**20  # compressed bytes read at once from a non-BGZF file
+    _NUM_BGZF_BLOCKS_PER_TASK = 64  # each block has <=64KB of data
+    _EOF = object()
+
+    def __init__(self, filepath:str, num_threads:int = 1):
+        import queue
+        super().__init__()
+        self._filepath = filepath
+        self._f = open(filepath, 'rb')
+        self._queue: 'queue.Queue[Any]' = queue.Queue(maxsize=2 * max(1, num_threads))
+        self._stop = threading.Event()
+        self._executor = None
+        if self._is_bgzf():
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=max(1, num_threads))
+        self._buf = memoryview(b'')
+        self._done = False
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+        self._thread.start()
+
+    def readable(self) -> bool: return True
+
+    def readinto(self, b:Any) -> int:
+        while not self._buf:
+            if self._done: return 0
+            item = self._queue.get()
+            if item is self._EOF:
+                self._done = True
+                return 0
+            if isinstance(item, BaseException): raise item
+            if self._executor is not None: item = item.result()
+            self._buf = memoryview(item)
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        return n
+
+    def close(self) -> None:
+        import queue
+        if self.closed: return
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                item = self._queue.get(timeout=0.1)
+                if hasattr(item, 'cancel'): item.cancel()
+            except queue.Empty:
+                pass
+        if self._executor is not None: self._executor.shutdown(wait=True)
+        self._f.close()
+        super().close()
+
+    def _put(self, item:Any) -> bool:
+        '''Returns False if the reader was closed before `item` could be queued.'''
+        import queue
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self) -> None:
+        try:
+            if self._executor is not None:
+                self._produce_bgzf()
+            else:
+                self._produce_gzip()
+            self._put(self._EOF)
+        except Exception as exc:
+            self._put(exc)
+
+    def _produce_gzip(self) -> None:
+        d = None  # the decompressor of the current gzip member, or None between members
+        while True:
+            data = self._f.read(self._READ_SIZE)
+            if not data: break
+            while data:
+                if d is None:
+                    data = data.lstrip(b'\x00')  # like `gzip.GzipFile`, ignore zero-padding between members
+                    if not data: break
+                    d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                chunk = d.decompress(data)
+                if chunk and not self._put(chunk): return
+                if d.eof:
+                    # A gzip file can have several members, each of which needs a new decompressor.
+                    data = d.unused_data
+                    d = None
+                else:
+                    data = b''
+        if d is not None:
+            raise EOFError("Compressed file {!r} ended before the end-of-stream marker was reached".format(self._filepath))
+
+    def _produce_bgzf(self) -> None:
+        assert self._executor is not None
+        blocks: List[bytes] = []
+        while True:
+            block = self._read_bgzf_block()
+            if block is not None: blocks.append(block)
+            if blocks and (block is None or len(blocks) >= self._NUM_BGZF_BLOCKS_PER_TASK):
+                if not self._put(self._executor.submit(_inflate_gzip_members, blocks)): return
+                blocks = []
+            if block is None: return
+
+    def _is_bgzf(self) -> bool:
+        header = self._f.read(18)
+        self._f.seek(0)
+        return len(header) == 18 and bool(header[3] & 4) and header[12:16] == b'BC\x02\x00'
+
+    def _read_bgzf_block(self) -> Optional[bytes]:
+        header = self._f.read(18)
+        if not header: return None
+        if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[12:16] != b'BC\x02\x00':
+            raise PheWebError("{!r} looked like a BGZF file, but it has a block that isn't BGZF (at byte {})".format(
+                self._filepath, self._f.tell() - len(header)))
+        block_size = struct.unpack('<H', header[16:18])[0] + 1
+        rest = self._f.read(block_size - 18)
+        if len(rest) != block_size - 18:
+            raise EOFError("Compressed file {!r} ended before the end-of-stream marker was reached".format(self._filepath))
+        return header + rest
+
+def _inflate_gzip_members(members:List[bytes]) -> bytes:
+    '''Decompresses a list of complete gzip members (checking each one's CRC and length).'''
+    return b''.join(zlib.decompress(member, zlib.MAX_WBITS | 16) for member in members)
 
 
 
@@ -355,28 +877,192 @@ def VariantFileWriter(filepath:str, allow_extra_fields:bool = False, use_gzip:bo
     else:
         with AtomicSaver(filepath, text_mode=True, part_file=part_file, overwrite_part=True, rm_part_on_exc=False) as f:
             yield _vfw(f, allow_extra_fields, filepath)
+@contextmanager
+def IndexedVariantFileWriter(filepath:str, allow_extra_fields:bool = False, num_threads:int = 1):
+    '''
+    Like `VariantFileWriter`, but writes a bgzipped file and its tabix index (`filepath + '.tbi'`) in one pass,
+    giving the same result as writing a plain file and then running `convert_VariantFile_to_IndexedVariantFile()`.
+    BGZF blocks are compressed by `num_threads` threads while the caller keeps writing.
+    The variants must be sorted.
+    '''
+    part_file = get_tmp_path(filepath)
+    make_basedir(filepath)
+    with AtomicSaver(filepath, text_mode=False, part_file=part_file, overwrite_part=True, rm_part_on_exc=False) as f:
+        bgzf_writer = _BgzfWriter(f, num_threads=num_threads)
+        try:
+            indexing_writer = _TabixIndexingWriter(bgzf_writer, filepath)
+            yield _vfw(indexing_writer, allow_extra_fields, filepath)
+            tbi_data = indexing_writer.close()
+        finally:
+            bgzf_writer.close()
+    tbi_filepath = filepath + '.tbi'
+    with AtomicSaver(tbi_filepath, text_mode=False, part_file=get_tmp_path(tbi_filepath), overwrite_part=True, rm_part_on_exc=False) as f:
+        f.write(b''.join(_bgzf_compress_blocks(_split_into_bgzf_blocks(tbi_data))) + BGZF_EOF_BLOCK)
+
+@contextmanager
+def VariantFileFragmentWriter(filepath:str, num_threads:int = 1):
+    '''
+    Like `IndexedVariantFileWriter`, but writes a piece of a bgzipped file, without a header, an EOF marker, or a tabix index.
+    The writer's `.fields` are the fields that the header would have had (or None if nothing was written).
+    The fragments of consecutive groups of chroms are joined by `concatenate_variant_file_fragments()`.
+    '''
+    make_basedir(filepath)
+    with open(filepath, 'wb') as f:
+        bgzf_writer = _BgzfWriter(f, num_threads=num_threads)
+        try:
+            yield _vfw(_BgzfTextWriter(bgzf_writer), False, filepath, has_header=False)
+            bgzf_writer.finish(write_eof=False)
+        finally:
+            bgzf_writer.close()
+
+def concatenate_variant_file_fragments(fields:List[str], fragment_filepaths:List[str], filepath:str) -> None:
+    '''Writes a header of `fields` and then the fragments from `VariantFileFragmentWriter` (in order) to the bgzipped file `filepath`, and tabixes it.'''
+    make_basedir(filepath)
+    header = io.StringIO()
+    csv.writer(header, dialect='pheweb-internal-dialect').writerow(fields)
+    with AtomicSaver(filepath, text_mode=False, part_file=get_tmp_path(filepath), overwrite_part=True, rm_part_on_exc=False) as f:
+        f.write(b''.join(_bgzf_compress_blocks(_split_into_bgzf_blocks(header.getvalue().encode()))))
+        for fragment_filepath in fragment_filepaths:
+            with open(fragment_filepath, 'rb') as f_fragment:
+                shutil.copyfileobj(f_fragment, f)
+        f.write(BGZF_EOF_BLOCK)
+    pysam.tabix_index(
+        filename=filepath, force=True,
+        seq_col=0, start_col=1, end_col=1, # note: `pysam.tabix_index` calls the first column `0`, but cmdline `tabix` calls it `1`.
+        line_skip=1, # skip header
+    )
+
 class _vfw:
-    def __init__(self, f, allow_extra_fields:bool, filepath:str):
+    def __init__(self, f, allow_extra_fields:bool, filepath:str, has_header:bool = True):
         self._f = f
         self._allow_extra_fields = allow_extra_fields
         self._filepath = filepath
+        self._has_header = has_header
+    @property
+    def fields(self) -> Optional[List[str]]:
+        return list(self._writer.fieldnames) if hasattr(self, '_writer') else None
+    def _make_writer(self, keys:Iterable[str]) -> None:
+        fields:List[str] = []
+        for field in parse_utils.fields:
+            if field in keys: fields.append(field)
+        extra_fields = list(set(keys) - set(fields))
+        if extra_fields:
+            if not self._allow_extra_fields:
+                raise PheWebError("ERROR: found unexpected fields {!r} among the expected fields {!r} while writing {!r}.".format(
+                                extra_fields, fields, self._filepath))
+            fields += extra_fields
+        self._writer = csv.DictWriter(self._f, fieldnames=fields, dialect='pheweb-internal-dialect')
+        if self._has_header: self._writer.writeheader()
     def write(self, variant:Dict[str,Any]) -> None:
         if not hasattr(self, '_writer'):
-            fields:List[str] = []
-            for field in parse_utils.fields:
-                if field in variant: fields.append(field)
-            extra_fields = list(set(variant.keys()) - set(fields))
-            if extra_fields:
-                if not self._allow_extra_fields:
-                    raise PheWebError("ERROR: found unexpected fields {!r} among the expected fields {!r} while writing {!r}.".format(
-                                    extra_fields, fields, self._filepath))
-                fields += extra_fields
-            self._writer = csv.DictWriter(self._f, fieldnames=fields, dialect='pheweb-internal-dialect')
-            self._writer.writeheader()
+            self._make_writer(variant.keys())
         self._writer.writerow(variant)
     def write_all(self, variants:Iterator[Dict[str,Any]]) -> None:
         for v in variants:
             self.write(v)
+    def write_columns(self, columns:Dict[str,List[Any]]) -> None:
+        '''Writes many variants at once, given as columns like `{'chrom': ['1', '1'], 'pos': [869334, 869335], ...}`.'''
+        if not hasattr(self, '_writer'):
+            self._make_writer(columns.keys())
+        self._writer.writer.writerows(zip(*(columns[field] for field in self._writer.fieldnames)))
+
+@contextmanager
+def BinaryVariantFileWriter(filepath:str):
+    '''
+    Writes variants to a binary internal file, which can be read by `BinaryVariantFileReader`.
+
+        with BinaryVariantFileWriter('a.bin') as writer:
+            writer.write({'chrom': '2', 'pos': 47, ...})
+            writer.write_columns({'chrom': ['2', '2'], 'pos': [48, 49], ...})
+
+    Every variant must have the same keys.
+    '''
+    part_file = get_tmp_path(filepath)
+    make_basedir(filepath)
+    with AtomicSaver(filepath, text_mode=False, part_file=part_file, overwrite_part=True, rm_part_on_exc=False) as f:
+        f.write(binary_variant_file_magic)
+        writer = _bvfw(f, filepath)
+        yield writer
+        writer.flush()
+class _bvfw:
+    def __init__(self, f, filepath:str):
+        self._f = f
+        self._filepath = filepath
+        self._columns:Dict[str,List[Any]] = {}
+        self._id_for_string:Dict[str,Dict[str,int]] = {}
+    def _set_fields(self, keys:Iterable[str]) -> None:
+        fields = [field for field in parse_utils.fields if field in keys]
+        extra_fields = list(set(keys) - set(fields))
+        if extra_fields:
+            raise PheWebError("ERROR: found unexpected fields {!r} among the expected fields {!r} while writing {!r}.".format(
+                extra_fields, fields, self._filepath))
+        self._columns = {field: [] for field in fields}
+        self._id_for_string = {field: {} for field in fields if _is_binary_string_field(field)}
+    def write(self, variant:Dict[str,Any]) -> None:
+        if not self._columns:
+            self._set_fields(variant.keys())
+        if len(variant) != len(self._columns):
+            raise PheWebError("ERROR: the variant {!r} doesn't have exactly the fields {!r} while writing {!r}.".format(
+                variant, list(self._columns), self._filepath))
+        for field, column in self._columns.items():
+            column.append(variant[field])
+        if len(column) >= BINARY_BLOCK_NUM_VARIANTS:
+            self.flush()
+    def write_all(self, variants:Iterator[Dict[str,Any]]) -> None:
+        for v in variants:
+            self.write(v)
+    def write_columns(self, columns:Dict[str,List[Any]]) -> None:
+        '''Writes many variants at once, given as columns like `{'chrom': ['1', '1'], 'pos': [869334, 869335], ...}`.'''
+        if not self._columns:
+            self._set_fields(columns.keys())
+        if set(columns) != set(self._columns):
+            raise PheWebError("ERROR: the columns {!r} aren't exactly the fields {!r} while writing {!r}.".format(
+                list(columns), list(self._columns), self._filepath))
+        for field, column in self._columns.items():
+            column.extend(columns[field])
+        if len(column) >= BINARY_BLOCK_NUM_VARIANTS:
+            self.flush()
+
+    def flush(self) -> None:
+        '''Writes all buffered variants as one block.'''
+        import numpy as np
+        num_variants = len(next(iter(self._columns.values()), []))
+        if num_variants == 0: return
+        header:Dict[str,Any] = {'num_variants': num_variants, 'columns': [], 'new_strings': {}}
+        compressed_columns = []
+        for field, values in self._columns.items():
+            column:Any
+            if field == 'chrom':
+                column = np.array([chrom_order[chrom] for chrom in values], dtype=np.uint8)
+            elif field == 'pos':
+                column = np.array(values, dtype=np.uint32)
+            elif field in self._id_for_string:
+                id_for_string = self._id_for_string[field]
+                num_old_strings = len(id_for_string)
+                column = np.array([id_for_string.setdefault(value, len(id_for_string)) for value in values], dtype=np.uint32)
+                if len(id_for_string) > num_old_strings:
+                    header['new_strings'][field] = list(itertools.islice(id_for_string, num_old_strings, None))
+            elif _is_binary_float_field(field):
+                column = np.array([math.nan if value == '' else value for value in values], dtype=np.float64)
+                column32 = column.astype(np.float32)
+                if np.array_equal(_float32_to_float64(column32), column, equal_nan=True):
+                    column = column32
+            else:
+                column = np.array(values, dtype=np.int64)
+            column = column.astype(column.dtype.newbyteorder('<'), copy=False)
+            dtype = column.dtype.str
+            compressed_column = zlib.compress(column.tobytes(), 1)
+            header['columns'].append([field, dtype, len(compressed_column)])
+            compressed_columns.append(compressed_column)
+        if 'chrom' in self._columns and 'pos' in self._columns:
+            header['first'] = [chrom_order[self._columns['chrom'][0]], int(self._columns['pos'][0])]
+            header['last'] = [chrom_order[self._columns['chrom'][-1]], int(self._columns['pos'][-1])]
+        header_bytes = json.dumps(header).encode()
+        self._f.write(struct.pack('<Q', len(header_bytes)))
+        self._f.write(header_bytes)
+        for compressed_column in compressed_columns:
+            self._f.write(compressed_column)
+        self._columns = {field: [] for field in self._columns}
 
 def write_heterogenous_variantfile(filepath:str, assocs:List[Dict[str,Any]], use_gzip:bool = True) -> None:
     '''inject all necessary keys into the first association so that the writer will be made correctly'''
@@ -399,6 +1085,332 @@ def convert_VariantFile_to_IndexedVariantFile(vf_path:str, ivf_path:str) -> None
         line_skip=1, # skip header
     )
 
+BGZF_BLOCK_SIZE = 0xff00  # uncompressed bytes per block, as in htslib
+BGZF_EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+def _split_into_bgzf_blocks(data:bytes) -> List[bytes]:
+    return [data[i:i+BGZF_BLOCK_SIZE] for i in range(0, len(data), BGZF_BLOCK_SIZE)]
+
+def _bgzf_compress_blocks(blocks:List[bytes]) -> List[bytes]:
+    '''Compresses each block of <=`BGZF_BLOCK_SIZE` bytes into a BGZF block (a gzip member with a `BC` extra field that holds its size).'''
+    ret = []
+    for block in blocks:
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS)
+        compressed = compressor.compress(block) + compressor.flush()
+        if len(compressed) + 26 > 2**16:  # incompressible, so store it instead
+            compressor = zlib.compressobj(0, zlib.DEFLATED, -zlib.MAX_WBITS)
+            compressed = compressor.compress(block) + compressor.flush()
+        ret.append(struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(compressed) + 25) +
+                   compressed + struct.pack('<II', zlib.crc32(block), len(block)))
+    return ret
+
+class _BgzfWriter:
+    '''
+    Writes bytes to a binary file as BGZF blocks, compressing batches of blocks in a thread pool (zlib releases the GIL while it compresses).
+    Every block but the last has exactly `BGZF_BLOCK_SIZE` uncompressed bytes, so the block holding an uncompressed offset is easy to find.
+    After `.close()`, `.get_virtual_offset()` converts uncompressed offsets into virtual offsets.
+    '''
+    _NUM_BLOCKS_PER_TASK = 64
+
+    def __init__(self, f, num_threads:int = 1):
+        from concurrent.futures import ThreadPoolExecutor
+        import collections
+        self._f = f
+        self._num_threads = max(1, num_threads)
+        self._executor = ThreadPoolExecutor(max_workers=self._num_threads)
+        self._pending: 'collections.deque[Any]' = collections.deque()
+        self._buf = bytearray()
+        self.uncompressed_offset = 0
+        self._block_offsets = [0]  # the compressed offset of each block written so far, and then of the end
+        self._closed = False
+
+    def write(self, data:bytes) -> None:
+        self._buf += data
+        self.uncompressed_offset += len(data)
+        if len(self._buf) >= BGZF_BLOCK_SIZE * self._NUM_BLOCKS_PER_TASK:
+            num_bytes = len(self._buf) - len(self._buf) % BGZF_BLOCK_SIZE
+            self._submit(bytes(self._buf[:num_bytes]))
+            del self._buf[:num_bytes]
+
+    def _submit(self, data:bytes) -> None:
+        self._pending.append(self._executor.submit(_bgzf_compress_blocks, _split_into_bgzf_blocks(data)))
+        while len(self._pending) > 2 * self._num_threads:
+            self._write_blocks(self._pending.popleft().result())
+
+    def _write_blocks(self, blocks:List[bytes]) -> None:
+        for block in blocks:
+            self._f.write(block)
+            self._block_offsets.append(self._block_offsets[-1] + len(block))
+
+    def finish(self, write_eof:bool = True) -> None:
+        '''Writes everything that's left, and then the BGZF end-of-file marker (unless `write_eof` is false, as for a fragment).'''
+        if self._buf: self._submit(bytes(self._buf))
+        self._buf = bytearray()
+        while self._pending:
+            self._write_blocks(self._pending.popleft().result())
+        if write_eof: self._f.write(BGZF_EOF_BLOCK)
+        self.close()
+
+    def close(self) -> None:
+        if self._closed: return
+        for future in self._pending: future.cancel()
+        self._executor.shutdown(wait=True)
+        self._closed = True
+
+    def get_virtual_offset(self, uncompressed_offset:int) -> int:
+        # An offset at the end of a block is given as the start of the next block (or of the EOF marker), like htslib does.
+        if uncompressed_offset == self.uncompressed_offset: return self._block_offsets[-1] << 16
+        block_idx, offset_in_block = divmod(uncompressed_offset, BGZF_BLOCK_SIZE)
+        return (self._block_offsets[block_idx] << 16) | offset_in_block
+
+class _BgzfTextWriter:
+    '''A text file object that writes to a `_BgzfWriter`.'''
+    def __init__(self, bgzf_writer:_BgzfWriter):
+        self._bgzf_writer = bgzf_writer
+    def write(self, s:str) -> None:
+        self._bgzf_writer.write(s.encode())
+
+class _TabixIndexingWriter:
+    '''
+    A text file object that writes to a `_BgzfWriter` and indexes each line, like `pysam.tabix_index(seq_col=0, start_col=1, end_col=1, line_skip=1)`.
+    Building the index follows `tbx_index_build()`, `hts_idx_push()` and `hts_idx_finish()` in htslib.
+    Until `.close()`, the index holds uncompressed offsets.
+    '''
+    _MIN_SHIFT, _N_LVLS = 14, 5
+    _N_BINS = ((1 << 18) - 1) // 7
+    _META_BIN = _N_BINS + 1  # holds (start, end) of each chrom and its number of lines
+    _LINE_SKIP = 1
+
+    _NUM_WRITES_PER_BATCH = 4096
+
+    def __init__(self, bgzf_writer:_BgzfWriter, filepath:str):
+        self._bgzf_writer = bgzf_writer
+        self._filepath = filepath
+        self._pending: List[str] = []  # text that's been written but not yet indexed
+        self._partial_line = ''
+        self._num_lines = 0
+        self._chroms: List[str] = []
+        self._tid_for_chrom: Dict[str,int] = {}
+        self._bins: List[Dict[int,List[List[int]]]] = []
+        self._lidx: List[List[int]] = []
+        self._meta: Dict[int,List[List[int]]] = {}
+        self._n_no_coor = 0
+        # These are the fields of `hts_idx_t.z`, with `None` for htslib's `0xffffffff`.
+        self._save_bin: Optional[int] = None
+        self._save_tid: Optional[int] = None
+        self._last_tid: Optional[int] = None
+        self._last_bin: Optional[int] = None
+        self._save_off = self._last_off = self._off_beg = self._off_end = 0
+        self._last_coor = -1
+        self._n_mapped = self._n_unmapped = 0
+        self._last_chrom: Optional[str] = None
+        self._last_window = -1
+
+    def write(self, s:str) -> None:
+        self._pending.append(s)
+        if len(self._pending) >= self._NUM_WRITES_PER_BATCH: self._flush()
+
+    def _flush(self) -> None:
+        '''Writes and indexes every complete line that's been written.'''
+        lines = ''.join([self._partial_line] + self._pending).split('\n')
+        self._partial_line = lines.pop()
+        self._pending = []
+        if not lines: return
+        text = '\n'.join(lines) + '\n'
+        data = text.encode()
+        offset = self._bgzf_writer.uncompressed_offset
+        self._bgzf_writer.write(data)
+        line_lengths = [len(line) + 1 for line in lines] if len(data) == len(text) else [len(line.encode()) + 1 for line in lines]
+        self._index_lines(lines, line_lengths, offset)
+
+    def _index_lines(self, lines:List[str], line_lengths:List[int], offset:int) -> None:
+        '''Indexes lines that start at the uncompressed offset `offset`.'''
+        last_chrom, last_window, min_shift = self._last_chrom, self._last_window, self._MIN_SHIFT
+        # Most lines have the same chrom, bin and linear-index window as the previous line.  For those, `_push()` would only
+        # count the line and update `_last_off` and `_last_coor`, which are kept in local variables here.
+        num_fast_lines, last_off, last_coor = 0, self._last_off, self._last_coor
+        for line, line_length in zip(lines, line_lengths):
+            offset += line_length
+            try:
+                chrom, pos, _ = line.split('\t', 2)
+                beg = int(pos) - 1
+            except ValueError:
+                chrom, beg = None, None
+            if beg is not None and chrom == last_chrom and beg >> min_shift == last_window and beg >= last_coor and line[0] != '#' and self._num_lines >= self._LINE_SKIP:
+                num_fast_lines += 1
+                last_off = offset
+                last_coor = beg
+                continue
+            self._n_mapped += num_fast_lines
+            self._last_off, self._last_coor, num_fast_lines = last_off, last_coor, 0
+            if self._num_lines < self._LINE_SKIP or line.startswith('#'):
+                self._num_lines += 1
+                if not self._chroms: self._save_off = self._last_off = self._off_beg = self._off_end = offset
+            elif chrom is None or beg is None:
+                raise PheWebError("While writing {!r}, couldn't find the chrom and pos in the line {!r}".format(self._filepath, line))
+            else:
+                self._index_line(chrom, max(0, beg), offset)
+                last_chrom, last_window = chrom, max(0, beg) >> min_shift
+            last_off, last_coor = self._last_off, self._last_coor
+        self._n_mapped += num_fast_lines
+        self._last_off, self._last_coor = last_off, last_coor
+        self._last_chrom, self._last_window = last_chrom, last_window
+
+    def _index_line(self, chrom:str, beg:int, offset:int) -> None:
+        tid = self._tid_for_chrom.get(chrom)
+        if tid is None:
+            tid = self._tid_for_chrom[chrom] = len(self._chroms)
+            self._chroms.append(chrom)
+            self._bins.append({})
+            self._lidx.append([])
+        elif tid != self._last_tid:
+            raise PheWebError("While writing {!r}, the lines for chrom {!r} aren't all together".format(self._filepath, chrom))
+        if beg + 1 > 1 << (self._MIN_SHIFT + 3*self._N_LVLS):
+            raise PheWebError("While writing {!r}, the position {} on chrom {!r} is too large for a tabix index".format(self._filepath, beg+1, chrom))
+        self._push(tid, beg, beg+1, offset)
+
+    def _push(self, tid:int, beg:int, end:int, offset:int) -> None:
+        if self._last_tid != tid:
+            self._last_tid = tid
+            self._last_bin = None
+        elif tid >= 0 and self._last_coor > beg:
+            raise PheWebError("While writing {!r}, the positions on chrom {!r} aren't sorted".format(self._filepath, self._chroms[tid]))
+        if tid >= 0:
+            lidx = self._lidx[tid]
+            window_end = (end - 1) >> self._MIN_SHIFT
+            if len(lidx) <= window_end: lidx.extend([-1] * (window_end + 1 - len(lidx)))
+            for window in range(beg >> self._MIN_SHIFT, window_end + 1):
+                if lidx[window] == -1: lidx[window] = self._last_off
+            bin_num = _reg2bin(beg, end, self._MIN_SHIFT, self._N_LVLS)
+        else:
+            self._n_no_coor += 1
+            bin_num = -1
+        if self._last_bin != bin_num:
+            if self._save_bin is not None:
+                assert self._save_tid is not None
+                self._bins[self._save_tid].setdefault(self._save_bin, []).append([self._save_off, self._last_off])
+            if self._last_bin is None and self._save_bin is not None:  # changed chrom
+                assert self._save_tid is not None
+                self._off_end = self._last_off
+                self._meta[self._save_tid] = [[self._off_beg, self._off_end], [self._n_mapped, self._n_unmapped]]
+                self._n_mapped = self._n_unmapped = 0
+                self._off_beg = self._off_end
+            self._save_off = self._last_off
+            self._save_bin = self._last_bin = bin_num
+            self._save_tid = tid
+        if tid >= 0: self._n_mapped += 1
+        else: self._n_unmapped += 1
+        self._last_off = offset
+        self._last_coor = beg
+
+    def close(self) -> bytes:
+        '''Finishes the bgzipped file and returns the (uncompressed) contents of its tabix index.'''
+        if self._partial_line: self._pending.append('\n')
+        self._flush()
+        self._bgzf_writer.finish()
+        self._push(-1, 0, 0, self._bgzf_writer.uncompressed_offset)  # flush, like `hts_idx_finish()`
+        self._n_no_coor -= 1
+
+        voff = self._bgzf_writer.get_virtual_offset
+        out = [b'TBI\x01', struct.pack('<i', len(self._chroms))]
+        names = b''.join(chrom.encode() + b'\0' for chrom in self._chroms)
+        out.append(struct.pack('<7i', 0, 1, 2, 2, ord('#'), self._LINE_SKIP, len(names)))  # preset=generic, seq_col, beg_col, end_col, meta_char, line_skip
+        out.append(names)
+        for tid in range(len(self._chroms)):
+            bins = {bin_num: [[voff(beg), voff(end)] for beg, end in chunks] for bin_num, chunks in self._bins[tid].items()}
+            _compress_binning(bins, self._N_LVLS, self._N_BINS)
+            meta = self._meta[tid]
+            bins[self._META_BIN] = [[voff(meta[0][0]), voff(meta[0][1])], meta[1]]
+            lidx = [-1 if offset == -1 else voff(offset) for offset in self._lidx[tid]]
+            # Like `update_loff()`, give each window without any lines the offset of the next window that has one.  (The last window always has one.)
+            for window in range(len(lidx)-2, -1, -1):
+                if lidx[window] == -1: lidx[window] = lidx[window+1]
+            out.append(struct.pack('<i', len(bins)))
+            for bin_num, chunks in sorted(bins.items()):
+                out.append(struct.pack('<Ii', bin_num, len(chunks)))
+                out.append(struct.pack('<{}Q'.format(2*len(chunks)), *itertools.chain.from_iterable(chunks)))
+            out.append(struct.pack('<i{}Q'.format(len(lidx)), len(lidx), *lidx))
+        out.append(struct.pack('<Q', self._n_no_coor))
+        return b''.join(out)
+
+def _reg2bin(beg:int, end:int, min_shift:int, n_lvls:int) -> int:
+    '''Returns the smallest bin that contains `[beg, end)`, like `hts_reg2bin()`.'''
+    end -= 1
+    shift, first_bin = min_shift, ((1 << (3*n_lvls + 3)) - 1) // 7
+    for lvl in range(n_lvls, 0, -1):
+        first_bin -= 1 << (3*lvl)
+        if beg >> shift == end >> shift: return first_bin + (beg >> shift)
+        shift += 3
+    return 0
+
+def _compress_binning(bins:Dict[int,List[List[int]]], n_lvls:int, n_bins:int) -> None:
+    '''Like `compress_binning()` in htslib: merges bins that span less than 64KB of compressed data into their parents, and then merges adjacent chunks.'''
+    for lvl in range(n_lvls, 0, -1):
+        first_bin = ((1 << (3*lvl)) - 1) // 7
+        for bin_num in sorted(bins):
+            if bin_num >= n_bins or bin_num < first_bin: continue
+            chunks = bins[bin_num]
+            if lvl < n_lvls and len(chunks) > 1: chunks.sort(key=lambda chunk: chunk[0])
+            if (chunks[-1][1] >> 16) - (chunks[0][0] >> 16) < 0x10000:
+                parent_bin = (bin_num - 1) >> 3
+                if parent_bin in bins:
+                    bins[parent_bin].extend(chunks)
+                    del bins[bin_num]
+    if 0 in bins: bins[0].sort(key=lambda chunk: chunk[0])
+    for bin_num, chunks in bins.items():
+        merged = chunks[:1]
+        for chunk in chunks[1:]:
+            if merged[-1][1] >> 16 >= chunk[0] >> 16:
+                merged[-1][1] = max(merged[-1][1], chunk[1])
+            else:
+                merged.append(chunk)
+        chunks[:] = merged
+
+
+def get_tabix_chrom_virtual_offsets(tbi_filepath:str) -> Dict[str,int]:
+    '''
+    Returns `{chrom: virtual_offset}` from a tabix index, where `virtual_offset` points to the first line on that chrom.
+    (As in htslib, a virtual offset is `(bgzip_block_offset << 16) | offset_within_uncompressed_block`.)
+    See <https://samtools.github.io/hts-specs/tabix.pdf> for the format.
+    '''
+    with gzip.open(tbi_filepath, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'TBI\x01': raise PheWebError("The file {!r} isn't a tabix index".format(tbi_filepath))
+    n_ref, l_nm = struct.unpack_from('<i', data, 4)[0], struct.unpack_from('<i', data, 32)[0]
+    chroms = data[36:36+l_nm].split(b'\0')[:n_ref]
+    offset = 36 + l_nm
+    virtual_offsets: Dict[str,int] = {}
+    for chrom in chroms:
+        n_bin, = struct.unpack_from('<i', data, offset)
+        offset += 4
+        chunk_begs: List[int] = []
+        for _ in range(n_bin):
+            bin_num, n_chunk = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            if bin_num != 37450:  # The pseudo-bin 37450 holds metadata rather than chunks.
+                chunk_begs.extend(struct.unpack_from('<{}Q'.format(2*n_chunk), data, offset)[::2])
+            offset += 16 * n_chunk
+        n_intv, = struct.unpack_from('<i', data, offset)
+        offset += 4 + 8 * n_intv
+        if chunk_begs: virtual_offsets[chrom.decode()] = min(chunk_begs)
+    return virtual_offsets
+
+
+def get_virtual_offset(filepath:str, chroms:List[str]) -> int:
+    '''
+    Returns the virtual offset of the first variant on `chroms` in the bgzipped file `filepath`, or -1 if there are none.
+    Returns 0 (meaning "read from the beginning") if the tabix index is missing or out-of-date.
+    '''
+    tbi_filepath = filepath + '.tbi'
+    if not os.path.exists(tbi_filepath) or os.stat(tbi_filepath).st_mtime < os.stat(filepath).st_mtime: return 0
+    try:
+        virtual_offsets = get_tabix_chrom_virtual_offsets(tbi_filepath)
+    except Exception:
+        return 0
+    for chrom in chroms:
+        if chrom in virtual_offsets: return virtual_offsets[chrom]
+    return -1
+
 
 def write_json(*, filepath:Optional[str] = None, data=None, indent:Optional[int] = None, sort_keys:bool = False) -> None:
     # Don't allow positional args, because I can never remember the order anyways
@@ -407,6 +1419,14 @@ def write_json(*, filepath:Optional[str] = None, data=None, indent:Optional[int]
     make_basedir(filepath)
     with AtomicSaver(filepath, text_mode=True, part_file=part_file, overwrite_part=True, rm_part_on_exc=False) as f:
         json.dump(data, f, indent=indent, sort_keys=sort_keys, default=_json_writer_default)
+@contextmanager
+def file_lock(filepath:str) -> Iterator[None]:
+    '''Holds an exclusive lock on `<filepath>.lock`, so that processes that read-modify-write `filepath` take turns.'''
+    import fcntl
+    make_basedir(filepath)
+    with open(filepath + '.lock', 'a') as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        yield
 def _json_writer_default(obj:Any) -> Any:
     import numpy as np
     if isinstance(obj, np.float32):
@@ -4,8 +4,10 @@ This script takes a file with the columns [chrom, pos, ...] (but no headers) and
 '''
 
 from ..utils import get_gene_tuples
-from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath
+from .. import conf
+from ..file_utils import VariantFileReader, IndexedVariantFileWriter, get_filepath
 from .load_utils import mtime
+from .build_manifest import should_rebuild, record_build
 
 from intervaltree import IntervalTree, Interval
 import bisect
@@ -72,9 +74,9 @@ class GeneAnnotator(object):
 
 
 def annotate_genes(in_filepath:str, out_filepath:str) -> None:
-    '''Both args are filepaths'''
+    '''Both args are filepaths.  The output is bgzipped with a tabix index, so that `pheweb matrix` can start reading it at any chromosome.'''
     ga = GeneAnnotator(get_gene_tuples())
-    with VariantFileWriter(out_filepath) as out_f, \
+    with IndexedVariantFileWriter(out_filepath) as out_f, \
          VariantFileReader(in_filepath) as variants:
         for v in variants:
             v['nearest_genes'] = ga.annotate_position(v['chrom'], v['pos'])
@@ -86,6 +88,10 @@ def run(argv:List[str]) -> None:
         print('Annotate the sites file with nearest genes.  Fetches the relevant version of Gencode if not already present.')
         exit(1)
 
+    if conf.get_sites_file():
+        print('`sites_file` is set, so its nearest genes are used.')
+        return
+
     input_filepath = get_filepath('sites-rsids')
     genes_filepath = get_filepath('genes', must_exist=False)
     out_filepath = get_filepath('sites', must_exist=False)
@@ -95,7 +101,9 @@ def run(argv:List[str]) -> None:
         from . import download_genes
         download_genes.run([])
 
-    if os.path.exists(out_filepath) and max(mtime(genes_filepath), mtime(input_filepath)) <= mtime(out_filepath):
+    by_mtime = not os.path.exists(out_filepath) or max(mtime(genes_filepath), mtime(input_filepath)) > mtime(out_filepath)
+    if not should_rebuild('add-genes', [input_filepath, genes_filepath], [out_filepath], by_mtime=by_mtime):
         print('gene annotation is up-to-date!')
     else:
         annotate_genes(input_filepath, out_filepath)
+        record_build('add-genes', [input_filepath, genes_filepath])
@@ -23,6 +23,7 @@ from ..utils import chrom_order, chrom_order_list, chrom_aliases, PheWebError
 from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath, read_maybe_gzip
 from .. import conf
 from .load_utils import mtime
+from .build_manifest import should_rebuild, record_build
 
 import os
 import itertools
@@ -94,6 +95,10 @@ def run(argv:List[str]) -> None:
         print('Annotate the sites file with rsids. Download the relevant version of dbSNP if not already present.')
         exit(1)
 
+    if conf.get_sites_file():
+        print('`sites_file` is set, so its rsids are used.')
+        return
+
     in_filepath = get_filepath('unanno')
     out_filepath = get_filepath('sites-rsids', must_exist=False)
     rsids_filepath = get_filepath('rsids', must_exist=False)
@@ -103,9 +108,11 @@ def run(argv:List[str]) -> None:
         from . import download_rsids
         download_rsids.run([])
 
-    if os.path.exists(out_filepath) and max(mtime(in_filepath), mtime(rsids_filepath)) <= mtime(out_filepath):
-        print('rsid annotation is up-to-date!')
-        return
+    if os.path.exists(out_filepath):
+        by_mtime = max(mtime(in_filepath), mtime(rsids_filepath)) > mtime(out_filepath)
+        if not should_rebuild('add-rsids', [in_filepath, rsids_filepath], [out_filepath], by_mtime=by_mtime):
+            print('rsid annotation is up-to-date!')
+            return
 
     with VariantFileReader(in_filepath) as in_reader, \
          read_maybe_gzip(rsids_filepath) as rsids_f, \
@@ -147,3 +154,4 @@ def run(argv:List[str]) -> None:
                 for cpra in cp_group:
                     cpra['rsids'] = ''
                     writer.write(cpra)
+    record_build('add-rsids', [in_filepath, rsids_filepath])
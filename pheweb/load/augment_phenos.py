@@ -1,10 +1,28 @@
+'''
+This script annotates each phenotype's parsed file with the per-variant fields of the sites file, making its pheno_gz file (and tabix index).
+
+When there are fewer phenotypes than processes, a large parsed file is split into groups of chromosomes (using its tabix index).
+Each group is read by a separate process, which seeks both the parsed file and the sites file to its first chromosome,
+and writes a bgzip fragment without a header or the empty block that marks EOF.
+Then the fragments are concatenated in order after a header, the EOF block is appended, and the file is tabixed.
+'''
 
 from ..utils import PheWebError
-from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath, get_pheno_filepath, with_chrom_idx, get_tmp_path, convert_VariantFile_to_IndexedVariantFile
-from .load_utils import parallelize_per_pheno, get_phenos_subset, get_phenolist
+from .. import conf
+from ..file_utils import VariantFileReader, IndexedVariantFileWriter, BinaryVariantFileWriter, VariantFileFragmentWriter, concatenate_variant_file_fragments
+from ..file_utils import get_filepath, get_pheno_filepath, get_tmp_path, with_chrom_idx
+from .load_utils import PerPhenoParallelizer, get_phenos_subset, get_phenolist, PhenoStage
+from .sites import split_file_into_chrom_groups
+
+import argparse
+import contextlib
+import os
+from typing import List,Dict,Any,Optional
+
+
+# A parsed file is only split into parts with at least this many (compressed) bytes, because each part has some overhead.
+MIN_BYTES_PER_PART = 8 * 2**20
 
-import argparse, os
-from typing import List,Dict,Any
 
 def run(argv:List[str]) -> None:
     parser = argparse.ArgumentParser(description="annotate each phenotype by pulling in information from the combined sites file")
@@ -13,11 +31,14 @@ def run(argv:List[str]) -> None:
 
     phenos = get_phenos_subset(args.phenos) if args.phenos else get_phenolist()
 
-    parallelize_per_pheno(
+    PerPhenoParallelizer().run_on_each_pheno_in_parts(
         get_input_filepaths = get_input_filepaths,
         get_output_filepaths = get_output_filepaths,
         convert = convert,
-        cmd = 'augment-pheno',
+        split = split_pheno,
+        convert_part = convert_part,
+        merge_parts = merge_parts,
+        cmd = pheno_stage.cmd,
         phenos = phenos,
     )
 
@@ -27,22 +48,51 @@ def get_input_filepaths(pheno:dict) -> List[str]:
         get_filepath('sites'),
     ]
 def get_output_filepaths(pheno:dict) -> List[str]:
-    return [
+    ret = [
         get_pheno_filepath('pheno_gz', pheno['phenocode'], must_exist=False),
         get_pheno_filepath('pheno_gz_tbi', pheno['phenocode'], must_exist=False),
     ]
+    if conf.should_write_binary_variant_files():
+        ret.append(get_pheno_filepath('pheno_bin', pheno['phenocode'], must_exist=False))
+    return ret
 
 def convert(pheno:Dict[str,Any]) -> None:
-
-    parsed_filepath = get_pheno_filepath('parsed', pheno['phenocode'])
-    sites_filepath = get_filepath('sites')
     out_filepath = get_pheno_filepath('pheno_gz', pheno['phenocode'], must_exist=False)
-    out_unzipped_filepath = get_tmp_path(out_filepath)
+    bin_filepath = get_pheno_filepath('pheno_bin', pheno['phenocode'], must_exist=False) if conf.should_write_binary_variant_files() else None
+    with IndexedVariantFileWriter(out_filepath, num_threads=conf.get_num_compression_threads()) as writer, \
+         (BinaryVariantFileWriter(bin_filepath) if bin_filepath else contextlib.nullcontext()) as bin_writer:
+        if _augment(pheno, writer, bin_writer) == 0:
+            raise PheWebError("It appears that the phenotype {!r} has no variants.".format(pheno['phenocode']))
+
+def split_pheno(pheno:Dict[str,Any], max_num_parts:int) -> List[Optional[List[str]]]:
+    '''Splits the parsed file of `pheno` into groups of chroms, or returns `[None]` if it can't be split (see `split_file_into_chrom_groups()`).'''
+    if conf.should_write_binary_variant_files(): return [None]
+    return split_file_into_chrom_groups(get_pheno_filepath('parsed', pheno['phenocode']), max_num_parts, MIN_BYTES_PER_PART)
 
+def convert_part(pheno:Dict[str,Any], chroms:List[str]) -> Dict[str,Any]:
+    '''Returns `{"filepath": <filepath>, "fields": <fields>}`, where `filepath` is a bgzip fragment of the variants on `chroms`, and `fields` is None if there are none.'''
+    out_filepath = get_tmp_path('augment-{}-chr{}-chr{}.gz'.format(pheno['phenocode'], chroms[0], chroms[-1]))
+    with VariantFileFragmentWriter(out_filepath, num_threads=conf.get_num_compression_threads()) as writer:
+        _augment(pheno, writer, None, chroms=chroms)
+    return {'filepath': out_filepath, 'fields': writer.fields}
 
-    with VariantFileReader(sites_filepath) as sites_reader, \
-         VariantFileReader(parsed_filepath) as pheno_reader, \
-         VariantFileWriter(out_unzipped_filepath, use_gzip=False) as writer:
+def merge_parts(pheno:Dict[str,Any], parts:List[Dict[str,Any]]) -> None:
+    try:
+        fields_of_parts = [part['fields'] for part in parts if part['fields'] is not None]
+        if not fields_of_parts: raise PheWebError("It appears that the phenotype {!r} has no variants.".format(pheno['phenocode']))
+        assert all(fields == fields_of_parts[0] for fields in fields_of_parts), fields_of_parts
+        out_filepath = get_pheno_filepath('pheno_gz', pheno['phenocode'], must_exist=False)
+        concatenate_variant_file_fragments(fields_of_parts[0], [part['filepath'] for part in parts], out_filepath)
+    finally:
+        for part in parts: os.remove(part['filepath'])
+
+def _augment(pheno:Dict[str,Any], writer:Any, bin_writer:Any, chroms:Optional[List[str]] = None) -> int:
+    '''Writes each variant of `pheno` (on `chroms`, if it's given) with the fields of the matching variant in the sites file.  Returns the number of variants.'''
+    parsed_filepath = get_pheno_filepath('parsed', pheno['phenocode'])
+    sites_filepath = get_filepath('sites')
+    num_variants = 0
+    with VariantFileReader(sites_filepath, chroms=chroms) as sites_reader, \
+         VariantFileReader(parsed_filepath, chroms=chroms) as pheno_reader:
         sites_variants = with_chrom_idx(iter(sites_reader))
         pheno_variants = with_chrom_idx(iter(pheno_reader))
 
@@ -51,9 +101,10 @@ def convert(pheno:Dict[str,Any]) -> None:
             pheno_variant.update(sites_variant)
             del pheno_variant['chrom_idx']
             writer.write(pheno_variant)
+            if bin_writer is not None: bin_writer.write(pheno_variant)
 
         try: pheno_variant = next(pheno_variants)
-        except StopIteration: raise PheWebError("It appears that the phenotype {!r} has no variants.".format(pheno['phenocode']))
+        except StopIteration: return 0
         try: sites_variant = next(sites_variants)
         except StopIteration: raise PheWebError("It appears that your sites file ({!r}) has no variants.".format(sites_filepath))
         while True:
@@ -65,13 +116,14 @@ def convert(pheno:Dict[str,Any]) -> None:
                 raise PheWebError("The sites file ({}) is missing a variant that's present in {}: {}.".format(sites_filepath, parsed_filepath, pheno_variant))
             else:  # they're equal, so write out the match and then advance both. (pheno first and sites second)
                 write_variant(sites_variant, pheno_variant)
+                num_variants += 1
                 try: pheno_variant = next(pheno_variants)
                 except StopIteration: break  # done.
                 try: sites_variant = next(sites_variants)
                 except StopIteration: raise PheWebError("The sites file ({}) ran out of variants while {} still had {}".format(sites_filepath, parsed_filepath, pheno_variant))
+    return num_variants
 
-    convert_VariantFile_to_IndexedVariantFile(out_unzipped_filepath, out_filepath)
-    os.unlink(out_unzipped_filepath)
+pheno_stage = PhenoStage('augment-pheno', get_input_filepaths, get_output_filepaths, convert)
 
 
 def _which_variant_is_bigger(v1:Dict[str,Any], v2:Dict[str,Any]) -> int:
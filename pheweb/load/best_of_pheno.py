@@ -1,13 +1,21 @@
 '''
 This script creates generated-by-pheweb/best-of-pheno/<pheno> which contains the strongest 100k associations for the phenotype.
+It also writes generated-by-pheweb/best_of_pheno_filters/<pheno>.npz, which has the columns that `/api/manhattan-filtered/` filters on,
+so that the server doesn't have to parse every variant to filter them.
+If `show_manhattan_filter_button` is set, it also writes generated-by-pheweb/filtered_manhattan/<pheno>/<filters>.json
+for the common combinations of filters (see `get_precomputed_filters()`), which the server sends instead of filtering.
 '''
 
-from ..file_utils import VariantFileReader, VariantFileWriter, get_pheno_filepath
-from ..utils import chrom_order
-from .load_utils import MaxPriorityQueue, parallelize_per_pheno, get_phenos_subset, get_phenolist
+from .. import conf
+from ..file_utils import VariantFileReader, VariantFileWriter, get_pheno_filepath, get_tmp_path, write_json
+from ..utils import chrom_order, vep_consqeuence_category
+from .load_utils import MaxPriorityQueue, parallelize_per_pheno, get_phenos_subset, get_phenolist, get_maf_array
+from .manhattan import Binner, get_variant_order
 
 import argparse
-from typing import List,Dict,Any
+import os
+import numpy as np
+from typing import List,Dict,Any,Iterable,Optional,Tuple
 
 
 NUM_VARIANTS = 100_000
@@ -21,22 +29,118 @@ def run(argv:List[str]) -> None:
 
     parallelize_per_pheno(
         get_input_filepaths = lambda pheno: get_pheno_filepath('pheno_gz', pheno['phenocode']),
-        get_output_filepaths = lambda pheno: get_pheno_filepath('best_of_pheno', pheno['phenocode'], must_exist=False),
+        get_output_filepaths = get_output_filepaths,
         convert = make_bestof_file,
         cmd = 'best_of_pheno',
         phenos = phenos,
     )
 
 
+def get_output_filepaths(pheno:Dict[str,Any]) -> List[str]:
+    filepaths = [get_pheno_filepath('best_of_pheno', pheno['phenocode'], must_exist=False),
+                 get_pheno_filepath('best_of_pheno_filters', pheno['phenocode'], must_exist=False)]
+    if conf.should_show_manhattan_filter_button():
+        filepaths.append(get_filtered_manhattan_filepath(pheno['phenocode'], *get_precomputed_filters()[0]))
+    return filepaths
+
+
 def make_bestof_file(pheno:Dict[str,Any]) -> None:
-    make_bestof_file_explicit(get_pheno_filepath('pheno_gz', pheno['phenocode']),
-                              get_pheno_filepath('best_of_pheno', pheno['phenocode'], must_exist=False))
+    assocs = make_bestof_file_explicit(get_pheno_filepath('pheno_gz', pheno['phenocode']),
+                                       get_pheno_filepath('best_of_pheno', pheno['phenocode'], must_exist=False))
+    write_filter_files(pheno, assocs)
 
-def make_bestof_file_explicit(in_filepath:str, out_filepath:str) -> None:
-    q = MaxPriorityQueue()
+def write_filter_files(pheno:Dict[str,Any], assocs:List[Dict[str,Any]]) -> None:
+    '''Writes the filter columns and (if they're used) the precomputed filtered manhattan plots for the best-of-pheno variants `assocs`.'''
+    filter_columns = get_filter_columns(assocs, pheno)
+    write_filter_columns(get_pheno_filepath('best_of_pheno_filters', pheno['phenocode'], must_exist=False), filter_columns)
+    if conf.should_show_manhattan_filter_button():
+        for filters in get_precomputed_filters():
+            is_chosen = get_filter_mask(filter_columns, *filters)
+            # `Binner` modifies the variants that it returns, so it gets copies.
+            chosen_variants = (dict(v) for v, is_variant_chosen in zip(assocs, is_chosen.tolist()) if is_variant_chosen)
+            write_json(filepath=get_filtered_manhattan_filepath(pheno['phenocode'], *filters),
+                       data=get_filtered_manhattan_data(chosen_variants, filter_columns))
+
+def make_bestof_file_explicit(in_filepath:str, out_filepath:str) -> List[Dict[str,Any]]:
+    q = MaxPriorityQueue(get_tiebreak=get_variant_order)
     with VariantFileReader(in_filepath) as vfr:
         for v in vfr:
             q.add_and_keep_size(v, v['pval'], NUM_VARIANTS)
+    assocs = pop_all_in_order(q)
+    with VariantFileWriter(out_filepath) as vfw: vfw.write_all(assocs)
+    return assocs
+
+def pop_all_in_order(q:MaxPriorityQueue) -> List[Dict[str,Any]]:
+    '''Empties `q` and returns its variants sorted by position.'''
     assocs = list(q.pop_all())
     assocs.sort(key=lambda v: (chrom_order[v['chrom']], v['pos']))
-    with VariantFileWriter(out_filepath) as vfw: vfw.write_all(assocs)
+    return assocs
+
+
+csq_category_codes = {'': 0, 'nonsyn': 1, 'lof': 2}
+
+def get_filter_columns(variants:List[Dict[str,Any]], pheno:Dict[str,Any]) -> Dict[str,np.ndarray]:
+    '''
+    Returns the columns that `/api/manhattan-filtered/` filters on, for each of `variants`:
+      - `is_indel` (bool)
+      - `maf` (float64, with nan where it's unknown)
+      - `csq_category` (uint8, the code in `csq_category_codes` of the variant's consequence's category in `vep_consqeuence_category`)
+      - `pval` (float64)
+    '''
+    columns = {field: [v[field] for v in variants] for field in ['maf', 'af', 'ac'] if variants and field in variants[0]}
+    maf = get_maf_array(columns, pheno, is_checked=np.zeros(len(variants), dtype=bool))
+    return {
+        'is_indel': np.array([len(v['ref']) != 1 or len(v['alt']) != 1 for v in variants], dtype=bool),
+        'maf': np.full(len(variants), np.nan) if maf is None else maf.astype(np.float64),
+        'csq_category': np.array([csq_category_codes[vep_consqeuence_category.get(v.get('consequence', ''), '')] for v in variants], dtype=np.uint8),
+        'pval': np.array([v['pval'] for v in variants], dtype=np.float64),
+    }
+
+def get_filter_mask(filter_columns:Dict[str,np.ndarray], indel:str, consequence_category:str, min_maf:Optional[float], max_maf:Optional[float]) -> np.ndarray:
+    '''
+    Returns whether each variant passes the filters of `/api/manhattan-filtered/`.
+    `indel` is '', 'true', or 'false', and `consequence_category` is '', 'lof', or 'nonsyn'.  Variants with an unknown MAF fail any MAF filter.
+    '''
+    is_chosen = np.ones(len(filter_columns['pval']), dtype=bool)
+    if indel == 'true': is_chosen &= filter_columns['is_indel']
+    if indel == 'false': is_chosen &= ~filter_columns['is_indel']
+    if min_maf is not None: is_chosen &= (filter_columns['maf'] >= min_maf)
+    if max_maf is not None: is_chosen &= (filter_columns['maf'] <= max_maf)
+    if consequence_category == 'lof': is_chosen &= (filter_columns['csq_category'] == csq_category_codes['lof'])
+    if consequence_category == 'nonsyn': is_chosen &= (filter_columns['csq_category'] != csq_category_codes[''])
+    return is_chosen
+
+def get_filtered_manhattan_data(chosen_variants:Iterable[Dict[str,Any]], filter_columns:Dict[str,np.ndarray]) -> Dict[str,Any]:
+    '''Bins `chosen_variants` like `pheweb manhattan`, and adds the weakest pval of all the variants (chosen or not).'''
+    binner = Binner()
+    for variant in chosen_variants:
+        binner.process_variant(variant)
+    manhattan_data:Dict[str,Any] = binner.get_result()
+    manhattan_data['weakest_pval'] = max(0, float(filter_columns['pval'].max())) if len(filter_columns['pval']) else 0
+    return manhattan_data
+
+def get_precomputed_filters() -> List[Tuple[str,str,Optional[float],Optional[float]]]:
+    '''
+    Returns the filters `(indel, consequence_category, min_maf, max_maf)` that are precomputed, starting with the default of `pheno-filter.html`.
+    The MAF ranges are all of [0, 0.5], unbounded, and each side of every boundary in `manhattan_filter_maf_boundaries`.
+    '''
+    maf_ranges: List[Tuple[Optional[float],Optional[float]]] = [(0.0, 0.5), (None, None)]
+    for boundary in conf.get_manhattan_filter_maf_boundaries():
+        maf_ranges.extend([(0.0, float(boundary)), (float(boundary), 0.5)])
+    consequence_categories = ['', 'lof', 'nonsyn'] if conf.should_show_manhattan_filter_consequence() else ['']
+    return [(indel, consequence_category, min_maf, max_maf)
+            for min_maf, max_maf in maf_ranges
+            for consequence_category in consequence_categories
+            for indel in ['', 'true', 'false']]
+
+def get_filtered_manhattan_filepath(phenocode:str, indel:str, consequence_category:str, min_maf:Optional[float], max_maf:Optional[float]) -> str:
+    filters = 'indel-{}_csq-{}_maf-{}-{}'.format(indel or 'any', consequence_category or 'any',
+                                                 'none' if min_maf is None else repr(min_maf), 'none' if max_maf is None else repr(max_maf))
+    return os.path.join(get_pheno_filepath('filtered_manhattan', phenocode, must_exist=False), filters + '.json')
+
+def write_filter_columns(filepath:str, filter_columns:Dict[str,np.ndarray]) -> None:
+    tmp_filepath = get_tmp_path(filepath)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    with open(tmp_filepath, 'wb') as f:
+        np.savez(f, **filter_columns)
+    os.replace(tmp_filepath, filepath)
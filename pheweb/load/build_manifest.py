@@ -0,0 +1,143 @@
+'''
+If `build_manifest` is set, `pheweb process` records what each output was built from in `generated-by-pheweb/build-manifest.json`:
+the content hashes of its inputs and a fingerprint of the config that affects it.
+Then a step skips exactly the outputs whose inputs and config are unchanged, even if the files' mtimes have changed
+(eg, after copying the data directory to another filesystem, or touching an input).
+A step that changes an output's inputs (eg, removing a phenotype from `sites`) rebuilds it, even though no input is newer than it.
+
+Outputs without a record (eg, ones built before `build_manifest` was set) use mtimes, and are recorded if they're up-to-date.
+
+The manifest is like:
+  {"digests": {<filepath>: [<size>, <mtime_ns>, <digest>], ...},
+   "builds": {<key>: {"inputs": [<digest>, ...], "config": <digest>}, ...}}
+where `key` is the name of the step (like `matrix`), or `<step>/<phenocode>` for per-phenotype steps.
+Inputs are recorded in order rather than by filepath, so that renaming an input doesn't make it look changed.
+Filepaths in the data directory are relative to it.
+Each digest is cached until the file's size or mtime changes, so usually only new or changed files are read.
+'''
+
+from .. import conf
+from ..file_utils import get_filepath, write_json, file_lock
+
+import concurrent.futures
+import hashlib
+import json
+import os
+from typing import List,Dict,Any,Optional,Callable
+
+
+# The config that affects the outputs of each step.  (Steps that aren't here don't depend on any config.)
+_config_getters_for_step: Dict[str,List[Callable[[],Any]]] = {
+    'parse-input-files': [conf.pval_is_neglog10, conf.get_field_aliases, conf.get_assoc_min_maf, conf.get_debugging_limit_num_variants],
+    'augment-pheno': [conf.should_write_binary_variant_files],
+    'manhattan': [conf.get_manhattan_num_unbinned, conf.get_manhattan_peak_max_count, conf.get_manhattan_peak_pval_threshold,
+                  conf.get_manhattan_peak_sprawl_dist, conf.get_manhattan_peak_variant_counting_pval_threshold],
+    'qq': [conf.should_write_binary_variant_files, conf.should_approximate_qq],
+    'best_of_pheno': [conf.should_show_manhattan_filter_button, conf.should_show_manhattan_filter_consequence, conf.get_manhattan_filter_maf_boundaries],
+    'add-rsids': [conf.get_hg_build_number],
+    'add-genes': [conf.get_hg_build_number],
+    'matrix': [conf.get_matrix_num_shards, conf.should_write_variant_store],
+    'top-hits': [conf.get_top_hits_pval_cutoff, conf.get_within_pheno_mask_around_peak, conf.get_between_pheno_mask_around_peak],
+    'phenotypes': [conf.get_within_pheno_mask_around_peak, conf.get_between_pheno_mask_around_peak],
+}
+_config_getters_for_step['manhattan_qq'] = _config_getters_for_step['manhattan'] + _config_getters_for_step['qq'] + _config_getters_for_step['best_of_pheno']
+
+def get_config_fingerprint(step:str) -> str:
+    config = [getter() for getter in _config_getters_for_step.get(step, [])]
+    return hashlib.blake2b(json.dumps(config, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+class BuildManifest:
+    def __init__(self):
+        self._filepath = get_filepath('build-manifest', must_exist=False)
+        data = self._load()
+        self._digests: Dict[str,List[Any]] = data.get('digests', {})
+        self._builds: Dict[str,Dict[str,Any]] = data.get('builds', {})
+        self._new_digests: Dict[str,List[Any]] = {}
+        self._new_builds: Dict[str,Dict[str,Any]] = {}
+
+    @staticmethod
+    def load_if_enabled() -> Optional['BuildManifest']:
+        return BuildManifest() if conf.should_use_build_manifest() else None
+
+    def _load(self) -> Dict[str,Any]:
+        try:
+            with open(self._filepath) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self) -> None:
+        '''Adds the new digests and records to the manifest file, keeping any that other processes (eg, other steps of `pheweb process`) have saved.'''
+        with file_lock(self._filepath):
+            data = self._load()
+            self._digests = data.get('digests', {})
+            self._digests.update(self._new_digests)
+            self._builds = data.get('builds', {})
+            self._builds.update(self._new_builds)
+            write_json(filepath=self._filepath, data={'digests': self._digests, 'builds': self._builds})
+
+    def has_record(self, key:str) -> bool:
+        return key in self._builds
+
+    def is_up_to_date(self, key:str, step:str, input_filepaths:List[str], output_filepaths:List[str]) -> bool:
+        '''Returns whether `key` was built from inputs with the same contents as `input_filepaths`, with the same config, and its outputs still exist.'''
+        build = self._builds.get(key)
+        if build is None or build['config'] != get_config_fingerprint(step): return False
+        if not all(os.path.exists(fp) for fp in output_filepaths): return False
+        return build['inputs'] == self.get_digests(input_filepaths)
+
+    def record(self, key:str, step:str, input_digests:List[str]) -> None:
+        '''Records that `key` was just built from inputs with `input_digests` (from `get_digests()`, before building).'''
+        self._builds[key] = self._new_builds[key] = {'inputs': input_digests, 'config': get_config_fingerprint(step)}
+
+    def get_digests(self, filepaths:List[str]) -> List[str]:
+        '''Returns the content hash of each of `filepaths`.  Files that aren't cached are hashed in parallel threads.'''
+        names = [self._get_name(fp) for fp in filepaths]
+        stats = [os.stat(fp) for fp in filepaths]
+        stale_idxs = [idx for idx, (name, stat) in enumerate(zip(names, stats))
+                      if self._digests.get(name, [None, None])[:2] != [stat.st_size, stat.st_mtime_ns]]
+        if stale_idxs:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=conf.get_num_procs()) as executor:
+                # hashlib releases the GIL while it hashes, so threads can read and hash several files at once.
+                stale_digests = list(executor.map(_hash_file, [filepaths[idx] for idx in stale_idxs]))
+            for idx, digest in zip(stale_idxs, stale_digests):
+                self._digests[names[idx]] = self._new_digests[names[idx]] = [stats[idx].st_size, stats[idx].st_mtime_ns, digest]
+        return [self._digests[name][2] for name in names]
+
+    @staticmethod
+    def _get_name(filepath:str) -> str:
+        filepath = os.path.abspath(filepath)
+        data_dir = os.path.abspath(conf.get_data_dir())
+        if filepath.startswith(data_dir + os.path.sep): return os.path.relpath(filepath, data_dir)
+        return filepath
+
+def _hash_file(filepath:str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def should_rebuild(step:str, input_filepaths:List[str], output_filepaths:List[str], *, by_mtime:bool) -> bool:
+    '''
+    For a step with a single group of outputs: if `build_manifest` is set and has a record for `step`, returns whether it needs rebuilding.
+    Otherwise, returns `by_mtime` (the step's own decision, based on mtimes), and if that's False and `build_manifest` is set, records the current inputs.
+    '''
+    manifest = BuildManifest.load_if_enabled()
+    if manifest is None: return by_mtime
+    if manifest.has_record(step):
+        should = not manifest.is_up_to_date(step, step, input_filepaths, output_filepaths)
+    else:
+        should = by_mtime
+        if not should: manifest.record(step, step, manifest.get_digests(input_filepaths))
+    manifest.save()  # to keep any new digests
+    return should
+
+def record_build(step:str, input_filepaths:List[str]) -> None:
+    '''If `build_manifest` is set, records that `step` was just built from `input_filepaths`.'''
+    manifest = BuildManifest.load_if_enabled()
+    if manifest is None: return
+    manifest.record(step, step, manifest.get_digests(input_filepaths))
+    manifest.save()
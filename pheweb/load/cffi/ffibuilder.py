@@ -17,4 +17,26 @@ ffibuilder.set_source('pheweb.load.cffi._x',
 )
 ffibuilder.cdef('''
 const char* cffi_make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath);
+const char* cffi_make_matrix_for_chroms(const char *sites_filepath,
+                                        int64_t sites_virtual_offset,
+                                        const char **augmented_pheno_filepaths,
+                                        const int64_t *augmented_pheno_virtual_offsets,
+                                        size_t num_phenos,
+                                        const char *old_matrix_filepath,
+                                        int64_t old_matrix_virtual_offset,
+                                        const int64_t *column_group_aug_idxs,
+                                        const int64_t *column_group_old_starts,
+                                        const int64_t *column_group_old_ends,
+                                        size_t num_column_groups,
+                                        const char **chroms,
+                                        size_t num_chroms,
+                                        const char **chrom_order,
+                                        size_t num_chrom_order,
+                                        int write_header,
+                                        int write_eof_block,
+                                        const char *matrix_filepath,
+                                        const char *store_prefix,
+                                        size_t store_num_columns,
+                                        const int64_t *store_column_for_field,
+                                        size_t store_num_fields);
 ''')
@@ -20,7 +20,10 @@ compile with:
 #include <iomanip> // setprecision
 #include <zlib.h>
 #include <fcntl.h> // O_WRONLY &c
+#include <unistd.h> // lseek
 #include <exception> // do I need this?
+#include <limits> // quiet_NaN
+#include <memory> // unique_ptr
 
 
 // ------
@@ -61,10 +64,11 @@ public:
     void write(const std::string src_string) {
         write(src_string.c_str(), src_string.length());
     }
-    void close() {
+    void close(bool write_eof_block = true) {
         // Make one empty block at the end to indicate EOF (as per samtools unofficial spec)
+        // Skip it when writing a fragment that will be concatenated with others.
         if (_uncompressed_block_size) flush_uncompressed();
-        flush_uncompressed();
+        if (write_eof_block) flush_uncompressed();
     }
 private:
      static inline void packInt16(uint8_t *buffer, uint16_t value) {
@@ -191,6 +195,7 @@ public:
     }
     int is_open() { return opened; }
     gzstreambuf* open( const char* name, int open_mode);
+    gzstreambuf* open_at_offset( const char* name, off_t offset);
     gzstreambuf* close();
     ~gzstreambuf() { close(); }
     virtual int     overflow( int c = EOF);
@@ -205,6 +210,7 @@ public:
     gzstreambase( const char* name, int open_mode);
     ~gzstreambase();
     void open( const char* name, int open_mode);
+    void open_at_offset( const char* name, off_t offset);
     void close();
     gzstreambuf* rdbuf() { return &buf; }
 };
@@ -240,6 +246,22 @@ gzstreambuf* gzstreambuf::open( const char* name, int open_mode) {
     opened = 1;
     return this;
 }
+gzstreambuf* gzstreambuf::open_at_offset( const char* name, off_t offset) {
+    // Reads starting at byte `offset` of the compressed file, which must be the start of a gzip member (eg, a bgzip block).
+    if ( is_open())
+        return (gzstreambuf*)0;
+    mode = std::ios::in;
+    int fd = ::open(name, O_RDONLY);
+    if (fd < 0)
+        return (gzstreambuf*)0;
+    if (lseek(fd, offset, SEEK_SET) != offset || (file = gzdopen(fd, "rb")) == 0) {
+        ::close(fd);
+        return (gzstreambuf*)0;
+    }
+    setg( buffer + 4, buffer + 4, buffer + 4); // discard anything buffered before a previous close()
+    opened = 1;
+    return this;
+}
 gzstreambuf * gzstreambuf::close() {
     if ( is_open()) {
         sync();
@@ -314,6 +336,10 @@ void gzstreambase::open( const char* name, int open_mode) {
     if ( ! buf.open( name, open_mode))
         clear( rdstate() | std::ios::badbit);
 }
+void gzstreambase::open_at_offset( const char* name, off_t offset) {
+    if ( ! buf.open_at_offset( name, offset))
+        clear( rdstate() | std::ios::badbit);
+}
 void gzstreambase::close() {
     if ( buf.is_open())
         if ( ! buf.close())
@@ -329,6 +355,13 @@ public:
         stream.open(filepath.c_str());
         next();
     }
+    inline void seek(const std::string& filepath, int64_t virtual_offset) { // re-opens a bgzip file at a virtual offset (as in tabix) and reads the line there
+        stream.close();
+        stream.clear();
+        stream.open_at_offset(filepath.c_str(), virtual_offset >> 16); // the offset of the bgzip block
+        stream.ignore(virtual_offset & 0xffff); // the offset within the uncompressed block
+        next();
+    }
     inline void next() {
         std::getline(stream, line); // drops the \n
         if (!line.empty() && line[line.size() - 1] == '\r') line.erase(line.size() - 1); // CR remover from <http://stackoverflow.com/a/2529011/1166306>
@@ -381,6 +414,45 @@ static inline size_t pos_after_n_of_char(std::string str, size_t n, char c) {
     return -1;
 }
 
+static inline bool is_on_chroms(const std::string& line, const std::vector<std::string>& chroms) {
+    // whether the line's chrom (its first field) is one of `chroms`.  If `chroms` is empty, every chrom counts.
+    if (chroms.empty()) return true;
+    size_t chrom_len = line.find('\t');
+    for (size_t i = 0; i < chroms.size(); i++) {
+        if (0 == line.compare(0, chrom_len, chroms[i])) return true;
+    }
+    return false;
+}
+
+static inline int compare_cpra(const std::string& a, const std::string& b, const std::vector<std::string>& chrom_order) {
+    // compares the chrom-pos-ref-alt at the start of two lines, returning -1, 0, or 1 (like `strcmp`).
+    size_t a_chrom_len = a.find('\t'), b_chrom_len = b.find('\t');
+    if (a_chrom_len == std::string::npos || b_chrom_len == std::string::npos) { throw std::runtime_error("[tried to compare a line without a chrom]"); }
+    if (0 != a.compare(0, a_chrom_len, b, 0, b_chrom_len)) {
+        int a_chrom_idx = -1, b_chrom_idx = -1;
+        for (size_t i = 0; i < chrom_order.size(); i++) {
+            if (0 == a.compare(0, a_chrom_len, chrom_order[i])) a_chrom_idx = i;
+            if (0 == b.compare(0, b_chrom_len, chrom_order[i])) b_chrom_idx = i;
+        }
+        if (a_chrom_idx == -1 || b_chrom_idx == -1) { throw std::runtime_error("[unknown chrom in line: " + (a_chrom_idx == -1 ? a : b).substr(0, 100) + "]"); }
+        return a_chrom_idx < b_chrom_idx ? -1 : 1;
+    }
+    long long a_pos = strtoll(a.c_str() + a_chrom_len + 1, NULL, 10), b_pos = strtoll(b.c_str() + b_chrom_len + 1, NULL, 10);
+    if (a_pos != b_pos) return a_pos < b_pos ? -1 : 1;
+    size_t a_ref = a.find('\t', a_chrom_len + 1) + 1, b_ref = b.find('\t', b_chrom_len + 1) + 1;
+    size_t a_end = pos_after_n_of_char(a, 4, '\t'), b_end = pos_after_n_of_char(b, 4, '\t'); // ref and alt can't contain tabs, so comparing "ref\talt" works.
+    int cmp = a.compare(a_ref, a_end - a_ref, b, b_ref, b_end - b_ref);
+    return cmp < 0 ? -1 : (cmp > 0 ? 1 : 0);
+}
+
+static inline std::vector<size_t> tab_positions(const std::string& line) {
+    std::vector<size_t> ret;
+    for (size_t i = 0; i < line.size(); i++) {
+        if (line[i] == '\t') ret.push_back(i);
+    }
+    return ret;
+}
+
 static inline size_t n_fields(std::string str) {
     // count the number of tab-delimited fields in a string
     return 1 + std::count(str.begin(), str.end(), '\t'); // `1+` because there's no trailing \t
@@ -397,14 +469,112 @@ bool endsWith (std::string const &str, std::string const &suffix) {
 // ------
 // main
 
-int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath) {
+struct ColumnGroup {
+    // The per-assoc fields of one phenotype, which come either from `aug_filepaths[aug_idx]`
+    // or (if `aug_idx == -1`) from the fields `[old_start, old_end)` of the old matrix.
+    int64_t aug_idx;
+    size_t old_start;
+    size_t old_end;
+};
+
+class VariantStoreWriter {
+// Writes the raw arrays of a sparse variant store (see `pheweb/load/matrix.py`) for one fragment of the matrix:
+//   <prefix>.chrompos: a uint64 `chrom_idx << 32 | pos` for each variant
+//   <prefix>.variants: the sites.tsv line of each variant, concatenated
+//   <prefix>.variant_ends: a uint64 for each variant, the end of its line in <prefix>.variants
+//   <prefix>.records: packed records of a uint32 column-group index and then a float64 for each store column (NaN means empty)
+//   <prefix>.record_ends: a uint64 for each variant, the number of records up to and including its own
+public:
+    VariantStoreWriter(const std::string& prefix, size_t num_columns, const std::vector<int64_t>& column_for_field) :
+        _num_columns(num_columns), _column_for_field(column_for_field), _num_variant_bytes(0), _num_records(0), _values(num_columns) {
+        _chrompos.open((prefix + ".chrompos").c_str(), std::ios::out | std::ios::binary);
+        _variants.open((prefix + ".variants").c_str(), std::ios::out | std::ios::binary);
+        _variant_ends.open((prefix + ".variant_ends").c_str(), std::ios::out | std::ios::binary);
+        _records.open((prefix + ".records").c_str(), std::ios::out | std::ios::binary);
+        _record_ends.open((prefix + ".record_ends").c_str(), std::ios::out | std::ios::binary);
+        if (!_chrompos || !_variants || !_variant_ends || !_records || !_record_ends) { throw std::runtime_error("[failed to open the variant store files at " + prefix + "]"); }
+    }
+    void write_variant(const std::string& sites_line, const std::vector<std::string>& chrom_order) {
+        size_t chrom_len = sites_line.find('\t');
+        uint64_t chrom_idx = chrom_order.size();
+        for (size_t i = 0; i < chrom_order.size(); i++) {
+            if (0 == sites_line.compare(0, chrom_len, chrom_order[i])) { chrom_idx = i; break; }
+        }
+        if (chrom_idx == chrom_order.size()) { throw std::runtime_error("[unknown chrom in sites.tsv line: " + sites_line.substr(0, 100) + "]"); }
+        uint64_t chrompos = (chrom_idx << 32) | strtoull(sites_line.c_str() + chrom_len + 1, NULL, 10);
+        _chrompos.write((const char*)&chrompos, sizeof(chrompos));
+        _variants.write(sites_line.c_str(), sites_line.size());
+        _num_variant_bytes += sites_line.size();
+        _variant_ends.write((const char*)&_num_variant_bytes, sizeof(_num_variant_bytes));
+    }
+    void write_record(uint32_t column_group_idx, size_t first_field_idx, const char* fields, size_t fields_len) {
+        // `fields` is like "\t<value>\t<value>", holding the fields `first_field_idx` onwards of `_column_for_field`.
+        std::fill(_values.begin(), _values.end(), std::numeric_limits<double>::quiet_NaN());
+        const char* end = fields + fields_len;
+        for (size_t field_idx = first_field_idx; fields < end; field_idx++) {
+            const char* value_start = fields + 1; // skip the tab
+            const char* value_end = (const char*)memchr(value_start, '\t', end - value_start);
+            if (value_end == NULL) value_end = end;
+            int64_t column = _column_for_field[field_idx];
+            if (column >= 0 && value_end > value_start) _values[column] = strtod(value_start, NULL); // strtod stops at the tab
+            fields = value_end;
+        }
+        _records.write((const char*)&column_group_idx, sizeof(column_group_idx));
+        _records.write((const char*)_values.data(), sizeof(double) * _num_columns);
+        _num_records++;
+    }
+    void end_variant() {
+        _record_ends.write((const char*)&_num_records, sizeof(_num_records));
+    }
+    void close() {
+        _chrompos.close(); _variants.close(); _variant_ends.close(); _records.close(); _record_ends.close();
+        if (!_chrompos || !_variants || !_variant_ends || !_records || !_record_ends) { throw std::runtime_error("[failed to write the variant store files]"); }
+    }
+private:
+    size_t _num_columns;
+    std::vector<int64_t> _column_for_field; // for each per-assoc field of each column group, in order, its store column (or -1)
+    uint64_t _num_variant_bytes;
+    uint64_t _num_records;
+    std::vector<double> _values;
+    std::ofstream _chrompos, _variants, _variant_ends, _records, _record_ends;
+};
+
+static inline void write_old_matrix_fields(BgzipWriter &writer, const std::string& line, const std::vector<size_t>& tabs, const ColumnGroup& group) {
+    // writes "\t" followed by fields `[group.old_start, group.old_end)` of `line`, which has tabs at `tabs`.
+    size_t end = (group.old_end - 1 < tabs.size()) ? tabs[group.old_end - 1] : line.size();
+    writer.write(line.c_str() + tabs[group.old_start - 1], end - tabs[group.old_start - 1]);
+}
+
+int make_matrix(const char *sites_filepath,
+                int64_t sites_virtual_offset,
+                const std::vector<std::string>& aug_filepaths,
+                const std::vector<int64_t>& aug_virtual_offsets,
+                const std::string& old_matrix_filepath,
+                int64_t old_matrix_virtual_offset,
+                const std::vector<ColumnGroup>& column_groups,
+                const std::vector<std::string>& chroms,
+                const std::vector<std::string>& chrom_order,
+                bool write_header,
+                bool write_eof_block,
+                const char *matrix_filepath,
+                const std::string& store_prefix,
+                size_t store_num_columns,
+                const std::vector<int64_t>& store_column_for_field) {
+    // Only variants on `chroms` are written (or all variants, if `chroms` is empty).
+    // `aug_virtual_offsets[i]` is the bgzip virtual offset (from the tabix index) of the first variant on `chroms` in `aug_filepaths[i]`,
+    //   or 0 to read from the beginning, or -1 if that file has no variants on `chroms`.
+    //   `sites_virtual_offset` and `old_matrix_virtual_offset` are the same for sites.tsv and the old matrix.
+    // If `old_matrix_filepath` is empty, there is no old matrix, and `chrom_order` isn't needed.
+    // If `store_prefix` isn't empty, this also writes a sparse variant store (see `VariantStoreWriter`) for the same variants.
+    // Matrices written for contiguous groups of chroms (in order) can be concatenated, if only the first has a header and only the last has an EOF block.
     BgzipWriter writer(matrix_filepath);
 
     LineReader sites_reader;
     sites_reader.attach(sites_filepath);
 
-    std::vector<std::string> aug_filepaths = glob(augmented_pheno_glob);
     size_t N_phenos = aug_filepaths.size();
+    if (aug_virtual_offsets.size() != N_phenos) { throw std::runtime_error("[the number of offsets doesn't match the number of pheno files]"); }
+    std::vector<bool> aug_has_chroms(N_phenos, true);
     std::vector<LineReader> aug_readers(N_phenos);
     std::vector<std::string> aug_phenocodes(N_phenos);
     std::vector<unsigned> aug_n_per_assoc_fields(N_phenos); // initialized to 0s.
@@ -421,6 +591,22 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
         }
     }
 
+    const bool has_old_matrix = !old_matrix_filepath.empty();
+    LineReader old_matrix_reader;
+    std::vector<size_t> old_matrix_tabs;
+    size_t n_old_matrix_fields = 0;
+    if (has_old_matrix) {
+        old_matrix_reader.attach(old_matrix_filepath);
+        old_matrix_tabs = tab_positions(old_matrix_reader.line);
+        n_old_matrix_fields = old_matrix_tabs.size() + 1;
+    }
+    for (size_t g = 0; g < column_groups.size(); g++) {
+        if (column_groups[g].aug_idx >= (int64_t)N_phenos ||
+            (column_groups[g].aug_idx < 0 && !(has_old_matrix && 4 <= column_groups[g].old_start && column_groups[g].old_start < column_groups[g].old_end && column_groups[g].old_end <= n_old_matrix_fields))) {
+            throw std::runtime_error("[a column group refers to a pheno file or old matrix fields that don't exist]");
+        }
+    }
+
     // Headers:
     // sites.tsv's header must begin with "chrom pos ref alt ".
     // Every file's header must begin with the header of sites.tsv
@@ -438,39 +624,145 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
             throw std::runtime_error(errstream.str().c_str());
         }
     }
-    writer.write("#"); // tabix needs the header commented.
-    writer.write(sites_reader.line); // no trailing \t or \n
+    if (write_header) {
+        writer.write("#"); // tabix needs the header commented.
+        writer.write(sites_reader.line); // no trailing \t or \n
+    }
     for (size_t i=0; i < N_phenos; i++) {
         std::string per_assoc_fields = aug_readers[i].line.substr(sites_reader.line.size(), std::string::npos);
         std::istringstream line_stream(per_assoc_fields);
         std::string field;
         std::getline(line_stream, field, '\t'); // consume first tab.
-        while(std::getline(line_stream, field, '\t')) {
-            writer.write("\t");
-            writer.write(field);
-            writer.write("@");
-            writer.write(aug_phenocodes[i]);
-            aug_n_per_assoc_fields[i]++;
+        while(std::getline(line_stream, field, '\t')) aug_n_per_assoc_fields[i]++;
+    }
+    if (write_header) {
+        for (size_t g = 0; g < column_groups.size(); g++) {
+            if (column_groups[g].aug_idx < 0) {
+                write_old_matrix_fields(writer, old_matrix_reader.line, old_matrix_tabs, column_groups[g]);
+                continue;
+            }
+            size_t i = column_groups[g].aug_idx;
+            std::string per_assoc_fields = aug_readers[i].line.substr(sites_reader.line.size(), std::string::npos);
+            std::istringstream line_stream(per_assoc_fields);
+            std::string field;
+            std::getline(line_stream, field, '\t'); // consume first tab.
+            while(std::getline(line_stream, field, '\t')) {
+                writer.write("\t");
+                writer.write(field);
+                writer.write("@");
+                writer.write(aug_phenocodes[i]);
+            }
         }
+        writer.write("\n");
     }
-    writer.write("\n");
     const size_t n_per_variant_fields = n_fields(sites_reader.line);
-    // advance every file to its 1st data-line
-    sites_reader.next();
-    for (size_t i=0; i<N_phenos; i++) aug_readers[i].next();
+    std::unique_ptr<VariantStoreWriter> store;
+    std::vector<size_t> column_group_first_field_idx(column_groups.size());
+    if (!store_prefix.empty()) {
+        size_t num_fields = 0;
+        for (size_t g = 0; g < column_groups.size(); g++) {
+            column_group_first_field_idx[g] = num_fields;
+            if (column_groups[g].aug_idx < 0) num_fields += column_groups[g].old_end - column_groups[g].old_start;
+            else num_fields += aug_n_per_assoc_fields[column_groups[g].aug_idx];
+        }
+        if (num_fields != store_column_for_field.size()) { throw std::runtime_error("[the number of store columns doesn't match the number of per-assoc fields]"); }
+        store.reset(new VariantStoreWriter(store_prefix, store_num_columns, store_column_for_field));
+    }
+    // advance every file to its 1st data-line on `chroms`
+    if (sites_virtual_offset < 0) {
+        sites_reader.line.clear(); // there are no variants on `chroms`
+    } else {
+        if (sites_virtual_offset > 0) sites_reader.seek(sites_filepath, sites_virtual_offset);
+        else sites_reader.next();
+        while (!is_on_chroms(sites_reader.line, chroms) && !sites_reader.eof()) sites_reader.next();
+    }
+    for (size_t i=0; i<N_phenos; i++) {
+        if (aug_virtual_offsets[i] < 0) {
+            aug_has_chroms[i] = false;
+            aug_readers[i].stream.close();
+            continue;
+        }
+        if (aug_virtual_offsets[i] > 0) aug_readers[i].seek(aug_filepaths[i], aug_virtual_offsets[i]);
+        else aug_readers[i].next();
+        while (!is_on_chroms(aug_readers[i].line, chroms) && !aug_readers[i].eof()) aug_readers[i].next();
+        if (!is_on_chroms(aug_readers[i].line, chroms)) {
+            aug_has_chroms[i] = false;
+            aug_readers[i].stream.close();
+        }
+    }
+    // `old_matrix_has_line` means that `old_matrix_reader.line` is a variant on `chroms` that we haven't used yet.
+    bool old_matrix_has_line = has_old_matrix && old_matrix_virtual_offset >= 0 && !old_matrix_reader.eof();
+    if (old_matrix_has_line) {
+        if (old_matrix_virtual_offset > 0) old_matrix_reader.seek(old_matrix_filepath, old_matrix_virtual_offset);
+        else old_matrix_reader.next();
+        while (!is_on_chroms(old_matrix_reader.line, chroms) && !old_matrix_reader.eof()) old_matrix_reader.next();
+        old_matrix_has_line = is_on_chroms(old_matrix_reader.line, chroms) && !old_matrix_reader.line.empty();
+    }
+    if (!is_on_chroms(sites_reader.line, chroms)) { // there are no variants on `chroms`
+        writer.close(write_eof_block);
+        if (store) store->close();
+        return 0;
+    }
 
     // Data:
     // Every aug_pheno is a subsequence of sites.tsv.
     // If a line in an aug_pheno has the same chrom-pos-ref-alt as sites.tsv, then it must have the sites.tsv line as its prefix.
     //    (ie, it must have the same per-variant fields, in the same order.)
     // So, we iterate over sites.tsv, printing and advancing any aug_pheno that matches CPRA, and printing '' for every field in non-matching aug_phenos.
+    // The old matrix is merged the same way, except that it can have variants that aren't in sites.tsv anymore (if a pheno was dropped).
+    //    Those variants are skipped, but the columns that we keep from it must be empty for them.
     while(1) {
         writer.write(sites_reader.line);
+        if (store) store->write_variant(sites_reader.line, chrom_order);
 
         size_t pos_after_cpra = pos_after_n_of_char(sites_reader.line, 4, '\t');
 
-        for (size_t i=0; i<N_phenos; i++) {
-            if (!aug_readers[i].eof() && 0 == sites_reader.line.compare(0, pos_after_cpra, aug_readers[i].line, 0, pos_after_cpra)) { // CPRAs match.
+        bool old_matrix_matches = false;
+        while (old_matrix_has_line) {
+            int cmp = compare_cpra(old_matrix_reader.line, sites_reader.line, chrom_order);
+            if (cmp > 0) break;
+            old_matrix_tabs = tab_positions(old_matrix_reader.line);
+            if (old_matrix_tabs.size() + 1 != n_old_matrix_fields) {
+                std::ostringstream errstream;
+                errstream << "[the old matrix has a line with a different number of tab-delimited fields than its header]";
+                errstream << "[bad line = " << old_matrix_reader.line.substr(0, 1000) << "]";
+                throw std::runtime_error(errstream.str().c_str());
+            }
+            if (cmp == 0) { old_matrix_matches = true; break; }
+            for (size_t g = 0; g < column_groups.size(); g++) {
+                if (column_groups[g].aug_idx >= 0) continue;
+                size_t end = (column_groups[g].old_end - 1 < old_matrix_tabs.size()) ? old_matrix_tabs[column_groups[g].old_end - 1] : old_matrix_reader.line.size();
+                if (end - old_matrix_tabs[column_groups[g].old_start - 1] != column_groups[g].old_end - column_groups[g].old_start) {
+                    std::ostringstream errstream;
+                    errstream << "[the old matrix has data for a variant that isn't in sites.tsv, for a phenotype that we're keeping]";
+                    errstream << "[bad line = " << old_matrix_reader.line.substr(0, 1000) << "]";
+                    throw std::runtime_error(errstream.str().c_str());
+                }
+            }
+            if (old_matrix_reader.eof()) { old_matrix_has_line = false; break; }
+            old_matrix_reader.next();
+            old_matrix_has_line = is_on_chroms(old_matrix_reader.line, chroms);
+        }
+
+        for (size_t g = 0; g < column_groups.size(); g++) {
+            if (column_groups[g].aug_idx < 0) {
+                if (old_matrix_matches) {
+                    write_old_matrix_fields(writer, old_matrix_reader.line, old_matrix_tabs, column_groups[g]);
+                    if (store) {
+                        size_t start = old_matrix_tabs[column_groups[g].old_start - 1];
+                        size_t end = (column_groups[g].old_end - 1 < old_matrix_tabs.size()) ? old_matrix_tabs[column_groups[g].old_end - 1] : old_matrix_reader.line.size();
+                        if (end - start != column_groups[g].old_end - column_groups[g].old_start) { // not just tabs
+                            store->write_record(g, column_group_first_field_idx[g], old_matrix_reader.line.c_str() + start, end - start);
+                        }
+                    }
+                } else {
+                    for (size_t j = column_groups[g].old_start; j < column_groups[g].old_end; j++) writer.write("\t");
+                }
+                continue;
+            }
+            size_t i = column_groups[g].aug_idx;
+            // Once a reader runs out, its `line` is empty, so it can't match.
+            if (aug_has_chroms[i] && 0 == sites_reader.line.compare(0, pos_after_cpra, aug_readers[i].line, 0, pos_after_cpra)) { // CPRAs match.
                 if (0 != aug_readers[i].line.compare(0, sites_reader.line.size(), sites_reader.line)) {
                     std::ostringstream errstream;
                     errstream << "[There's a variant in a pheno file that has different information from that same variant in sites.tsv.]";
@@ -489,6 +781,7 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
                     throw std::runtime_error(errstream.str().c_str());
                 }
                 writer.write(aug_readers[i].line.c_str() + sites_reader.line.size(), aug_readers[i].line.size() - sites_reader.line.size()); //write per-assoc fields
+                if (store) store->write_record(g, column_group_first_field_idx[g], aug_readers[i].line.c_str() + sites_reader.line.size(), aug_readers[i].line.size() - sites_reader.line.size());
                 aug_readers[i].next();
 
             } else { // CPRAs don't match
@@ -497,12 +790,23 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
             }
         }
         writer.write("\n");
+        if (store) store->end_variant();
+
+        if (old_matrix_matches) {
+            if (old_matrix_reader.eof()) old_matrix_has_line = false;
+            else {
+                old_matrix_reader.next();
+                old_matrix_has_line = is_on_chroms(old_matrix_reader.line, chroms);
+            }
+        }
 
         if (sites_reader.eof()) break;
         sites_reader.next();
+        if (!is_on_chroms(sites_reader.line, chroms)) break;
     }
 
-    writer.close();
+    writer.close(write_eof_block);
+    if (store) store->close();
 
     return 0;
 }
@@ -512,21 +816,84 @@ int make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, co
 // ------
 // entry points
 
-const char* make_matrix_and_return_string(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath) {
+static std::string error_message; // outlives the exception, so that python can read it
+
+const char* make_matrix_and_return_string(const char *sites_filepath,
+                                          int64_t sites_virtual_offset,
+                                          const std::vector<std::string>& aug_filepaths,
+                                          const std::vector<int64_t>& aug_virtual_offsets,
+                                          const std::string& old_matrix_filepath,
+                                          int64_t old_matrix_virtual_offset,
+                                          const std::vector<ColumnGroup>& column_groups,
+                                          const std::vector<std::string>& chroms,
+                                          const std::vector<std::string>& chrom_order,
+                                          bool write_header,
+                                          bool write_eof_block,
+                                          const char *matrix_filepath,
+                                          const std::string& store_prefix,
+                                          size_t store_num_columns,
+                                          const std::vector<int64_t>& store_column_for_field) {
   try {
-    make_matrix(sites_filepath, augmented_pheno_glob, matrix_filepath);
+    make_matrix(sites_filepath, sites_virtual_offset, aug_filepaths, aug_virtual_offsets, old_matrix_filepath, old_matrix_virtual_offset, column_groups,
+                chroms, chrom_order, write_header, write_eof_block, matrix_filepath, store_prefix, store_num_columns, store_column_for_field);
     return "ok";
   } catch (const std::exception &exc) {
-    return exc.what();
+    error_message = exc.what();
+    return error_message.c_str();
   } catch (...) {
     return "[something broke]";
   }
 }
 
+const char* make_matrix_and_return_string(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath) {
+  std::vector<std::string> aug_filepaths = glob(augmented_pheno_glob);
+  std::vector<int64_t> aug_virtual_offsets(aug_filepaths.size(), 0);
+  std::vector<ColumnGroup> column_groups;
+  for (size_t i = 0; i < aug_filepaths.size(); i++) column_groups.push_back(ColumnGroup{(int64_t)i, 0, 0});
+  std::vector<std::string> chroms; // empty means every chrom
+  return make_matrix_and_return_string(sites_filepath, 0, aug_filepaths, aug_virtual_offsets, "", -1, column_groups,
+                                       chroms, chroms, true, true, matrix_filepath, "", 0, std::vector<int64_t>());
+}
+
 extern "C" { // we need C because C++ mangles names supposedly
   extern const char* cffi_make_matrix(const char *sites_filepath, const char *augmented_pheno_glob, const char *matrix_filepath) {
     return make_matrix_and_return_string(sites_filepath, augmented_pheno_glob, matrix_filepath);
   }
+  extern const char* cffi_make_matrix_for_chroms(const char *sites_filepath,
+                                                 int64_t sites_virtual_offset,
+                                                 const char **augmented_pheno_filepaths,
+                                                 const int64_t *augmented_pheno_virtual_offsets,
+                                                 size_t num_phenos,
+                                                 const char *old_matrix_filepath,
+                                                 int64_t old_matrix_virtual_offset,
+                                                 const int64_t *column_group_aug_idxs,
+                                                 const int64_t *column_group_old_starts,
+                                                 const int64_t *column_group_old_ends,
+                                                 size_t num_column_groups,
+                                                 const char **chroms,
+                                                 size_t num_chroms,
+                                                 const char **chrom_order,
+                                                 size_t num_chrom_order,
+                                                 int write_header,
+                                                 int write_eof_block,
+                                                 const char *matrix_filepath,
+                                                 const char *store_prefix,
+                                                 size_t store_num_columns,
+                                                 const int64_t *store_column_for_field,
+                                                 size_t store_num_fields) {
+    std::vector<std::string> aug_filepaths(augmented_pheno_filepaths, augmented_pheno_filepaths + num_phenos);
+    std::vector<int64_t> aug_virtual_offsets(augmented_pheno_virtual_offsets, augmented_pheno_virtual_offsets + num_phenos);
+    std::vector<ColumnGroup> column_groups;
+    for (size_t g = 0; g < num_column_groups; g++) {
+      column_groups.push_back(ColumnGroup{column_group_aug_idxs[g], (size_t)column_group_old_starts[g], (size_t)column_group_old_ends[g]});
+    }
+    std::vector<std::string> chroms_vec(chroms, chroms + num_chroms);
+    std::vector<std::string> chrom_order_vec(chrom_order, chrom_order + num_chrom_order);
+    std::vector<int64_t> store_column_for_field_vec(store_column_for_field, store_column_for_field + store_num_fields);
+    return make_matrix_and_return_string(sites_filepath, sites_virtual_offset, aug_filepaths, aug_virtual_offsets, old_matrix_filepath, old_matrix_virtual_offset, column_groups,
+                                         chroms_vec, chrom_order_vec, write_header, write_eof_block, matrix_filepath,
+                                         store_prefix, store_num_columns, store_column_for_field_vec);
+  }
 }
 
 // for use when compiling directly (for debugging)
@@ -54,7 +54,7 @@ monitor_command = {
 def run(argv:List[str]) -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument('--engine', choices=['slurm', 'sge', 'uge'], required=True)
-    parser.add_argument('--step', choices=['parse', 'augment-phenos', 'manhattan', 'qq'], required=True)
+    parser.add_argument('--step', choices=['parse', 'augment-phenos', 'manhattan', 'qq', 'manhattan-qq'], required=True)
     parser.add_argument('--N_per_job', default=5)
     args = parser.parse_args(argv)
 
@@ -75,6 +75,10 @@ def run(argv:List[str]) -> None:
             from . import qq
             get_input_filepaths = qq.get_input_filepaths
             get_output_filepaths = qq.get_output_filepaths
+        elif args.step == "manhattan-qq":
+            from . import manhattan_qq
+            get_input_filepaths = manhattan_qq.get_input_filepaths
+            get_output_filepaths = manhattan_qq.get_output_filepaths
         else:
             raise Exception("No implementation for step {}".format(args.step))
         return PerPhenoParallelizer().should_process_pheno(
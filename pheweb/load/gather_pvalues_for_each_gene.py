@@ -7,8 +7,9 @@ This avoids reading any variant more than once.
 '''
 
 from ..utils import get_padded_gene_tuples
-from ..file_utils import MatrixReader, get_filepath, get_tmp_path
+from ..file_utils import get_matrix_reader, get_filepath, get_tmp_path
 from .load_utils import Parallelizer
+from .build_manifest import should_rebuild, record_build
 
 import sqlite3, json, traceback, functools
 from pathlib import Path
@@ -23,7 +24,8 @@ def run(argv:List[str]) -> None:
     # Check whether we're already up-to-date.
     out_filepath = Path(get_filepath('best-phenos-by-gene-sqlite3', must_exist=False))
     matrix_filepath = Path(get_filepath('matrix'))
-    if out_filepath.exists() and matrix_filepath.stat().st_mtime < out_filepath.stat().st_mtime:
+    if out_filepath.exists() and not should_rebuild('gather-pvalues-for-each-gene', [str(matrix_filepath)], [str(out_filepath)],
+                                                     by_mtime=matrix_filepath.stat().st_mtime >= out_filepath.stat().st_mtime):
         print('{} is up-to-date!'.format(str(out_filepath)))
         return
 
@@ -57,6 +59,7 @@ def run(argv:List[str]) -> None:
         db.execute('CREATE TABLE best_phenos_for_each_gene (gene TEXT PRIMARY KEY, json TEXT)')
         db.executemany('INSERT INTO best_phenos_for_each_gene (gene, json) VALUES (?,?)', ((k,json.dumps(v)) for k,v in data.items()))
     out_tmp_filepath.replace(out_filepath)
+    record_build('gather-pvalues-for-each-gene', [str(matrix_filepath)])
     print('Done making best-pheno-for-each-gene at {}'.format(str(out_filepath)))
 
 def get_regions_on_chrom() -> Dict[str,List[Tuple[int,int]]]:
@@ -85,7 +88,7 @@ def process_regions(taskq, retq, parent_overrides) -> None:
         retq.put({'type':'exception', 'task':None, 'exception_str':str(exc), 'exception_tb':traceback.format_exc()})
         raise
     tree_for_chrom = get_gene_intervaltree_for_chrom()
-    with MatrixReader().context() as matrix_reader:
+    with get_matrix_reader().context() as matrix_reader:
         f = functools.partial(get_region_info, matrix_reader, tree_for_chrom)
         Parallelizer._make_multiple_tasks_doer(f)(taskq, retq, parent_overrides)
 
@@ -1,10 +1,12 @@
 
-from ..utils import round_sig, get_phenolist, PheWebError, fmt_seconds
+from ..utils import round_sig, round_sig_array, get_phenolist, PheWebError, fmt_seconds
 from .. import conf
 from .. import parse_utils
-from ..file_utils import get_dated_tmp_path
+from ..file_utils import get_dated_tmp_path, get_filepath, write_json, file_lock
+from .build_manifest import BuildManifest
 
 import functools
+import json
 import traceback
 import time
 import os
@@ -13,9 +15,10 @@ import multiprocessing, queue
 import random
 import sys
 import heapq
+import numpy as np
 from pathlib import Path
 from types import GeneratorType
-from typing import List,Set,Dict,Optional,Any,Callable,Union
+from typing import List,Set,Dict,Optional,Any,Callable,Union,NamedTuple
 import re
 
 
@@ -45,6 +48,34 @@ def get_maf(variant:Dict[str,Any], pheno:Dict[str,Any]) -> Optional[float]:
         if not isinstance(maf_sigfigs, int): raise Exception()
         return round_sig(sum(mafs)/len(mafs), maf_sigfigs)
 
+def get_maf_array(columns:Dict[str,List[Any]], pheno:Dict[str,Any], is_checked:np.ndarray) -> Optional[np.ndarray]:
+    '''
+    Like `get_maf()` for each variant in `columns` (like `{'af': [0.1, 0.2], ...}`), but vectorized.
+    Only variants where `is_checked` is True are checked for agreement.
+    Where `get_maf()` would raise a helpful exception, this just raises an unhelpful one.
+    '''
+    mafs = []
+    if 'maf' in columns:
+        mafs.append(np.array(columns['maf'], dtype=np.float64))
+    if 'af' in columns:
+        af = np.array(columns['af'], dtype=np.float64)
+        mafs.append(np.minimum(af, 1-af))
+    if 'ac' in columns and 'num_samples' in pheno:
+        x = np.array(columns['ac'], dtype=np.float64) / 2 / pheno['num_samples']
+        mafs.append(np.minimum(x, 1-x))
+    if len(mafs) == 0: return None
+    elif len(mafs) == 1:
+        return mafs[0]
+    else:
+        if any(np.any(is_checked & (maf > 0.5)) for maf in mafs):
+            raise PheWebError("Error: some variants in pheno {} have at least one way of computing maf that is > 0.5".format(pheno['phenocode']))
+        if np.any(is_checked & (np.max(mafs, axis=0) - np.min(mafs, axis=0) > 0.05)):
+            raise PheWebError("Error: some variants in pheno {} have two ways of computing maf that differ by more than 0.05.".format(pheno['phenocode']))
+        maf_sum = mafs[0]
+        for maf in mafs[1:]: maf_sum = maf_sum + maf  # same order of additions as `sum()`
+        maf_sigfigs = parse_utils.fields['maf']['sigfigs']  # type:ignore
+        return round_sig_array(maf_sum / len(mafs), maf_sigfigs)
+
 
 def exception_printer(f):
     @functools.wraps(f)
@@ -130,22 +161,40 @@ class MaxPriorityQueue:
     `.popall()` iteratively `.pop()`s until empty.
     priorities must be comparable.
     `item` can be anything.
+    If `get_tiebreak` is given, items with equal priorities are ordered by `get_tiebreak(item)`, and the item with the largest one is popped first.
+    Otherwise, which of them is popped (or dropped by `.add_and_keep_size()`) first depends on the order they were added.
     '''
     class ComparesFalse: __eq__ = __lt__ = __gt__ = lambda s,o: False
-    def __init__(self):
-        self._q = [] # a heap-property-satisfying list like [(priority, ComparesFalse(), item), ...]
+    class ReversedTiebreak:
+        # In the heap, a larger tiebreak goes first, like a larger priority.  `__eq__` is `False` so that `item`s won't be compared.
+        __slots__ = ('key',)
+        def __init__(self, key): self.key = key
+        def __lt__(self, other): return self.key > other.key
+        def __gt__(self, other): return self.key < other.key
+        def __eq__(self, other): return False
+    def __init__(self, get_tiebreak:Optional[Callable] = None):
+        self._q: List[tuple] = [] # a heap-property-satisfying list like [(priority, ComparesFalse(), item), ...]
+        self._get_tiebreak = get_tiebreak
+    def _make_entry(self, item, priority) -> tuple:
+        if self._get_tiebreak is None: return (-priority, MaxPriorityQueue.ComparesFalse(), item)
+        return (-priority, MaxPriorityQueue.ReversedTiebreak(self._get_tiebreak(item)), item)
     def add(self, item, priority) -> None:
-        heapq.heappush(self._q, (-priority, MaxPriorityQueue.ComparesFalse(), item))
+        heapq.heappush(self._q, self._make_entry(item, priority))
     def add_and_keep_size(self, item, priority, size:int, popped_callback:Optional[Callable] = None) -> None:
         if len(self._q) < size:
             self.add(item, priority)
         else:
-            if -priority > self._q[0][0]: # if the new priority isn't as big as the biggest priority in the heap, switch them
-                _, _, item = heapq.heapreplace(self._q, (-priority, MaxPriorityQueue.ComparesFalse(), item))
+            top = self._q[0]
+            # if the new priority isn't as big as the biggest priority in the heap, switch them
+            if -priority > top[0] or (-priority == top[0] and self._get_tiebreak is not None and self._get_tiebreak(item) < top[1].key):
+                _, _, item = heapq.heapreplace(self._q, self._make_entry(item, priority))
             if popped_callback: popped_callback(item)
     def pop(self):
         _, _, item = heapq.heappop(self._q)
         return item
+    def peek_priority(self):
+        '''Returns the priority of the item that `.pop()` would return.'''
+        return -self._q[0][0]
     def __len__(self):
         return len(self._q)
     def pop_all(self):
@@ -153,7 +202,14 @@ class MaxPriorityQueue:
             yield self.pop()
 
 
+class _TaskBatch(list):
+    '''Several small tasks that a child process takes from the task queue at once.'''
+
 class Parallelizer:
+    # When tasks have costs, the small ones are batched, with each batch costing at most 1/BATCHES_PER_PROC of each process's share.
+    BATCHES_PER_PROC = 16
+    MAX_BATCH_SIZE = 32
+
     def run_multiple_tasks(self, tasks, do_multiple_tasks, cmd=None):
         '''
         Make a task queue and a return queue.
@@ -161,18 +217,23 @@ class Parallelizer:
         We manually pass `overrides` down to the child, because otherwise multiprocessing won't pickle it and pass it down.
         Watch for results, exceptions, and task-completion in retq.
         Yields things like: {type:"result", ...}
+        Afterwards, `self.task_seconds` is like `[(task, seconds), ...]`, and `self.stats` has how busy the processes were.
+        The stats are also saved for `cmd` in `parallelizer-stats.json`, to help choose `num_procs`.
         '''
         if not tasks: return
-        n_procs = min(conf.get_num_procs(cmd), len(tasks))
+        num_tasks = sum(len(task) if isinstance(task, _TaskBatch) else 1 for task in tasks)
+        n_procs = num_procs = min(conf.get_num_procs(cmd), len(tasks))
         taskq = multiprocessing.Queue()
         for task in tasks: taskq.put(task)
         for _ in range(n_procs): taskq.put({"exit":True})
         retq = multiprocessing.Queue()
+        self.task_seconds: List[Any] = []
+        start_time, first_exit_time = time.time(), None
         procs = [multiprocessing.Process(target=do_multiple_tasks, args=(taskq, retq, conf.overrides), daemon=True) for _ in range(n_procs)]
         for p in procs: p.start()
         with ProgressBar() as progressbar:
             n_tasks_complete = 0
-            self._update_progressbar(progressbar, n_tasks_complete, n_procs, len(tasks))
+            self._update_progressbar(progressbar, n_tasks_complete, n_procs, num_tasks)
             while True:
                 try:
                     ret = retq.get(block=True, timeout=10)
@@ -185,7 +246,8 @@ class Parallelizer:
                     yield ret
                 elif ret['type'] == 'task-completion':
                     n_tasks_complete += 1
-                    self._update_progressbar(progressbar, n_tasks_complete, n_procs, len(tasks))
+                    self.task_seconds.append((ret['task'], ret['seconds']))
+                    self._update_progressbar(progressbar, n_tasks_complete, n_procs, num_tasks)
                 elif ret['type'] == 'exception':
                     for p in procs:
                         if p.is_alive():
@@ -199,20 +261,64 @@ class Parallelizer:
                     raise PheWebError('Child process had exception, info dumped to {}'.format(exc_filepath))
                 elif ret['type'] == 'exit':
                     n_procs -= 1
-                    self._update_progressbar(progressbar, n_tasks_complete, n_procs, len(tasks))
+                    if first_exit_time is None: first_exit_time = time.time()
+                    self._update_progressbar(progressbar, n_tasks_complete, n_procs, num_tasks)
                     for p in procs: p.is_alive()  # This cleans up zombies
                     if n_procs == 0:
-                        self._update_progressbar(progressbar, n_tasks_complete, n_procs, len(tasks))
+                        self._update_progressbar(progressbar, n_tasks_complete, n_procs, num_tasks)
                         for p in procs:
                             p.join()
                             if p.exitcode != 0: raise PheWebError("A child process exited with status {}".format(p.exitcode))
-                        return
+                        break
                 else:
                     raise PheWebError("Unknown type of ret: {}".format(ret))
-    def run_single_tasks(self, tasks, do_single_task, cmd=None):
+        end_time = time.time()
+        self._set_stats(cmd, num_procs, end_time - start_time, end_time - first_exit_time)
+
+    def _set_stats(self, cmd:Optional[str], num_procs:int, wall_seconds:float, tail_seconds:float) -> None:
+        busy_seconds = sum(seconds for _, seconds in self.task_seconds)
+        self.stats = {
+            'num_procs': num_procs,
+            'num_tasks': len(self.task_seconds),
+            'wall_seconds': round(wall_seconds, 1),
+            'busy_seconds': round(busy_seconds, 1),
+            'utilization': round(min(1, busy_seconds / (num_procs * wall_seconds)), 3) if wall_seconds > 0 else 1,
+            'tail_seconds': round(tail_seconds, 1),  # from when the first process ran out of tasks until the last one finished
+            'longest_task_seconds': round(max(seconds for _, seconds in self.task_seconds), 1) if self.task_seconds else 0,
+        }
+        print('The {} processes were busy {:.0%} of the time.  For the last {}, some were idle.'.format(
+            num_procs, self.stats['utilization'], fmt_seconds(tail_seconds)))
+        if cmd is not None: _update_parallelizer_stats(cmd, last_run=self.stats)
+
+    def run_single_tasks(self, tasks, do_single_task, cmd=None, *, task_costs=None):
+        '''
+        Runs `do_single_task(task)` for each of `tasks` in child processes.
+        If `task_costs` (eg, input sizes or past runtimes) is given, the tasks are run longest-first and small ones are batched (see `_schedule()`).
+        '''
+        if task_costs is not None: tasks = self._schedule(tasks, task_costs, conf.get_num_procs(cmd))
         do_multiple_tasks = self._make_multiple_tasks_doer(do_single_task)
         for ret in self.run_multiple_tasks(tasks, do_multiple_tasks, cmd=cmd):
             yield ret
+    @classmethod
+    def _schedule(cls, tasks:List[Any], task_costs:List[float], num_procs:int) -> List[Any]:
+        '''
+        Orders `tasks` by decreasing cost, so that a big task doesn't start last and leave the other processes waiting for it.
+        Consecutive small tasks are grouped into `_TaskBatch`es, so that each child process takes them from the task queue at once.
+        '''
+        max_batch_cost = sum(task_costs) / (num_procs * cls.BATCHES_PER_PROC)
+        scheduled: List[Any] = []
+        batch, batch_cost = _TaskBatch(), 0.
+        for idx in sorted(range(len(tasks)), key=lambda idx: -task_costs[idx]):
+            if task_costs[idx] >= max_batch_cost:
+                scheduled.append(tasks[idx])
+                continue
+            if batch and (batch_cost + task_costs[idx] > max_batch_cost or len(batch) >= cls.MAX_BATCH_SIZE):
+                scheduled.append(batch if len(batch) > 1 else batch[0])
+                batch, batch_cost = _TaskBatch(), 0.
+            batch.append(tasks[idx])
+            batch_cost += task_costs[idx]
+        if batch: scheduled.append(batch if len(batch) > 1 else batch[0])
+        return scheduled
     def _update_progressbar(self, progressbar, n_tasks_complete, n_procs, num_tasks):
         if n_procs == 0 and num_tasks == n_tasks_complete:
             progressbar.set_message('Completed {:4} tasks in {}'.format(
@@ -233,33 +339,37 @@ class Parallelizer:
             retq.put({'type': 'exception', 'task': None, 'exception_str': err, 'exception_tb': err})
             raise Exception(err)
         conf.overrides.update(parent_overrides)
-        for task in iter(taskq.get, {'exit':True}):
-            try:
-                x = do_single_task(task)
-                for ret in (x if isinstance(x, GeneratorType) else [x]): # if it returns None (rather than a generator), assume it has no results
+        for tasks in iter(taskq.get, {'exit':True}):
+            for task in (tasks if isinstance(tasks, _TaskBatch) else [tasks]):
+                try:
+                    start_time = time.time()
+                    x = do_single_task(task)
+                    for ret in (x if isinstance(x, GeneratorType) else [x]): # if it returns None (rather than a generator), assume it has no results
+                        retq.put({
+                            "type": "result",
+                            "task": task,
+                            "value": ret,
+                        })
+                    retq.put({
+                        'type': 'task-completion',
+                        'task': task,
+                        'seconds': time.time() - start_time,
+                    })
+                except (Exception, KeyboardInterrupt) as exc:
                     retq.put({
-                        "type": "result",
+                        "type": "exception",
                         "task": task,
-                        "value": ret,
+                        "exception_str": str(exc),
+                        "exception_tb": traceback.format_exc(),
                     })
-                retq.put({
-                    'type': 'task-completion',
-                    'task': task,
-                })
-            except (Exception, KeyboardInterrupt) as exc:
-                retq.put({
-                    "type": "exception",
-                    "task": task,
-                    "exception_str": str(exc),
-                    "exception_tb": traceback.format_exc(),
-                })
-                return
+                    return
         retq.put({"type":"exit"})
 
 class PerPhenoParallelizer(Parallelizer):
     def run_on_each_pheno(self, get_input_filepaths, get_output_filepaths, convert, *, cmd=None, phenos=None):
         if phenos is None: phenos = get_phenolist()
-        tasks = [pheno for pheno in phenos if self.should_process_pheno(pheno, get_input_filepaths, get_output_filepaths)]
+        manifest = BuildManifest.load_if_enabled() if cmd is not None else None
+        tasks = self._get_phenos_to_process(phenos, get_input_filepaths, get_output_filepaths, cmd, manifest)
         if not tasks:
             print("Output files are all newer than input files, so there's nothing to do.")
             return {}
@@ -268,23 +378,159 @@ class PerPhenoParallelizer(Parallelizer):
         else:
             print("Processing {} phenos ({} already done)".format(len(tasks), len(phenos)-len(tasks)))
         pheno_results = {}
-        for ret in self.run_single_tasks(tasks, convert, cmd=cmd):
-            pc = ret['task']['phenocode']
-            v = ret['value']
-            if isinstance(v, dict) and v.get('type', '') == 'warning':
-                continue # TODO: self._progressbar.prepend_message(ret['message'])
-            assert pc not in pheno_results
-            pheno_results[pc] = v
+        task_costs = self._get_task_costs(tasks, get_input_filepaths, cmd)
+        input_digests = self._get_input_digests(manifest, tasks, get_input_filepaths)
+        self.task_seconds = []
+        try:
+            for ret in self.run_single_tasks(tasks, convert, cmd=cmd, task_costs=task_costs):
+                pc = ret['task']['phenocode']
+                v = ret['value']
+                if isinstance(v, dict) and v.get('type', '') == 'warning':
+                    continue # TODO: self._progressbar.prepend_message(ret['message'])
+                assert pc not in pheno_results
+                pheno_results[pc] = v
+        finally:
+            # Phenos that failed without raising (like in `parse-input-files`) aren't recorded as built.
+            failed_phenocodes = {pc for pc, v in pheno_results.items() if isinstance(v, dict) and v.get('succeeded') is False}
+            self._record_builds(manifest, cmd, input_digests, [pheno['phenocode'] for pheno, _ in self.task_seconds if pheno['phenocode'] not in failed_phenocodes])
+        self._save_task_seconds(cmd, [(pheno['phenocode'], seconds) for pheno, seconds in self.task_seconds])
         return pheno_results
-    def should_process_pheno(self, pheno, get_input_filepaths, get_output_filepaths):
-        input_filepaths = get_input_filepaths(pheno)
-        output_filepaths = get_output_filepaths(pheno)
-        if isinstance(input_filepaths, str): input_filepaths = [input_filepaths]
-        if isinstance(output_filepaths, str): output_filepaths = [output_filepaths]
+    def run_on_each_pheno_in_parts(self, get_input_filepaths, get_output_filepaths, convert, split, convert_part, merge_parts, *, cmd=None, phenos=None):
+        '''
+        Like `run_on_each_pheno()`, but when there are fewer phenos than processes, each pheno can be processed in parts by several processes.
+        `split(pheno, max_num_parts)` returns a list of parts (eg, groups of chroms).  If it returns only one part, `convert(pheno)` is used.
+        Otherwise, `convert_part(pheno, part)` runs in a child process for each part, and returns a (picklable) result.
+        When every part of a pheno is done, `merge_parts(pheno, results)` runs in this process, with the results in the order of the parts.
+        '''
+        if phenos is None: phenos = get_phenolist()
+        manifest = BuildManifest.load_if_enabled() if cmd is not None else None
+        phenos_to_process = self._get_phenos_to_process(phenos, get_input_filepaths, get_output_filepaths, cmd, manifest)
+        if not phenos_to_process:
+            print("Output files are all newer than input files, so there's nothing to do.")
+            return
+        max_num_parts = conf.get_num_procs(cmd) // len(phenos_to_process)
+        tasks = []
+        for pheno in phenos_to_process:
+            parts = split(pheno, max_num_parts) if max_num_parts > 1 else [None]
+            if len(parts) == 1:
+                tasks.append({'pheno': pheno})
+            else:
+                tasks.extend({'pheno': pheno, 'part': part, 'part_idx': part_idx, 'num_parts': len(parts)} for part_idx, part in enumerate(parts))
+        message = "Processing {} phenos".format(len(phenos_to_process))
+        if len(tasks) > len(phenos_to_process): message += " in {} parts".format(len(tasks))
+        if len(phenos) > len(phenos_to_process): message += " ({} already done)".format(len(phenos)-len(phenos_to_process))
+        print(message)
+        pheno_costs = dict(zip((pheno['phenocode'] for pheno in phenos_to_process), self._get_task_costs(phenos_to_process, get_input_filepaths, cmd)))
+        task_costs = [pheno_costs[task['pheno']['phenocode']] / task.get('num_parts', 1) for task in tasks]
+        input_digests = self._get_input_digests(manifest, phenos_to_process, get_input_filepaths)
+        part_results: Dict[str,Dict[int,Any]] = {}  # like {phenocode: {part_idx: result}}
+        do_task = functools.partial(_run_pheno_task, convert, convert_part)
+        self.task_seconds = []
+        try:
+            for ret in self.run_single_tasks(tasks, do_task, cmd=cmd, task_costs=task_costs):
+                task = ret['task']
+                if 'part' not in task: continue
+                results = part_results.setdefault(task['pheno']['phenocode'], {})
+                results[task['part_idx']] = ret['value']
+                if len(results) == task['num_parts']:
+                    merge_parts(task['pheno'], [results[part_idx] for part_idx in range(task['num_parts'])])
+                    del part_results[task['pheno']['phenocode']]
+            assert not part_results, list(part_results)
+        finally:
+            # A pheno is done once all of its parts are complete (and the last part's completion comes after its parts are merged).
+            num_parts_complete: Dict[str,int] = {}
+            for task, _ in self.task_seconds:
+                num_parts_complete[task['pheno']['phenocode']] = num_parts_complete.get(task['pheno']['phenocode'], 0) + 1
+            self._record_builds(manifest, cmd, input_digests, [task['pheno']['phenocode'] for task, _ in self.task_seconds
+                                                               if task.get('part_idx', 0) == 0 and num_parts_complete[task['pheno']['phenocode']] == task.get('num_parts', 1)])
+        self._save_task_seconds(cmd, [(task['pheno']['phenocode'], seconds) for task, seconds in self.task_seconds])
+    def _get_task_costs(self, phenos, get_input_filepaths, cmd) -> List[float]:
+        '''
+        Estimates how long each pheno will take, using its runtime from the last run of `cmd` if there is one, and its input size otherwise.
+        Phenos with both give the seconds per byte for the phenos without a past runtime.
+        '''
+        input_sizes: List[float] = []
+        for pheno in phenos:
+            input_sizes.append(sum(os.stat(fp).st_size for fp in _as_list(get_input_filepaths(pheno))))
+        past_seconds = _load_parallelizer_stats().get(cmd, {}).get('task_seconds', {}) if cmd is not None else {}
+        seconds_per_byte = sorted(past_seconds[pheno['phenocode']] / size for pheno, size in zip(phenos, input_sizes) if pheno['phenocode'] in past_seconds and size > 0)
+        if not seconds_per_byte: return input_sizes
+        median_seconds_per_byte = seconds_per_byte[len(seconds_per_byte) // 2]
+        return [past_seconds.get(pheno['phenocode'], size * median_seconds_per_byte) for pheno, size in zip(phenos, input_sizes)]
+    def _save_task_seconds(self, cmd, phenocode_seconds) -> None:
+        if cmd is None: return
+        seconds_for_phenocode: Dict[str,float] = {}
+        for phenocode, seconds in phenocode_seconds:  # the parts of a pheno are added together
+            seconds_for_phenocode[phenocode] = seconds_for_phenocode.get(phenocode, 0) + seconds
+        _update_parallelizer_stats(cmd, task_seconds={phenocode: round(seconds, 2) for phenocode, seconds in seconds_for_phenocode.items()})
+    def _get_phenos_to_process(self, phenos, get_input_filepaths, get_output_filepaths, cmd, manifest) -> List[Dict[str,Any]]:
+        if manifest is not None:
+            # Hash the recorded phenos' inputs in parallel, rather than one at a time in `should_process_pheno()`.
+            recorded_phenos = [pheno for pheno in phenos if manifest.has_record('{}/{}'.format(cmd, pheno['phenocode']))]
+            self._get_input_digests(manifest, [pheno for pheno in recorded_phenos if all(map(os.path.exists, _as_list(get_input_filepaths(pheno))))], get_input_filepaths)
+        phenos_to_process = [pheno for pheno in phenos if self.should_process_pheno(pheno, get_input_filepaths, get_output_filepaths, cmd=cmd, manifest=manifest)]
+        if manifest is not None:
+            # Phenos that are up-to-date by mtime but haven't been recorded yet are recorded as they are now.
+            phenocodes_to_process = set(pheno['phenocode'] for pheno in phenos_to_process)
+            unrecorded_phenos = [pheno for pheno in phenos if pheno['phenocode'] not in phenocodes_to_process and not manifest.has_record('{}/{}'.format(cmd, pheno['phenocode']))]
+            self._record_builds(manifest, cmd, self._get_input_digests(manifest, unrecorded_phenos, get_input_filepaths), [pheno['phenocode'] for pheno in unrecorded_phenos])
+        return phenos_to_process
+    def _get_input_digests(self, manifest, phenos, get_input_filepaths) -> Dict[str,List[str]]:
+        if manifest is None: return {}
+        input_filepaths = [_as_list(get_input_filepaths(pheno)) for pheno in phenos]
+        digests = manifest.get_digests([fp for fps in input_filepaths for fp in fps])
+        input_digests = {}
+        for pheno, fps in zip(phenos, input_filepaths):
+            input_digests[pheno['phenocode']], digests = digests[:len(fps)], digests[len(fps):]
+        return input_digests
+    def _record_builds(self, manifest, cmd, input_digests, phenocodes) -> None:
+        if manifest is None: return
+        for phenocode in phenocodes:
+            manifest.record('{}/{}'.format(cmd, phenocode), cmd, input_digests[phenocode])
+        manifest.save()
+    def should_process_pheno(self, pheno, get_input_filepaths, get_output_filepaths, *, cmd=None, manifest=None):
+        '''
+        Returns whether any output of `pheno` is missing or older than an input.
+        If `manifest` has a record of building `pheno` for `cmd`, whether the inputs' contents or the config changed is used instead of mtimes.
+        '''
+        input_filepaths = _as_list(get_input_filepaths(pheno))
+        output_filepaths = _as_list(get_output_filepaths(pheno))
         for fp in input_filepaths:
             if not os.path.exists(fp):
                 raise PheWebError("Cannot make {} because {} does not exist".format(' or '.join(output_filepaths), fp))
-        return any(not os.path.exists(fp) for fp in output_filepaths) or max(map(mtime, input_filepaths)) > min(map(mtime, output_filepaths))
+        if any(not os.path.exists(fp) for fp in output_filepaths): return True
+        key = '{}/{}'.format(cmd, pheno['phenocode'])
+        if manifest is not None and manifest.has_record(key):
+            return not manifest.is_up_to_date(key, cmd, input_filepaths, output_filepaths)
+        return max(map(mtime, input_filepaths)) > min(map(mtime, output_filepaths))
+class PhenoStage(NamedTuple):
+    '''The per-pheno work of a step, so that `pheweb process` can do each pheno as soon as its inputs are ready.'''
+    cmd: str
+    get_input_filepaths: Callable[[Dict[str,Any]],List[str]]
+    get_output_filepaths: Callable[[Dict[str,Any]],List[str]]
+    convert: Callable[[Dict[str,Any]],Any]
+
+def _load_parallelizer_stats() -> Dict[str,Any]:
+    try:
+        with open(get_filepath('parallelizer-stats', must_exist=False)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+def _update_parallelizer_stats(cmd:str, *, last_run:Optional[Dict[str,Any]] = None, task_seconds:Optional[Dict[str,float]] = None) -> None:
+    '''Records `last_run` (replacing the old one) and `task_seconds` (updating the old ones) for `cmd`.'''
+    filepath = get_filepath('parallelizer-stats', must_exist=False)
+    with file_lock(filepath):  # `pheweb process` can run several steps at once
+        stats = _load_parallelizer_stats()
+        cmd_stats = stats.setdefault(cmd, {})
+        if last_run is not None: cmd_stats['last_run'] = last_run
+        if task_seconds is not None: cmd_stats.setdefault('task_seconds', {}).update(task_seconds)
+        write_json(filepath=filepath, data=stats, indent=1)
+
+def _as_list(filepaths:Union[str,List[str]]) -> List[str]:
+    return [filepaths] if isinstance(filepaths, str) else filepaths
+def _run_pheno_task(convert, convert_part, task):
+    if 'part' not in task: return convert(task['pheno'])
+    return convert_part(task['pheno'], task['part'])
 def parallelize_per_pheno(get_input_filepaths, get_output_filepaths, convert, *, cmd=None, phenos=None):
     return PerPhenoParallelizer().run_on_each_pheno(get_input_filepaths, get_output_filepaths, convert, cmd=cmd, phenos=phenos)
 
@@ -1,5 +1,6 @@
 
 from ..file_utils import VariantFileReader, get_filepath, get_tmp_path
+from .build_manifest import should_rebuild, record_build
 
 import sqlite3
 from pathlib import Path
@@ -15,7 +16,8 @@ def run(argv:List[str]) -> None:
     sites_filepath = Path(get_filepath('sites'))
     cpras_rsids_filepath = Path(get_filepath('cpras-rsids-sqlite3', must_exist=False))
 
-    if cpras_rsids_filepath.exists() and cpras_rsids_filepath.stat().st_mtime >= sites_filepath.stat().st_mtime:
+    if cpras_rsids_filepath.exists() and not should_rebuild('cpras-rsids-sqlite3', [str(sites_filepath)], [str(cpras_rsids_filepath)],
+                                                            by_mtime=cpras_rsids_filepath.stat().st_mtime < sites_filepath.stat().st_mtime):
         print('cpras-rsids-sqlite3 is up-to-date!')
 
     else:
@@ -39,4 +41,5 @@ def run(argv:List[str]) -> None:
             db_conn.execute('CREATE INDEX rsid_idx ON cpras_rsids (rsid)')
 
         cpras_rsids_tmp_filepath.rename(cpras_rsids_filepath)
+        record_build('cpras-rsids-sqlite3', [str(sites_filepath)])
         print('Done making cpras-rsids sqlite3 at {}'.format(str(cpras_rsids_filepath)))
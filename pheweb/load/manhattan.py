@@ -8,20 +8,25 @@ This script creates json files which can be used to render Manhattan plots.
 # TODO: optimize binning for fold@20 view.
 #       - if we knew the max_qval before we started (eg, by running qq first), it would be very easy.
 #       - at present, we set qval bin size well for the [0-40] range but not for variants above that.
-# TODO: combine with QQ?
+# Note: `pheweb manhattan-qq` makes these json files in the same pass over each pheno_gz file as the QQ json files.
 
 # TODO: keep 10 variants unbinned from each chrom
 
-from ..utils import chrom_order
+from ..utils import chrom_order, chrom_order_list
 from .. import conf
 from ..file_utils import VariantFileReader, write_json, get_pheno_filepath
 from .load_utils import MaxPriorityQueue, parallelize_per_pheno, get_phenos_subset, get_phenolist
 
 import math, argparse
-from typing import List,Dict,Any,Tuple
+import numpy as np
+from typing import List,Dict,Any,Tuple,Callable,Optional
 Variant = Dict[str,Any]
 
 BIN_LENGTH = int(3e6)
+# Qvals are put in bins rounded to this, the smallest `_qval_bin_size`, and `get_result()` rounds them to the final `_qval_bin_size`.
+# Every `_qval_bin_size` is a multiple of it, so the result doesn't depend on when each variant was binned.
+MIN_QVAL_BIN_SIZE = 0.05
+CHUNK_SIZE = 2**14  # number of variants to give to `VectorizedBinner` at a time
 
 
 def run(argv:List[str]) -> None:
@@ -47,24 +52,31 @@ def make_manhattan_json_file(pheno:Dict[str,Any]) -> None:
     make_manhattan_json_file_explicit(get_pheno_filepath('pheno_gz', pheno['phenocode']),
                                       get_pheno_filepath('manhattan', pheno['phenocode'], must_exist=False))
 def make_manhattan_json_file_explicit(in_filepath:str, out_filepath:str) -> None:
-    binner = Binner()
+    binner = VectorizedBinner()
     with VariantFileReader(in_filepath) as variants:
+        chunk: List[Variant] = []
         for variant in variants:
-            binner.process_variant(variant)
+            chunk.append(variant)
+            if len(chunk) >= CHUNK_SIZE:
+                binner.process_variants(chunk)
+                chunk = []
+        binner.process_variants(chunk)
     data = binner.get_result()
     write_json(filepath=out_filepath, data=data)
 
 
 class Binner:
-    def __init__(self):
-        self._peak_best_variant = None
-        self._peak_last_chrpos = None
-        self._peak_pq = MaxPriorityQueue()
-        self._unbinned_variant_pq = MaxPriorityQueue()
-        self._bins = {} # like {<chrom>: {<pos // bin_length>: [{chrom, startpos, qvals}]}}
-        self._qval_bin_size = 0.05 # this makes 200 bins for the minimum-allowed y-axis covering 0-10
+    def __init__(self, config:Optional[conf.LoadingConfig] = None):
+        self._config = config or conf.get_loading_config()
+        self._peak_best_variant: Optional[Variant] = None
+        self._peak_last_chrpos: Any = None  # like (chrom, pos), once `_peak_best_variant` is set
+        # Variants with equal pvals are ordered by position, so that which of them are kept doesn't depend on the order they're seen.
+        self._peak_pq = MaxPriorityQueue(get_tiebreak=get_variant_order)
+        self._unbinned_variant_pq = MaxPriorityQueue(get_tiebreak=get_variant_order)
+        self._bins: Dict[int,Dict[int,Dict[str,Any]]] = {} # like {<chrom>: {<pos // bin_length>: [{chrom, startpos, qvals}]}}
+        self._qval_bin_size = MIN_QVAL_BIN_SIZE # this makes 200 bins for the minimum-allowed y-axis covering 0-10
         self._num_significant_in_current_peak = 0  # num variants stronger than manhattan_peak_variant_counting_pval_threshold
-        assert conf.get_manhattan_peak_variant_counting_pval_threshold() < conf.get_manhattan_peak_pval_threshold() # counting must be stricter than peak-extending
+        assert self._config.manhattan_peak_variant_counting_pval_threshold < self._config.manhattan_peak_pval_threshold # counting must be stricter than peak-extending
 
     def process_variant(self, variant:Variant) -> None:
         '''
@@ -74,8 +86,8 @@ class Binner:
              2) make the current variant the new `peak_best_variant`.
           b) If the variant ends a peak, push `peak_best_variant` into `peak_pq` and push the current variant into `unbinned_variant_pq`.
           c) Otherwise, just push the variant into `unbinned_variant_pq`.
-        Whenever `peak_pq` exceeds the size `conf.get_manhattan_peak_max_count()`, push its member with the weakest pval into `unbinned_variant_pq`.
-        Whenever `unbinned_variant_pq` exceeds the size `conf.get_manhattan_num_unbinned()`, bin its member with the weakest pval.
+        Whenever `peak_pq` exceeds the size `manhattan_peak_max_count`, push its member with the weakest pval into `unbinned_variant_pq`.
+        Whenever `unbinned_variant_pq` exceeds the size `manhattan_num_unbinned`, bin its member with the weakest pval.
         So, at the end, we'll have `peak_pq`, `unbinned_variant_pq`, and `bins`.
         '''
 
@@ -86,13 +98,13 @@ class Binner:
             elif qval > 20:
                 self._qval_bin_size = 0.1 # this makes 200-400 bins for a y-axis extending up to 20-40.
 
-        if variant['pval'] < conf.get_manhattan_peak_pval_threshold(): # part of a peak
+        if variant['pval'] < self._config.manhattan_peak_pval_threshold: # part of a peak
             if self._peak_best_variant is None: # open a new peak
                 self._peak_best_variant = variant
                 self._peak_last_chrpos = (variant['chrom'], variant['pos'])
-                self._num_significant_in_current_peak = 1 if variant['pval'] < conf.get_manhattan_peak_variant_counting_pval_threshold() else 0
-            elif self._peak_last_chrpos[0] == variant['chrom'] and self._peak_last_chrpos[1] + conf.get_manhattan_peak_sprawl_dist() > variant['pos']: # extend current peak
-                if variant['pval'] < conf.get_manhattan_peak_variant_counting_pval_threshold(): self._num_significant_in_current_peak += 1
+                self._num_significant_in_current_peak = 1 if variant['pval'] < self._config.manhattan_peak_variant_counting_pval_threshold else 0
+            elif self._peak_last_chrpos[0] == variant['chrom'] and self._peak_last_chrpos[1] + self._config.manhattan_peak_sprawl_dist > variant['pos']: # extend current peak
+                if variant['pval'] < self._config.manhattan_peak_variant_counting_pval_threshold: self._num_significant_in_current_peak += 1
                 self._peak_last_chrpos = (variant['chrom'], variant['pos'])
                 if variant['pval'] >= self._peak_best_variant['pval']:
                     self._maybe_bin_variant(variant)
@@ -101,7 +113,7 @@ class Binner:
                     self._peak_best_variant = variant
             else: # close old peak and open new peak
                 self._peak_best_variant['num_significant_in_peak'] = self._num_significant_in_current_peak
-                self._num_significant_in_current_peak = 1 if variant['pval'] < conf.get_manhattan_peak_variant_counting_pval_threshold() else 0
+                self._num_significant_in_current_peak = 1 if variant['pval'] < self._config.manhattan_peak_variant_counting_pval_threshold else 0
                 self._maybe_peak_variant(self._peak_best_variant)
                 self._peak_best_variant = variant
                 self._peak_last_chrpos = (variant['chrom'], variant['pos'])
@@ -110,11 +122,11 @@ class Binner:
 
     def _maybe_peak_variant(self, variant:Variant) -> None:
         self._peak_pq.add_and_keep_size(variant, variant['pval'],
-                                        size=conf.get_manhattan_peak_max_count(),
+                                        size=self._config.manhattan_peak_max_count,
                                         popped_callback=self._maybe_bin_variant)
     def _maybe_bin_variant(self, variant:Variant) -> None:
         self._unbinned_variant_pq.add_and_keep_size(variant, variant['pval'],
-                                                    size=conf.get_manhattan_num_unbinned(),
+                                                    size=self._config.manhattan_num_unbinned,
                                                     popped_callback=self._bin_variant)
     def _bin_variant(self, variant:Variant) -> None:
         chrom_idx = chrom_order[variant['chrom']]
@@ -122,9 +134,36 @@ class Binner:
         pos_bin_id = variant['pos'] // BIN_LENGTH
         if pos_bin_id not in self._bins[chrom_idx]:
             self._bins[chrom_idx][pos_bin_id] = {'chrom': variant['chrom'], 'startpos': pos_bin_id * BIN_LENGTH, 'qvals': set()}
-        qval = self._rounded(324) if variant['pval'] == 0 else self._rounded(-math.log10(variant['pval']))
+        qval = _round_qval(324 if variant['pval'] == 0 else -math.log10(variant['pval']), MIN_QVAL_BIN_SIZE)
         self._bins[chrom_idx][pos_bin_id]["qvals"].add(qval)
 
+    def merge(self, other:'Binner') -> None:
+        '''
+        Adds the variants that `other` processed, as if this had processed them after its own variants.
+        `other` must only have processed chroms after the ones this has processed (so that no peak is split between them).
+        The result is the same as one `Binner` processing every variant, because ties between pvals are broken by position
+        and the qvals in bins are rounded to `MIN_QVAL_BIN_SIZE` until `get_result()`.
+        '''
+        if other._peak_best_variant is not None:
+            # The first peak variant of `other` closes our open peak, and `other`'s open peak becomes ours.
+            if self._peak_best_variant is not None:
+                self._peak_best_variant['num_significant_in_peak'] = self._num_significant_in_current_peak
+                self._maybe_peak_variant(self._peak_best_variant)
+            self._peak_best_variant = other._peak_best_variant
+            self._peak_last_chrpos = other._peak_last_chrpos
+            self._num_significant_in_current_peak = other._num_significant_in_current_peak
+        if other._qval_bin_size != MIN_QVAL_BIN_SIZE: self._qval_bin_size = other._qval_bin_size  # `other` saw a qval > 20, which sets it
+        for variant in other._peak_pq.pop_all():
+            self._maybe_peak_variant(variant)
+        for variant in other._unbinned_variant_pq.pop_all():
+            self._maybe_bin_variant(variant)
+        for chrom_idx, bins in other._bins.items():
+            for pos_bin_id, b in bins.items():
+                if pos_bin_id in self._bins.get(chrom_idx, {}):
+                    self._bins[chrom_idx][pos_bin_id]['qvals'].update(b['qvals'])
+                else:
+                    self._bins.setdefault(chrom_idx, {})[pos_bin_id] = b
+
     def get_result(self) -> Dict[str,List[Variant]]:
         # this can only be called once
         if getattr(self, 'already_got_result', None): raise Exception()
@@ -156,9 +195,7 @@ class Binner:
         }
 
     def _rounded(self, qval:float) -> float:
-        # round down to the nearest multiple of `self._qval_bin_size`, then add 1/2 of `self._qval_bin_size` to be in the middle of the bin
-        x = qval // self._qval_bin_size * self._qval_bin_size + self._qval_bin_size / 2
-        return round(x, 3) # trim `0.35000000000000003` to `0.35` for convenience and network request size
+        return _round_qval(qval, self._qval_bin_size)
 
     def _get_qvals_and_qval_extents(self, qvals:List[float]) -> Tuple[List[float],List[Tuple[float,float]]]:
         qvals = sorted(self._rounded(qval) for qval in qvals)
@@ -175,3 +212,69 @@ class Binner:
             else:
                 rv_qval_extents.append((start,end))
         return (rv_qvals, rv_qval_extents)
+
+
+def get_variant_order(variant:Variant) -> Tuple[int,int,str,str]:
+    '''The order of variants in a pheno_gz file.'''
+    return (chrom_order[variant['chrom']], variant['pos'], variant['ref'], variant['alt'])
+
+def _round_qval(qval:float, qval_bin_size:float) -> float:
+    # round down to the nearest multiple of `qval_bin_size`, then add 1/2 of `qval_bin_size` to be in the middle of the bin
+    x = qval // qval_bin_size * qval_bin_size + qval_bin_size / 2
+    return round(x, 3) # trim `0.35000000000000003` to `0.35` for convenience and network request size
+
+
+class VectorizedBinner(Binner):
+    '''
+    Makes exactly the same result as `Binner`, but takes variants a chunk at a time and handles most of them with numpy.
+
+    `Binner.process_variant()` only does something interesting with a variant if it:
+      - is part of a peak (ie, `pval < manhattan_peak_pval_threshold`),
+      - changes `_qval_bin_size` (ie, `qval > 20`),
+      - or would enter `_unbinned_variant_pq` (ie, `pval` is stronger than the weakest in it, once it's full).
+    Otherwise, it just bins the variant.  Those thresholds only get stricter, so in each chunk, the few variants that
+    might be interesting are given to `Binner.process_variant()` in order, and the rest are binned all at once.
+    (A variant whose pval ties the weakest in `_unbinned_variant_pq` isn't interesting, because it comes after it in position.)
+    `Binner` is still the reference implementation.
+    '''
+    def process_variants(self, variants:List[Variant]) -> None:
+        '''Like calling `process_variant()` on each of `variants`, in order.'''
+        if not variants: return
+        self.process_arrays(chrom_idxs = np.fromiter((chrom_order[v['chrom']] for v in variants), dtype=np.int64, count=len(variants)),
+                            positions = np.fromiter((v['pos'] for v in variants), dtype=np.int64, count=len(variants)),
+                            pvals = np.fromiter((v['pval'] for v in variants), dtype=np.float64, count=len(variants)),
+                            get_variant = variants.__getitem__)
+
+    def process_arrays(self, chrom_idxs:np.ndarray, positions:np.ndarray, pvals:np.ndarray, get_variant:Callable[[int],Variant]) -> None:
+        '''
+        Like `process_variants()`, for the variants with the columns `chrom_idxs`, `positions` and `pvals`.
+        `get_variant(i)` must return the variant at index `i`, which is only called for the few variants that might end up unbinned.
+        '''
+        if len(self._unbinned_variant_pq) < self._config.manhattan_num_unbinned: weakest_unbinned_pval = math.inf
+        else: weakest_unbinned_pval = self._unbinned_variant_pq.peek_priority()
+        # `1e-19` is a little looser than `qval > 20`, to be safe from rounding.
+        is_interesting = (pvals < weakest_unbinned_pval) | (pvals < self._config.manhattan_peak_pval_threshold) | (pvals < 1e-19)
+        interesting_idxs = np.flatnonzero(is_interesting)
+
+        for idx in interesting_idxs.tolist():
+            self.process_variant(get_variant(idx))
+        boring_idxs = np.flatnonzero(~is_interesting)
+        if len(boring_idxs) == 0: return
+
+        # pvals only have a few significant figures, so there are few distinct pvals.  Each is rounded like `Binner._bin_variant()`.
+        distinct_pvals, pval_codes = np.unique(pvals[boring_idxs], return_inverse=True)
+        rounded_qvals, rounded_qval_idxs = np.unique(
+            [_round_qval(324 if pval == 0 else -math.log10(pval), MIN_QVAL_BIN_SIZE) for pval in distinct_pvals.tolist()],
+            return_inverse=True)
+        rounded_qvals = rounded_qvals.tolist()
+
+        # Each occupied (chrom, pos_bin, rounded_qval) is packed into one int, so that `np.unique()` can find them.
+        num_pos_bins = int(positions.max()) // BIN_LENGTH + 1
+        packed = (chrom_idxs[boring_idxs] * num_pos_bins + positions[boring_idxs] // BIN_LENGTH) * len(rounded_qvals) + rounded_qval_idxs[pval_codes]
+        for key in np.unique(packed).tolist():
+            chrom_and_pos_bin, rounded_qval_idx = divmod(key, len(rounded_qvals))
+            chrom_idx, pos_bin_id = divmod(chrom_and_pos_bin, num_pos_bins)
+            if chrom_idx not in self._bins: self._bins[chrom_idx] = {}
+            if pos_bin_id not in self._bins[chrom_idx]:
+                self._bins[chrom_idx][pos_bin_id] = {'chrom': chrom_order_list[chrom_idx], 'startpos': pos_bin_id * BIN_LENGTH, 'qvals': set()}
+            self._bins[chrom_idx][pos_bin_id]['qvals'].add(rounded_qvals[rounded_qval_idx])
@@ -0,0 +1,202 @@
+'''
+This script makes the manhattan and QQ json files for each phenotype in a single pass over its pheno_gz file
+(or its pheno_bin file, if `binary_variant_files` is set), instead of the separate passes of `pheweb manhattan` and `pheweb qq`.
+A pheno_bin file is read a block of columns at a time, and only the few variants that might be shown individually
+(in the manhattan plot or the best-of-pheno files) are made into dicts.
+If `show_manhattan_filter_button` is set, the same pass also makes the best-of-pheno files (like `pheweb best-of-pheno`).
+Every output is computed before any is written, so if anything fails, none of the outputs of that phenotype are replaced.
+
+When there are fewer phenotypes than processes, a large pheno_gz file is split into groups of chromosomes (using its tabix index),
+each group is read by a separate process, and their results are merged in chromosome order.
+Each group's QQ data is its qvals (and mafs), which are concatenated in chromosome order, or its `qq.QQSketch` if `approximate_qq` is set.
+'''
+
+from .. import conf
+from ..file_utils import VariantFileReader, BinaryVariantFileReader, VariantFileWriter, write_json, get_pheno_filepath
+from ..utils import PheWebError
+from .load_utils import MaxPriorityQueue, get_maf, get_maf_array, PerPhenoParallelizer, PhenoStage, get_phenos_subset, get_phenolist
+from .manhattan import VectorizedBinner, get_variant_order, CHUNK_SIZE as BINNER_CHUNK_SIZE
+from .sites import split_file_into_chrom_groups
+from . import qq
+from . import best_of_pheno
+
+import argparse
+import array
+import math
+import numpy as np
+from typing import List,Dict,Any,Optional
+
+
+# A pheno_gz file is only split into parts with at least this many (compressed) bytes, because each part has some overhead.
+MIN_BYTES_PER_PART = 8 * 2**20
+
+
+def run(argv:List[str]) -> None:
+    parser = argparse.ArgumentParser(description="Make the manhattan and QQ plots (and best-of-pheno files, if they're used) for each phenotype.")
+    parser.add_argument('--phenos', help="Can be like '4,5,6,12' or '4-6,12' to run on only the phenos at those positions (0-indexed) in pheno-list.json (and only if they need to run)")
+    args = parser.parse_args(argv)
+
+    phenos = get_phenos_subset(args.phenos) if args.phenos else get_phenolist()
+
+    PerPhenoParallelizer().run_on_each_pheno_in_parts(
+        get_input_filepaths = get_input_filepaths,
+        get_output_filepaths = get_output_filepaths,
+        convert = make_json_files,
+        split = split_pheno,
+        convert_part = make_pheno_part,
+        merge_parts = merge_pheno_parts,
+        cmd = pheno_stage.cmd,
+        phenos = phenos,
+    )
+
+def get_input_filepaths(pheno:dict) -> List[str]: return [get_pheno_filepath(qq._get_input_kind(), pheno['phenocode'])]
+def get_output_filepaths(pheno:dict) -> List[str]:
+    filepaths = [get_pheno_filepath('manhattan', pheno['phenocode'], must_exist=False),
+                 get_pheno_filepath('qq', pheno['phenocode'], must_exist=False)]
+    if conf.should_show_manhattan_filter_button():
+        filepaths.extend(best_of_pheno.get_output_filepaths(pheno))
+    return filepaths
+
+
+def make_json_files(pheno:Dict[str,Any]) -> None:
+    summary = _PhenoSummary(pheno)
+    summary.read(get_input_filepaths(pheno)[0])
+    summary.write()
+
+pheno_stage = PhenoStage('manhattan_qq', get_input_filepaths, get_output_filepaths, make_json_files)
+
+def split_pheno(pheno:Dict[str,Any], max_num_parts:int) -> List[Optional[List[str]]]:
+    '''Splits the pheno_gz file of `pheno` into groups of chroms, or returns `[None]` if it can't be split (see `split_file_into_chrom_groups()`).'''
+    if conf.should_write_binary_variant_files(): return [None]
+    return split_file_into_chrom_groups(get_input_filepaths(pheno)[0], max_num_parts, MIN_BYTES_PER_PART)
+
+def make_pheno_part(pheno:Dict[str,Any], chroms:List[str]) -> '_PhenoSummary':
+    summary = _PhenoSummary(pheno)
+    summary.read(get_input_filepaths(pheno)[0], chroms=chroms)
+    return summary
+
+def merge_pheno_parts(pheno:Dict[str,Any], summaries:List['_PhenoSummary']) -> None:
+    for summary in summaries[1:]:
+        summaries[0].merge(summary)
+    summaries[0].write()
+
+
+class _PhenoSummary:
+    '''
+    The manhattan, QQ and best-of-pheno data of a phenotype's variants (or of the variants on some of its chroms).
+    A summary of a following group of chroms can be merged into it, which gives the same result as reading all of those chroms at once
+    (see `Binner.merge()`).
+    '''
+    def __init__(self, pheno:Dict[str,Any]):
+        self.pheno = pheno
+        self.should_make_best_of_pheno = conf.should_show_manhattan_filter_button()
+        self.binner = VectorizedBinner()
+        self.best_of_pheno_q = MaxPriorityQueue(get_tiebreak=get_variant_order)
+        # Like `qq.get_variants_df()`, these are kept in compact arrays rather than lists of python floats.
+        # With `approximate_qq`, they're moved into `qq_sketch` every `qq.QQ_CHUNK_SIZE` variants.
+        self.mafs, self.qvals = array.array('f'), array.array('f')
+        self.has_maf: Optional[bool] = None  # None until a variant is read
+        self.qq_sketch: Optional[qq.QQSketch] = None
+        self.fields: Optional[List[str]] = None
+
+    def read(self, in_filepath:str, chroms:Optional[List[str]] = None) -> None:
+        if conf.should_write_binary_variant_files():
+            assert chroms is None
+            self._read_binary(in_filepath)
+            return
+        binner = self.binner
+        binner_chunk: List[Dict[str,Any]] = []
+        best_of_pheno_q = self.best_of_pheno_q
+        should_make_best_of_pheno = self.should_make_best_of_pheno
+        mafs, qvals, has_maf, qq_sketch = self.mafs, self.qvals, self.has_maf, self.qq_sketch
+        with VariantFileReader(in_filepath, chroms=chroms) as vfr:
+            self.fields = vfr.fields
+            for v in vfr:
+                binner_chunk.append(v)
+                if len(binner_chunk) >= BINNER_CHUNK_SIZE:
+                    binner.process_variants(binner_chunk)
+                    binner_chunk = []
+                if should_make_best_of_pheno:
+                    best_of_pheno_q.add_and_keep_size(v, v['pval'], best_of_pheno.NUM_VARIANTS)
+                maf = get_maf(v, self.pheno)
+                if has_maf is None:
+                    has_maf = maf is not None
+                    if conf.should_approximate_qq(): qq_sketch = qq.QQSketch(has_maf)
+                if has_maf: mafs.append(maf or 0)
+                qvals.append(1000 if v['pval']==0 else -math.log10(v['pval']))
+                if qq_sketch is not None and len(qvals) >= qq.QQ_CHUNK_SIZE:
+                    qq_sketch.add(np.frombuffer(qvals, dtype=np.float32), np.frombuffer(mafs, dtype=np.float32) if has_maf else None)
+                    mafs, qvals = array.array('f'), array.array('f')
+        binner.process_variants(binner_chunk)
+        if qq_sketch is not None:
+            qq_sketch.add(np.frombuffer(qvals, dtype=np.float32), np.frombuffer(mafs, dtype=np.float32) if has_maf else None)
+            mafs, qvals = array.array('f'), array.array('f')
+        self.mafs, self.qvals, self.has_maf, self.qq_sketch = mafs, qvals, has_maf, qq_sketch
+
+    def _read_binary(self, in_filepath:str) -> None:
+        # Like `read()`, but with whole columns at a time, like `qq.get_variants_df_from_binary()`.
+        with BinaryVariantFileReader(in_filepath) as reader:
+            self.fields = reader.fields
+            for block in reader.get_blocks(decode_strings=True):
+                pvals = block['pval']
+                def get_variant(idx:int, block:Dict[str,Any] = block) -> Dict[str,Any]: return reader.get_variant(block, idx)
+                self.binner.process_arrays(block['chrom_idx'].astype(np.int64), block['pos'].astype(np.int64), pvals, get_variant)
+                if self.should_make_best_of_pheno:
+                    # Like `VectorizedBinner`, only variants stronger than the weakest in the queue (when the block starts) might enter it.
+                    q = self.best_of_pheno_q
+                    weakest_pval = q.peek_priority() if len(q) >= best_of_pheno.NUM_VARIANTS else math.inf
+                    for idx in np.flatnonzero(pvals < weakest_pval).tolist():
+                        q.add_and_keep_size(get_variant(idx), float(pvals[idx]), best_of_pheno.NUM_VARIANTS)
+                block_mafs = get_maf_array(block, self.pheno, is_checked=np.ones(len(pvals), dtype=bool))
+                if self.has_maf is None:
+                    self.has_maf = block_mafs is not None
+                    if conf.should_approximate_qq(): self.qq_sketch = qq.QQSketch(self.has_maf)
+                with np.errstate(divide='ignore'):
+                    block_qvals = np.where(pvals==0, 1000, -np.log10(pvals))
+                if self.qq_sketch is not None:
+                    self.qq_sketch.add(block_qvals, block_mafs)
+                else:
+                    self.qvals.frombytes(block_qvals.astype(np.float32).tobytes())
+                    if block_mafs is not None: self.mafs.frombytes(block_mafs.astype(np.float32).tobytes())
+
+    def merge(self, other:'_PhenoSummary') -> None:
+        '''Adds the variants of `other`, which must be on chroms after the ones in this summary.'''
+        self.binner.merge(other.binner)
+        for v in other.best_of_pheno_q.pop_all():
+            self.best_of_pheno_q.add_and_keep_size(v, v['pval'], best_of_pheno.NUM_VARIANTS)
+        if other.has_maf is None: return  # `other` had no variants
+        if self.has_maf is None:
+            self.has_maf, self.qq_sketch, self.fields = other.has_maf, other.qq_sketch, other.fields
+        elif self.has_maf != other.has_maf:
+            raise PheWebError("Some variants of pheno {!r} have mafs and some don't".format(self.pheno['phenocode']))
+        elif self.qq_sketch is not None:
+            assert other.qq_sketch is not None
+            self.qq_sketch.merge(other.qq_sketch)
+        # (Without `approximate_qq`, the qvals and mafs are in chrom order, just like when all of the chroms are read at once.)
+        self.mafs.extend(other.mafs)
+        self.qvals.extend(other.qvals)
+
+    def get_qq_data(self) -> Dict[str,Any]:
+        if self.qq_sketch is not None: return self.qq_sketch.get_qq_data()
+        variants_df = np.empty(len(self.qvals), dtype=[('maf',np.float32),('qval',np.float32)] if self.has_maf else [('qval',np.float32)])
+        variants_df['qval'] = np.frombuffer(self.qvals, dtype=np.float32)
+        if self.has_maf: variants_df['maf'] = np.frombuffer(self.mafs, dtype=np.float32)
+        return qq.get_qq_data(variants_df)
+
+    def write(self) -> None:
+        '''Computes every output, and then writes them.'''
+        phenocode = self.pheno['phenocode']
+        if self.has_maf is None: raise PheWebError("No variants found in {}".format(get_input_filepaths(self.pheno)[0]))
+        manhattan_data = self.binner.get_result()
+        qq_data = self.get_qq_data()
+        if self.should_make_best_of_pheno:
+            # `Binner` adds fields (like `peak`) to some variants, so only the original fields are kept.
+            assert self.fields is not None
+            best_assocs = [{field: v[field] for field in self.fields} for v in best_of_pheno.pop_all_in_order(self.best_of_pheno_q)]
+
+        write_json(filepath=get_pheno_filepath('manhattan', phenocode, must_exist=False), data=manhattan_data)
+        write_json(filepath=get_pheno_filepath('qq', phenocode, must_exist=False), data=qq_data)
+        if self.should_make_best_of_pheno:
+            with VariantFileWriter(get_pheno_filepath('best_of_pheno', phenocode, must_exist=False)) as vfw:
+                vfw.write_all(best_assocs)
+            best_of_pheno.write_filter_files(self.pheno, best_assocs)
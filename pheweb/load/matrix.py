@@ -1,21 +1,49 @@
 
-# TODO: Parallelize by chromosome.
-#  Spawn a pheweb process to do each chromosome.  Each one must do:
-#  + For every `pheno_gz/*.gz` and `sites/sites.tsv`, find the byte offset to the block that begins our chromosome.
-#  + Now cffi down into a function just like our normal one, but which starts at that offset, discards variants until it hits the target chromosome, merges, and then exits.
-#  + Don't append an empty block in `BgzipWriter:close()`.
-#  When all the child processes are done, the main thread needs to concatenate all the single-chrom matrix files and then append an empty bgzip block to signal EOF.
 
+'''
+This script makes a single bgzipped, tabixed file with the data for every variant in every phenotype.
 
-from ..utils import get_phenolist, PheWebError
-from ..file_utils import MatrixReader, get_tmp_path, get_filepath, get_pheno_filepath
-from .load_utils import mtime
+The chromosomes are split into one contiguous group per process (as in `pheweb sites`).
+For each group, the c++ code seeks each `pheno_gz/*.gz` to the group's first chromosome (using its tabix index)
+and writes a bgzip fragment without the empty block that marks EOF.
+Then the fragments are concatenated in order, the EOF block is appended, and the whole matrix is tabixed once.
+
+If there's already a matrix, the columns of each phenotype whose parsed file hasn't changed since are copied from it,
+so that only new or changed phenotypes are read from `pheno_gz/`.  The per-variant columns always come from `sites.tsv`.
+
+If `matrix_num_shards` is set, this also writes a sparse copy of the matrix to `matrix_sharded/` (see `ShardedMatrixReader`),
+with one shard per contiguous group of phenotypes.
+
+If `variant_store` is set, the c++ code also writes the arrays of a sparse variant store for each group of chromosomes,
+which are concatenated into `variant_store/` (see `VariantStoreReader`):
+  - `chrompos.npy`: `chrom_idx << 32 | pos` for each variant, sorted, for binary search
+  - `variants.npy` and `variant_offsets.npy`: the sites.tsv line of variant `i` is `variants[variant_offsets[i]:variant_offsets[i+1]]`
+  - `records.npy` and `record_offsets.npy`: the associations of variant `i` are `records[record_offsets[i]:record_offsets[i+1]]`,
+    where each record is a phenotype index and a float64 for each per-assoc field (NaN for empty)
+  - `store.json`: the phenotypes, their fields, and the fields of sites.tsv.  It's written last.
+'''
+
+from ..utils import get_phenolist, PheWebError, chrom_order, chrom_order_list
+from .. import conf
+from .. import parse_utils
+from ..file_utils import MatrixReader, get_tmp_path, get_filepath, get_pheno_filepath, get_virtual_offset, read_gzip, read_maybe_gzip, write_json, convert_VariantFile_to_IndexedVariantFile
+from .load_utils import mtime, Parallelizer
+from .build_manifest import should_rebuild, record_build
+from .sites import get_chrom_groups
 from .cffi._x import ffi, lib
 
 import os
 import glob
+import heapq
+import json
+import shutil
 import pysam
-from typing import List
+import numpy as np
+from typing import List,Dict,Any,Tuple,Optional,Iterator
+
+
+# The empty bgzip block that marks the end of a bgzipped file.
+BGZIP_EOF_BLOCK = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
 
 
 def clear_out_junk() -> None:
@@ -28,7 +56,6 @@ def clear_out_junk() -> None:
             os.remove(filepath)
 
 def should_run() -> bool:
-    sites_filepath = get_filepath('sites')
     matrix_gz_filepath = get_filepath('matrix', must_exist=False)
 
     if not os.path.exists(matrix_gz_filepath): return True
@@ -45,19 +72,31 @@ def should_run() -> bool:
         print('- phenos in matrix.tsv.gz but not pheno-list.json:', ', '.join(repr(p) for p in matrix_phenocodes - cur_phenocodes))
         return True
 
-    # If pheno_gz or sites.tsv are newer than matrix, rebuild.
-    infilepaths = [get_pheno_filepath('pheno_gz', phenocode) for phenocode in cur_phenocodes] + [sites_filepath]
+    # If pheno_gz or sites.tsv are newer than matrix (or, with `build_manifest`, differ from the ones it was made from), rebuild.
+    infilepaths = _get_input_filepaths()
     infile_modtime = max(mtime(filepath) for filepath in infilepaths)
-    if infile_modtime > mtime(matrix_gz_filepath):
-        print('rerunning because some input files are newer than matrix.tsv.gz')
+    if should_rebuild('matrix', infilepaths, [matrix_gz_filepath], by_mtime=infile_modtime > mtime(matrix_gz_filepath)):
+        print('rerunning because some input files changed since matrix.tsv.gz was made')
         return True
 
+    if conf.should_write_variant_store():
+        store_json_filepath = os.path.join(get_filepath('variant_store', must_exist=False), 'store.json')
+        if not os.path.exists(store_json_filepath) or mtime(store_json_filepath) < mtime(matrix_gz_filepath):
+            print('rerunning because the variant store is missing or older than matrix.tsv.gz')
+            return True
+
     return False
 
+def _get_input_filepaths() -> List[str]:
+    return sorted(get_pheno_filepath('pheno_gz', pheno['phenocode']) for pheno in get_phenolist()) + [get_filepath('sites')]
+
 def run(argv:List[str]) -> None:
 
     if '-h' in argv or '--help' in argv:
         print('Make a single large tabixed file of all phenotypes data')
+        print('')
+        print('Usage:')
+        print('  --full   rebuild the matrix from scratch instead of reusing columns from the old matrix')
         exit(1)
 
     matrix_gz_filepath = get_filepath('matrix', must_exist=False)
@@ -65,17 +104,54 @@ def run(argv:List[str]) -> None:
         clear_out_junk()
 
         sites_filepath = get_filepath('sites')
-        pheno_gz_glob = get_filepath('pheno_gz')+'/*.gz'
+        pheno_gz_filepaths = sorted(glob.glob(get_filepath('pheno_gz')+'/*.gz'))
         matrix_gz_tmp_filepath = get_tmp_path(matrix_gz_filepath)
 
-        # we don't need `ffi.new('char[]', ...)` because args are `const`
-        ret = lib.cffi_make_matrix(sites_filepath.encode('utf8'),
-                                   pheno_gz_glob.encode('utf8'),
-                                   matrix_gz_tmp_filepath.encode('utf8'))
-        ret_bytes = ffi.string(ret, maxlen=1000)
-        if ret_bytes != b'ok':
-            raise PheWebError('The portion of `pheweb matrix` written in c++/cffi failed with the message ' + repr(ret_bytes))
+        old_column_groups = {} if '--full' in argv else get_reusable_old_column_groups(matrix_gz_filepath)
+        column_groups: List[Tuple[int,int,int]] = []  # (aug_idx, old_start, old_end), as in the c++
+        aug_filepaths: List[str] = []
+        for filepath in pheno_gz_filepaths:
+            phenocode = os.path.basename(filepath)[:-3]
+            if phenocode in old_column_groups:
+                column_groups.append((-1,) + old_column_groups[phenocode])
+            else:
+                column_groups.append((len(aug_filepaths), 0, 0))
+                aug_filepaths.append(filepath)
+        if old_column_groups:
+            print('reusing the columns of {} phenotypes from the old matrix, and reading {} phenotypes from pheno_gz/'.format(
+                len(old_column_groups), len(aug_filepaths)))
+
+        store_info = get_variant_store_info(sites_filepath, pheno_gz_filepaths, column_groups, matrix_gz_filepath) if conf.should_write_variant_store() else None
+
+        chrom_groups = get_chrom_groups(conf.get_num_procs('matrix'))
+        tasks = [{
+            'sites_filepath': sites_filepath,
+            'pheno_gz_filepaths': aug_filepaths,
+            'old_matrix_filepath': matrix_gz_filepath if old_column_groups else None,
+            'column_groups': column_groups,
+            'chroms': chroms,
+            'is_first': i == 0,
+            'store_column_for_field': store_info['column_for_field'] if store_info else None,
+            'store_num_columns': len(store_info['fields']) if store_info else 0,
+        } for i, chroms in enumerate(chrom_groups)]
+        fragment_filepaths: Dict[int,str] = {}
+        for ret in Parallelizer().run_single_tasks(tasks, make_matrix_fragment, cmd='matrix'):
+            fragment_filepaths[chrom_order[ret['task']['chroms'][0]]] = ret['value']
+
+        with open(matrix_gz_tmp_filepath, 'wb') as f:
+            for _, fragment_filepath in sorted(fragment_filepaths.items()):
+                with open(fragment_filepath, 'rb') as f_fragment:
+                    shutil.copyfileobj(f_fragment, f)
+                os.remove(fragment_filepath)
+            f.write(BGZIP_EOF_BLOCK)
         os.rename(matrix_gz_tmp_filepath, matrix_gz_filepath)
+
+        if store_info is not None:
+            print('writing the variant store')
+            make_variant_store(
+                [_get_store_prefix(fragment_filepath) for _, fragment_filepath in sorted(fragment_filepaths.items())],
+                {k: v for k, v in store_info.items() if k != 'column_for_field'})
+        record_build('matrix', _get_input_filepaths())
     else:
         print('matrix is up-to-date!')
 
@@ -88,3 +164,253 @@ def run(argv:List[str]) -> None:
         )
     else:
         print('matrix.tbi is up-to-date!')
+
+    num_shards = conf.get_matrix_num_shards()
+    if num_shards > 0:
+        if should_make_sharded_matrix(num_shards):
+            print('making sharded matrix')
+            make_sharded_matrix(num_shards)
+        else:
+            print('sharded matrix is up-to-date!')
+
+
+def get_reusable_old_column_groups(matrix_gz_filepath:str) -> Dict[str,Tuple[int,int]]:
+    '''
+    Returns `{phenocode: (start, end)}`, where columns `[start, end)` of the old matrix hold the per-assoc fields of `phenocode`,
+    for each current phenotype whose parsed file is older than the old matrix.  Prints which phenotypes were added, dropped, or changed.
+    '''
+    old_column_groups = get_old_column_groups(matrix_gz_filepath)
+    if old_column_groups is None: return {}
+    matrix_mtime = mtime(matrix_gz_filepath)
+    cur_phenocodes = [pheno['phenocode'] for pheno in get_phenolist()]
+    added_phenocodes = [phenocode for phenocode in cur_phenocodes if phenocode not in old_column_groups]
+    dropped_phenocodes = [phenocode for phenocode in old_column_groups if phenocode not in cur_phenocodes]
+    changed_phenocodes = [phenocode for phenocode in cur_phenocodes if phenocode in old_column_groups and _get_pheno_mtime(phenocode) > matrix_mtime]
+    for description, phenocodes in [('added', added_phenocodes), ('dropped', dropped_phenocodes), ('changed', changed_phenocodes)]:
+        if phenocodes:
+            print('- columns for {} phenotypes will be {}: {}'.format(len(phenocodes), description, ', '.join(repr(p) for p in phenocodes)))
+    return {phenocode: old_column_groups[phenocode] for phenocode in cur_phenocodes
+            if phenocode in old_column_groups and phenocode not in changed_phenocodes}
+
+def get_old_column_groups(matrix_gz_filepath:str) -> Optional[Dict[str,Tuple[int,int]]]:
+    '''Returns `{phenocode: (start, end)}` for the old matrix, or None if it's missing or its header is unexpected.'''
+    try:
+        with read_gzip(matrix_gz_filepath) as f:
+            colnames = f.readline().rstrip('\n').split('\t')
+    except Exception:
+        return None
+    if not colnames[0].startswith('#') or colnames[:4] != ['#chrom', 'pos', 'ref', 'alt']: return None
+    column_groups: Dict[str,Tuple[int,int]] = {}
+    for colnum, colname in enumerate(colnames):
+        if '@' not in colname:
+            if column_groups: return None  # per-variant fields must all come first
+            continue
+        phenocode = colname.split('@', 1)[1]
+        if phenocode in column_groups:
+            start, end = column_groups[phenocode]
+            if end != colnum: return None  # each phenotype's fields must be contiguous
+            column_groups[phenocode] = (start, colnum + 1)
+        else:
+            column_groups[phenocode] = (colnum, colnum + 1)
+    return column_groups
+
+def get_variant_store_info(sites_filepath:str, pheno_gz_filepaths:List[str], column_groups:List[Tuple[int,int,int]], old_matrix_filepath:str) -> Dict[str,Any]:
+    '''
+    Returns the contents of `store.json`, plus `column_for_field`, which maps each per-assoc field of each column group (in order)
+    to its index in `fields` (which is every per-assoc field that any phenotype has, in the order of `parse_utils.per_assoc_fields`).
+    '''
+    with read_maybe_gzip(sites_filepath) as f:
+        sites_fields = f.readline().rstrip('\n').split('\t')
+    old_colnames: List[str] = []
+    if any(group[0] == -1 for group in column_groups):
+        with read_gzip(old_matrix_filepath) as f:
+            old_colnames = f.readline().rstrip('\n').split('\t')
+    phenos: List[Dict[str,Any]] = []
+    for filepath, (aug_idx, old_start, old_end) in zip(pheno_gz_filepaths, column_groups):
+        if aug_idx == -1:
+            fields = [colname.split('@', 1)[0] for colname in old_colnames[old_start:old_end]]
+        else:
+            with read_gzip(filepath) as f:
+                fields = f.readline().rstrip('\n').split('\t')[len(sites_fields):]
+        for field in fields:
+            if parse_utils.per_assoc_fields.get(field, {}).get('type') is not float:
+                raise PheWebError('The variant store can only hold per-assoc fields of type float, but {!r} has {!r}'.format(filepath, field))
+        phenos.append({'phenocode': os.path.basename(filepath)[:-3], 'fields': fields})
+    store_fields = [field for field in parse_utils.per_assoc_fields if any(field in pheno['fields'] for pheno in phenos)]
+    return {
+        'phenos': phenos,
+        'fields': store_fields,
+        'sites_fields': sites_fields,
+        'column_for_field': [store_fields.index(field) for pheno in phenos for field in pheno['fields']],
+    }
+
+def _get_pheno_mtime(phenocode:str) -> float:
+    # pheno_gz files are rewritten whenever sites.tsv changes (eg, when a phenotype is added), so use the parsed file when we can.
+    parsed_filepath = get_pheno_filepath('parsed', phenocode, must_exist=False)
+    if os.path.exists(parsed_filepath): return mtime(parsed_filepath)
+    return mtime(get_pheno_filepath('pheno_gz', phenocode))
+
+def make_matrix_fragment(task:Dict[str,Any]) -> str:
+    '''Writes the matrix for the variants on `task['chroms']` as a bgzip fragment without an EOF block, and returns its filepath.'''
+    out_filepath = get_tmp_path('matrix-chr{}-chr{}.tsv.gz'.format(task['chroms'][0], task['chroms'][-1]))
+    store_column_for_field = task['store_column_for_field'] or []
+    virtual_offsets = [get_virtual_offset(filepath, task['chroms']) for filepath in task['pheno_gz_filepaths']]
+    old_matrix_filepath = task['old_matrix_filepath'] or ''
+    old_matrix_virtual_offset = get_virtual_offset(old_matrix_filepath, task['chroms']) if old_matrix_filepath else -1
+    # `ffi.new()` arrays must stay referenced until the call returns.
+    filepaths_keepalive = [ffi.new('char[]', filepath.encode('utf8')) for filepath in task['pheno_gz_filepaths']]
+    chroms_keepalive = [ffi.new('char[]', chrom.encode('utf8')) for chrom in task['chroms']]
+    chrom_order_keepalive = [ffi.new('char[]', chrom.encode('utf8')) for chrom in chrom_order_list]
+    ret = lib.cffi_make_matrix_for_chroms(
+        task['sites_filepath'].encode('utf8'),
+        get_virtual_offset(task['sites_filepath'], task['chroms']),
+        ffi.new('const char*[]', filepaths_keepalive),
+        ffi.new('int64_t[]', virtual_offsets),
+        len(filepaths_keepalive),
+        old_matrix_filepath.encode('utf8'),
+        old_matrix_virtual_offset,
+        ffi.new('int64_t[]', [group[0] for group in task['column_groups']]),
+        ffi.new('int64_t[]', [group[1] for group in task['column_groups']]),
+        ffi.new('int64_t[]', [group[2] for group in task['column_groups']]),
+        len(task['column_groups']),
+        ffi.new('const char*[]', chroms_keepalive),
+        len(chroms_keepalive),
+        ffi.new('const char*[]', chrom_order_keepalive),
+        len(chrom_order_keepalive),
+        task['is_first'],
+        False,
+        out_filepath.encode('utf8'),
+        _get_store_prefix(out_filepath).encode('utf8') if task['store_column_for_field'] is not None else b'',
+        task['store_num_columns'],
+        ffi.new('int64_t[]', store_column_for_field),
+        len(store_column_for_field))
+    ret_bytes = ffi.string(ret, maxlen=1000)
+    if ret_bytes != b'ok':
+        raise PheWebError('The portion of `pheweb matrix` written in c++/cffi failed with the message ' + repr(ret_bytes))
+    return out_filepath
+
+def _get_store_prefix(fragment_filepath:str) -> str:
+    return fragment_filepath[:-len('.tsv.gz')] + '-store'
+
+
+def make_variant_store(store_prefixes:List[str], store_info:Dict[str,Any]) -> None:
+    '''Concatenates the variant-store arrays written for each group of chromosomes into `variant_store/`, and then writes `store.json`.'''
+    store_dirpath = get_filepath('variant_store', must_exist=False)
+    os.makedirs(store_dirpath, exist_ok=True)
+    store_json_filepath = os.path.join(store_dirpath, 'store.json')
+    if os.path.exists(store_json_filepath): os.remove(store_json_filepath)  # so that nothing reads the arrays while they're incomplete
+
+    record_dtype = np.dtype([('pheno_idx', np.uint32)] + [(field, np.float64) for field in store_info['fields']])
+    # The `.npy` files are written to tmp paths and then renamed, so that a running server's memory-maps of the old arrays stay valid.
+    _concatenate_arrays([prefix+'.chrompos' for prefix in store_prefixes], np.uint64, os.path.join(store_dirpath, 'chrompos.npy'))
+    _concatenate_arrays([prefix+'.variants' for prefix in store_prefixes], np.uint8, os.path.join(store_dirpath, 'variants.npy'))
+    _concatenate_arrays([prefix+'.records' for prefix in store_prefixes], record_dtype, os.path.join(store_dirpath, 'records.npy'))
+    # Each fragment's ends count from the start of that fragment, so they're offset by the total of the previous fragments.
+    _concatenate_arrays([prefix+'.variant_ends' for prefix in store_prefixes], np.uint64, os.path.join(store_dirpath, 'variant_offsets.npy'), cumulative=True)
+    _concatenate_arrays([prefix+'.record_ends' for prefix in store_prefixes], np.uint64, os.path.join(store_dirpath, 'record_offsets.npy'), cumulative=True)
+    for prefix in store_prefixes:
+        for suffix in ['.chrompos', '.variants', '.variant_ends', '.records', '.record_ends']:
+            os.remove(prefix + suffix)
+
+    write_json(filepath=store_json_filepath, data=store_info)
+
+def _concatenate_arrays(filepaths:List[str], dtype:Any, out_filepath:str, *, cumulative:bool = False, chunk_len:int = 2**20) -> None:
+    '''
+    Writes the raw arrays in `filepaths` to the `.npy` file `out_filepath`, one after the other.
+    If `cumulative`, the arrays hold ends of ranges, so the output starts with a 0 and each array is offset by the last end before it.
+    '''
+    dtype = np.dtype(dtype)
+    lengths = [os.stat(filepath).st_size // dtype.itemsize for filepath in filepaths]
+    tmp_filepath = get_tmp_path(out_filepath)
+    out = np.lib.format.open_memmap(tmp_filepath, mode='w+', dtype=dtype, shape=(sum(lengths) + cumulative,))
+    out_idx, base = 0, 0
+    if cumulative:
+        out[0] = 0
+        out_idx = 1
+    for filepath, length in zip(filepaths, lengths):
+        if length == 0: continue  # `np.memmap` can't map an empty file
+        arr = np.memmap(filepath, dtype=dtype, mode='r', shape=(length,))
+        for chunk_start in range(0, length, chunk_len):
+            chunk = arr[chunk_start:chunk_start+chunk_len]
+            out[out_idx:out_idx+len(chunk)] = chunk + base if cumulative else chunk
+            out_idx += len(chunk)
+        if cumulative: base += int(arr[-1])
+        del arr
+    out.flush()
+    del out
+    os.replace(tmp_filepath, out_filepath)
+
+
+def should_make_sharded_matrix(num_shards:int) -> bool:
+    shards_json_filepath = os.path.join(get_filepath('matrix_sharded', must_exist=False), 'shards.json')
+    if not os.path.exists(shards_json_filepath) or mtime(shards_json_filepath) < mtime(get_filepath('matrix')): return True
+    with open(shards_json_filepath) as f:
+        shards_info = json.load(f)
+    return shards_info['num_shards'] != num_shards
+
+def make_sharded_matrix(num_shards:int) -> None:
+    sharded_dirpath = get_filepath('matrix_sharded', must_exist=False)
+    os.makedirs(sharded_dirpath, exist_ok=True)
+    shards_json_filepath = os.path.join(sharded_dirpath, 'shards.json')
+    if os.path.exists(shards_json_filepath): os.remove(shards_json_filepath)  # so that nothing reads the shards while they're incomplete
+    for filepath in glob.glob(os.path.join(sharded_dirpath, 'shard-*')): os.remove(filepath)
+
+    sites_filepath = get_filepath('sites')
+    with read_maybe_gzip(sites_filepath) as f:
+        sites_fields = f.readline().rstrip('\n').split('\t')
+    phenos: List[Dict[str,Any]] = []
+    for filepath in sorted(glob.glob(get_filepath('pheno_gz')+'/*.gz')):
+        with read_gzip(filepath) as f:
+            fields = f.readline().rstrip('\n').split('\t')
+        if fields[0].startswith('#'): fields[0] = fields[0][1:]
+        if fields[:len(sites_fields)] != sites_fields:
+            raise PheWebError("The pheno file {!r} has a header that doesn't begin with the header of sites.tsv".format(filepath))
+        phenos.append({'phenocode': os.path.basename(filepath)[:-3], 'fields': fields[len(sites_fields):], 'filepath': filepath})
+
+    num_shards = min(num_shards, len(phenos))
+    tasks: List[Dict[str,Any]] = [{'sites_filepath': sites_filepath, 'shard_num': None, 'out_filepath': os.path.join(sharded_dirpath, 'sites.tsv.gz')}]
+    for shard_num in range(num_shards):
+        phenocode_idxs = range(shard_num * len(phenos) // num_shards, (shard_num+1) * len(phenos) // num_shards)
+        for phenocode_idx in phenocode_idxs: phenos[phenocode_idx]['shard'] = shard_num
+        tasks.append({
+            'sites_filepath': sites_filepath,
+            'shard_num': shard_num,
+            'out_filepath': os.path.join(sharded_dirpath, 'shard-{}.tsv.gz'.format(shard_num)),
+            'phenos': [(phenocode_idx, phenos[phenocode_idx]['filepath']) for phenocode_idx in phenocode_idxs],
+        })
+    for _ in Parallelizer().run_single_tasks(tasks, make_sharded_matrix_file, cmd='matrix'):
+        pass
+
+    for pheno in phenos: del pheno['filepath']
+    write_json(filepath=shards_json_filepath, data={'num_shards': num_shards, 'sites_fields': sites_fields, 'phenos': phenos})
+
+def make_sharded_matrix_file(task:Dict[str,Any]) -> None:
+    '''Writes either the sites file (with a `row_id` for each line of sites.tsv) or one shard of the sharded matrix.'''
+    tmp_filepath = get_tmp_path(task['out_filepath'])
+    with read_maybe_gzip(task['sites_filepath']) as f_sites, open(tmp_filepath, 'w') as f_out:
+        sites_header = next(f_sites).rstrip('\n')
+        if task['shard_num'] is None:
+            f_out.write('#' + sites_header + '\trow_id\n')
+            for row_id, line in enumerate(f_sites):
+                f_out.write('{}\t{}\n'.format(line.rstrip('\n'), row_id))
+        else:
+            f_out.write('#chrom\tpos\trow_id\tphenocode_idx\tvalues\n')
+            # Every pheno_gz line begins with the sites.tsv line of its variant, so we advance through sites.tsv to find its row_id.
+            row_id, sites_line = -1, ''
+            for cpra, phenocode_idx, line in heapq.merge(*(_get_pheno_lines(filepath, phenocode_idx) for phenocode_idx, filepath in task['phenos'])):
+                while not (line.startswith(sites_line) and line[len(sites_line)] == '\t'):
+                    sites_line = next(f_sites, '').rstrip('\n')
+                    if not sites_line:
+                        raise PheWebError("sites.tsv is missing the variant {} (or it is out of order)".format('-'.join(map(str, cpra))))
+                    row_id += 1
+                f_out.write('{}\t{}\t{}\t{}{}'.format(line[:line.index('\t')], cpra[1], row_id, phenocode_idx, line[len(sites_line):]))
+    convert_VariantFile_to_IndexedVariantFile(tmp_filepath, task['out_filepath'])
+    os.remove(tmp_filepath)
+
+def _get_pheno_lines(filepath:str, phenocode_idx:int) -> Iterator[Tuple[Tuple[int,int,str,str],int,str]]:
+    '''Yields `((chrom_idx, pos, ref, alt), phenocode_idx, line)` for each line, which is the order of sites.tsv.'''
+    with read_gzip(filepath) as f:
+        next(f)
+        for line in f:
+            chrom, pos, ref, alt, _ = line.split('\t', 4)
+            yield ((chrom_order[chrom], int(pos), ref, alt), phenocode_idx, line)
@@ -1,9 +1,9 @@
 
 from ..utils import get_phenolist, PheWebError
 from .. import conf
-from ..file_utils import VariantFileWriter, write_json, get_generated_path, get_filepath, get_pheno_filepath
+from ..file_utils import IndexedVariantFileWriter, write_json, get_generated_path, get_filepath, get_pheno_filepath
 from .read_input_file import PhenoReader
-from .load_utils import parallelize_per_pheno, indent, get_phenos_subset
+from .load_utils import parallelize_per_pheno, indent, get_phenos_subset, PhenoStage
 
 import itertools
 import argparse
@@ -62,12 +62,19 @@ def write_failures(filepath:str, failed_results:Dict[str,Any]):
 def convert(pheno:Dict[str,Any]) -> Iterator[Dict[str,Any]]:
     # suppress Exceptions so that we can report back on which phenotypes succeeded and which didn't.
     try:
-        with VariantFileWriter(get_pheno_filepath('parsed', pheno['phenocode'], must_exist=False)) as writer:
+        # The tabix index lets `pheweb sites` start reading each chromosome group where it begins.
+        with IndexedVariantFileWriter(get_pheno_filepath('parsed', pheno['phenocode'], must_exist=False), num_threads=conf.get_num_compression_threads()) as writer:
             pheno_reader = PhenoReader(pheno, minimum_maf=conf.get_assoc_min_maf())
-            variants = pheno_reader.get_variants()
             debugging_limit_num_variants = conf.get_debugging_limit_num_variants()
-            if debugging_limit_num_variants: variants = itertools.islice(variants, 0, debugging_limit_num_variants)
-            writer.write_all(variants)
+            if conf.should_parse_columnar():
+                chunks = pheno_reader.get_variant_columns()
+                if debugging_limit_num_variants: chunks = islice_columns(chunks, debugging_limit_num_variants)
+                for chunk in chunks:
+                    writer.write_columns(chunk)
+            else:
+                variants = pheno_reader.get_variants()
+                if debugging_limit_num_variants: variants = itertools.islice(variants, 0, debugging_limit_num_variants)
+                writer.write_all(variants)
     except Exception as exc:
         import traceback
         yield {
@@ -80,3 +87,19 @@ def convert(pheno:Dict[str,Any]) -> Iterator[Dict[str,Any]]:
         yield {"succeeded": False, "exception_str": str(exc), "exception_tb": traceback.format_exc()}
     else:
         yield {"succeeded": True}
+
+def _convert_or_raise(pheno:Dict[str,Any]) -> None:
+    '''Like `convert()`, but raises if parsing fails, so that a job for only this phenotype fails.'''
+    for ret in convert(pheno):
+        if ret.get('succeeded') is False:
+            raise PheWebError("Failed to parse phenotype {!r}:\n{}".format(pheno['phenocode'], ret['exception_tb']))
+
+pheno_stage = PhenoStage('parse-input-files', get_input_filepaths, get_output_filepaths, _convert_or_raise)
+
+def islice_columns(chunks:Iterator[Dict[str,List[Any]]], num_variants:int) -> Iterator[Dict[str,List[Any]]]:
+    '''Like `itertools.islice(variants, 0, num_variants)` for chunks of columns.'''
+    for chunk in chunks:
+        if num_variants <= 0: return
+        chunk = {field: column[:num_variants] for field,column in chunk.items()}
+        num_variants -= len(chunk['chrom'])
+        yield chunk
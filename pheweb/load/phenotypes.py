@@ -1,8 +1,10 @@
 
 from ..utils import get_phenolist
 from ..file_utils import write_json, get_filepath, get_pheno_filepath, write_heterogenous_variantfile
+from .build_manifest import should_rebuild, record_build
 
 import json
+import os
 from pathlib import Path
 from typing import Iterator,Dict,Any,List
 
@@ -37,11 +39,12 @@ def should_run() -> bool:
     if not all(fp.exists() for fp in output_filepaths):
         return True
     oldest_output_mtime = min(fp.stat().st_mtime for fp in output_filepaths)
-    input_filepaths = [Path(get_pheno_filepath('manhattan', pheno['phenocode'])) for pheno in get_phenolist()]
-    newest_input_mtime = max(fp.stat().st_mtime for fp in input_filepaths)
-    if newest_input_mtime > oldest_output_mtime:
-        return True
-    return False
+    input_filepaths = _get_input_filepaths()
+    newest_input_mtime = max(os.stat(fp).st_mtime for fp in input_filepaths)
+    return should_rebuild('phenotypes', input_filepaths, [str(fp) for fp in output_filepaths], by_mtime=newest_input_mtime > oldest_output_mtime)
+
+def _get_input_filepaths() -> List[str]:
+    return [get_pheno_filepath('manhattan', pheno['phenocode']) for pheno in get_phenolist()]
 
 def run(argv:List[str]) -> None:
     if '-h' in argv or '--help' in argv:
@@ -61,3 +64,5 @@ def run(argv:List[str]) -> None:
     out_filepath_tsv = get_filepath('phenotypes_summary_tsv', must_exist=False)
     write_heterogenous_variantfile(out_filepath_tsv, data, use_gzip=False)
     print("wrote {} phenotypes to {}".format(len(data), out_filepath_tsv))
+
+    record_build('phenotypes', _get_input_filepaths())
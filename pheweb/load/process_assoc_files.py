@@ -1,58 +1,317 @@
 
-
 # TODO: color lines with ==> using `colorama`
 # TODO: add a step to verify that the genome build is correct using detect_ref (once on first 10k of each input file, and again on `sites`)
 
-from ..utils import fmt_seconds
+from .. import conf
+from ..utils import fmt_seconds, get_phenolist, PheWebError
+from .load_utils import PerPhenoParallelizer, PhenoStage
+from .build_manifest import BuildManifest
 
 import time
+import heapq
 import importlib
-from typing import List
-
-scripts = '''
-phenolist verify
-parse_input_files
-sites
-make_gene_aliases_sqlite3
-add_rsids
-add_genes
-make_cpras_rsids_sqlite3
-augment_phenos
-matrix
-gather_pvalues_for_each_gene
-manhattan
-top_hits
-qq
-phenotypes
-pheno_correlation
-'''.split('\n')
-scripts = [script for script in scripts if script]
+import multiprocessing, multiprocessing.connection
+import os
+import sys
+from types import GeneratorType
+from typing import List,Dict,Set,Any,Optional,NamedTuple,Tuple,Callable
+
+
+class Step(NamedTuple):
+    script: str
+    deps: List[str]  # the steps whose outputs this step reads
+    parallel: bool = False  # whether this step runs `num_procs` processes
+    per_pheno: bool = False  # whether this step's module has a `pheno_stage`, so that each pheno can be done as soon as its inputs are ready
+
+# This is the dataflow in `etc/detailed-internal-dataflow.md`.  The steps are in an order that satisfies their deps.
+steps = [
+    Step('phenolist verify', []),
+    Step('parse_input_files', ['phenolist verify'], parallel=True),
+    Step('sites', ['parse_input_files'], parallel=True),
+    Step('make_gene_aliases_sqlite3', ['phenolist verify']),
+    Step('add_rsids', ['sites']),
+    Step('add_genes', ['add_rsids', 'make_gene_aliases_sqlite3']),  # (both download the genes file if it's missing)
+    Step('make_cpras_rsids_sqlite3', ['add_genes']),
+    Step('augment_phenos', ['add_genes'], parallel=True, per_pheno=True),
+    Step('matrix', ['augment_phenos'], parallel=True),
+    Step('gather_pvalues_for_each_gene', ['matrix'], parallel=True),
+    Step('manhattan_qq', ['augment_phenos'], parallel=True, per_pheno=True),
+    Step('top_hits', ['manhattan_qq']),
+    Step('phenotypes', ['manhattan_qq']),
+    Step('pheno_correlation', ['phenolist verify']),
+]
+scripts = [step.script for step in steps]
+
+def get_streaming_steps(mysteps:List[Step]) -> List[Step]:
+    '''
+    When `sites_file` is set, the sites are already annotated, so `sites` only checks that file, `add_rsids` and `add_genes` are skipped,
+    and each pheno can be augmented as soon as it's parsed, instead of after every pheno has been parsed.
+    '''
+    replaced_deps = {
+        'sites': ['phenolist verify'],
+        'augment_phenos': ['parse_input_files', 'sites'],
+        'make_cpras_rsids_sqlite3': ['sites'],
+        'gather_pvalues_for_each_gene': ['matrix', 'make_gene_aliases_sqlite3'],  # (it reads the genes file, which `add_genes` isn't there to download)
+    }
+    ret = []
+    for step in mysteps:
+        if step.script in ['add_rsids', 'add_genes']: continue
+        if step.script == 'parse_input_files': step = step._replace(per_pheno=True)
+        if step.script == 'sites': step = step._replace(parallel=False)
+        ret.append(step._replace(deps=replaced_deps.get(step.script, step.deps)))
+    return ret
 
 def run(argv:List[str]) -> None:
     if any(arg in ['-h', '--help'] for arg in argv):
         print('Run all the steps to go from a prepared phenolist to a ready-to-serve pheweb.')
         print('This is equivalent to running:\n')
-        print(' &&\n'.join('    pheweb {}'.format(script.replace('_', '-')) for script in scripts))
+        print(' &&\n'.join('    pheweb {}'.format(_get_name(script)) for script in scripts))
         print('')
+        print("If `num_procs` is more than 1, steps that don't depend on each other run at the same time, using at most `num_procs` processes in total.")
+        print("If `sites_file` is set, `pheweb sites` only checks that file, `pheweb add-rsids` and `pheweb add-genes` are skipped, and each pheno goes from parsing to manhattan and QQ plots without waiting for the others.")
         print("Passing `--no-parse` will skip `pheweb parse-input-files` (so it won't error if input filepaths are missing)")
         exit(1)
 
     if argv == ['--no-parse']:
-        myscripts = [s for s in scripts if s != 'parse_input_files']
+        mysteps = [s for s in steps if s.script != 'parse_input_files']
     else:
-        myscripts = scripts
+        mysteps = steps
+    if conf.get_sites_file():
+        mysteps = get_streaming_steps(mysteps)
+
+    if conf.get_num_procs() > 1:
+        _StepRunner(mysteps, conf.get_num_procs()).run()
+        return
 
-    for script in myscripts:
-        print('==> Starting `pheweb {}`'.format(script.replace('_', '-')))
+    for step in mysteps:
+        print('==> Starting `pheweb {}`'.format(_get_name(step.script)))
         start_time = time.time()
-        script_parts = script.split()
-        module = importlib.import_module('.{}'.format(script_parts[0]), __package__)
-        module_run = getattr(module, 'run', None)  # appeases mypy
-        if not callable(module_run): raise Exception("module.run ({!r}) isn't callable for module {!r} for script {!r}".format(module_run, module, script))
         try:
-            module_run(script_parts[1:])
+            _run_script(step.script)
         except Exception:
             print('==> failed after {}'.format(fmt_seconds(time.time() - start_time)))
             raise
         else:
             print('==> Completed in {}'.format(fmt_seconds(time.time() - start_time)), end='\n\n')
+
+def _get_name(script:str) -> str: return script.replace('_', '-')
+
+def _run_script(script:str) -> None:
+    script_parts = script.split()
+    module = importlib.import_module('.{}'.format(script_parts[0]), __package__)
+    module_run = getattr(module, 'run', None)  # appeases mypy
+    if not callable(module_run): raise Exception("module.run ({!r}) isn't callable for module {!r} for script {!r}".format(module_run, module, script))
+    module_run(script_parts[1:])
+
+
+class _Job(NamedTuple):
+    proc: multiprocessing.Process
+    output_conn: Any
+    num_procs: int
+    step: Step
+    pheno: Optional[Dict[str,Any]]
+    start_time: float
+    def get_name(self) -> str:
+        return _get_name(self.step.script) + ('' if self.pheno is None else ' ' + self.pheno['phenocode'])
+
+class _ExpandedStep:
+    '''The state of a per-pheno step whose phenos run as separate jobs.'''
+    def __init__(self, step:Step):
+        self.step = step
+        self.stage: PhenoStage = getattr(importlib.import_module('.{}'.format(step.script), __package__), 'pheno_stage')
+        self.parallelizer = PerPhenoParallelizer()  # for its helpers
+        self.manifest = BuildManifest.load_if_enabled()
+        self.start_time = self.last_progress_time = time.time()
+        self.phenos: Dict[str,Dict[str,Any]] = {}
+        self.waiting: Dict[str,Set[str]] = {}  # like {phenocode: {upstream_script, ...}}
+        self.queued: List[Tuple[float,str]] = []  # a heap of (-cost, phenocode)
+        self.running: Set[str] = set()
+        self.input_digests: Dict[str,List[str]] = {}
+        self.task_seconds: List[Tuple[str,float]] = []
+        self.num_already_done = 0
+        self.is_done = False
+    def get_unfinished_phenocodes(self) -> Set[str]:
+        return set(self.waiting) | set(phenocode for _, phenocode in self.queued) | self.running
+    def add_ready_phenos(self, phenos:List[Dict[str,Any]]) -> None:
+        '''Queues the phenos that need to run, now that their inputs are ready.'''
+        stage = self.stage
+        phenos_to_process = self.parallelizer._get_phenos_to_process(phenos, stage.get_input_filepaths, stage.get_output_filepaths, stage.cmd, self.manifest)
+        self.num_already_done += len(phenos) - len(phenos_to_process)
+        self.input_digests.update(self.parallelizer._get_input_digests(self.manifest, phenos_to_process, stage.get_input_filepaths))
+        for pheno, cost in zip(phenos_to_process, self.parallelizer._get_task_costs(phenos_to_process, stage.get_input_filepaths, stage.cmd)):
+            self.phenos[pheno['phenocode']] = pheno
+            heapq.heappush(self.queued, (-cost, pheno['phenocode']))
+
+class _StepRunner:
+    '''
+    Runs each step in its own process once the steps that it depends on are done, with at most `num_procs` processes in total.
+    A step that runs several processes gets an even share of `num_procs` with the other such steps that are ready or running.
+
+    When there are at least `num_procs` phenos, a per-pheno step (like `manhattan_qq`) runs each pheno in its own process,
+    as soon as the per-pheno steps that it depends on (like `augment_phenos`) have finished that pheno.
+    So some processes can be making manhattan plots while others are still augmenting other phenos
+    (or, with `get_streaming_steps()`, still parsing them).
+    Otherwise, a per-pheno step runs like any other step (so `augment_phenos` and `manhattan_qq` can split large phenos into parts).
+
+    Each line that a job prints is prefixed with the job's name.
+    If a job fails, no more jobs are started, and the running ones are allowed to finish.
+    '''
+    def __init__(self, mysteps:List[Step], num_procs:int):
+        self.steps = mysteps
+        self.num_procs = num_procs
+        self.num_free_procs = num_procs
+        self.pending = list(mysteps)
+        self.done: Set[str] = set(scripts) - set(step.script for step in mysteps)  # skipped steps count as done
+        self.expanded: Dict[str,_ExpandedStep] = {}
+        self.jobs: Dict[int,_Job] = {}  # by sentinel
+        self.outputs: Dict[Any,Tuple[str,bytes]] = {}  # like {connection: (prefix, incomplete_line)}
+        self.failed_job_names: List[str] = []
+
+    def run(self) -> None:
+        start_time = time.time()
+        while True:
+            if not self.failed_job_names: self._start_jobs()
+            if not self.jobs and not self.outputs: break
+            for ready in multiprocessing.connection.wait(list(self.jobs) + list(self.outputs)):
+                # (`_finish_job()` may have already read all of a job's output.)
+                if ready in self.outputs: self._print_output(ready)
+                elif ready in self.jobs: self._finish_job(self.jobs.pop(ready))  # type: ignore
+        if self.failed_job_names:
+            raise PheWebError('`pheweb process` stopped because these failed: {}'.format(', '.join(self.failed_job_names)))
+        if self.pending:
+            raise PheWebError('`pheweb process` finished without running: {}'.format(', '.join(_get_name(step.script) for step in self.pending)))
+        print('==> Completed all steps in {}'.format(fmt_seconds(time.time() - start_time)), flush=True)
+
+    def _start_jobs(self) -> None:
+        # Find the steps whose deps are done.  A per-pheno step can be expanded once its per-pheno deps have been expanded.
+        ready_steps = []
+        for step in list(self.pending):
+            if step.per_pheno and all(dep in self.done or dep in self.expanded for dep in step.deps) and len(get_phenolist()) >= self.num_procs:
+                self.pending.remove(step)
+                self._expand(step)
+            elif all(dep in self.done for dep in step.deps):
+                ready_steps.append(step)
+        num_parallel_groups = (sum(1 for step in ready_steps if step.parallel) +
+                               sum(1 for job in self.jobs.values() if job.pheno is None and job.step.parallel) +
+                               sum(1 for expanded in self.expanded.values() if not expanded.is_done))
+        share = max(1, self.num_procs // max(1, num_parallel_groups))
+        num_available_procs = self.num_free_procs  # This doesn't count procs reserved for a step that's waiting for its share.
+        for step in ready_steps:
+            num_procs = share if step.parallel else 1
+            if num_available_procs >= num_procs:
+                self.pending.remove(step)
+                print('==> Starting `pheweb {}`'.format(_get_name(step.script)) + (' with {} processes'.format(num_procs) if num_procs > 1 else ''), flush=True)
+                self._start_job(step, None, num_procs, _run_script, step.script)
+            num_available_procs -= num_procs
+        # Fill the other procs with phenos, preferring later steps (to finish phenos sooner), and then longer phenos.
+        while num_available_procs > 0:
+            expanded_steps = [expanded for expanded in self.expanded.values() if expanded.queued]
+            if not expanded_steps: break
+            expanded = max(expanded_steps, key=lambda expanded: self.steps.index(expanded.step))
+            _, phenocode = heapq.heappop(expanded.queued)
+            expanded.running.add(phenocode)
+            self._start_job(expanded.step, expanded.phenos[phenocode], 1, _run_pheno_stage, expanded.stage.convert, expanded.phenos[phenocode])
+            num_available_procs -= 1
+
+    def _expand(self, step:Step) -> None:
+        print('==> Starting `pheweb {}` for each pheno once its inputs are ready'.format(_get_name(step.script)), flush=True)
+        expanded = self.expanded[step.script] = _ExpandedStep(step)
+        unfinished_phenocodes_for_dep = {dep: self.expanded[dep].get_unfinished_phenocodes() for dep in step.deps if dep in self.expanded}
+        ready_phenos = []
+        for pheno in get_phenolist():
+            upstream_scripts = set(dep for dep, phenocodes in unfinished_phenocodes_for_dep.items() if pheno['phenocode'] in phenocodes)
+            if upstream_scripts: expanded.waiting[pheno['phenocode']] = upstream_scripts
+            else: ready_phenos.append(pheno)
+        expanded.add_ready_phenos(ready_phenos)
+        self._finish_expanded_if_done(expanded)
+
+    def _start_job(self, step:Step, pheno:Optional[Dict[str,Any]], num_procs:int, f:Callable, *args:Any) -> None:
+        read_conn, write_conn = multiprocessing.Pipe(duplex=False)
+        # so that the child doesn't inherit anything that's waiting to be printed
+        sys.stdout.flush()
+        sys.stderr.flush()
+        proc = multiprocessing.Process(target=_run_job, args=(write_conn, conf.overrides, num_procs, f) + args)
+        proc.start()
+        write_conn.close()
+        job = _Job(proc, read_conn, num_procs, step, pheno, time.time())
+        self.jobs[proc.sentinel] = job
+        self.outputs[read_conn] = ('[{}] '.format(job.get_name()), b'')
+        self.num_free_procs -= num_procs
+
+    def _print_output(self, read_conn:Any) -> None:
+        # The job writes raw bytes to its end of the pipe, so read them with `os.read()` instead of `read_conn.recv()`.
+        prefix, incomplete_line = self.outputs[read_conn]
+        data = os.read(read_conn.fileno(), 2**16)
+        lines = (incomplete_line + data).split(b'\n')
+        if data:
+            self.outputs[read_conn] = (prefix, lines.pop())
+        else:  # The job (and any processes it started) have closed their output.
+            read_conn.close()
+            del self.outputs[read_conn]
+            if not lines[-1]: lines.pop()
+        for line in lines:
+            if line.strip(): sys.stdout.write(prefix + line.decode('utf-8', 'replace') + '\n')
+        sys.stdout.flush()
+
+    def _finish_job(self, job:_Job) -> None:
+        job.proc.join()
+        while job.output_conn in self.outputs and job.output_conn.poll():  # print the rest of its output first
+            self._print_output(job.output_conn)
+        self.num_free_procs += job.num_procs
+        seconds = time.time() - job.start_time
+        expanded = self.expanded.get(job.step.script) if job.pheno is not None else None
+        if expanded is not None and job.pheno is not None: expanded.running.remove(job.pheno['phenocode'])
+        if job.proc.exitcode != 0:
+            print('==> `pheweb {}` failed after {}'.format(job.get_name(), fmt_seconds(seconds)), flush=True)
+            self.failed_job_names.append(job.get_name())
+            return
+
+        if expanded is None or job.pheno is None:
+            self.done.add(job.step.script)
+            print('==> Completed `pheweb {}` in {}'.format(job.get_name(), fmt_seconds(seconds)), flush=True)
+            return
+
+        phenocode = job.pheno['phenocode']
+        expanded.task_seconds.append((phenocode, seconds))
+        expanded.parallelizer._record_builds(expanded.manifest, expanded.stage.cmd, expanded.input_digests, [phenocode])
+        for downstream in self.expanded.values():
+            upstream_scripts = downstream.waiting.get(phenocode)
+            if upstream_scripts is not None and job.step.script in upstream_scripts:
+                upstream_scripts.remove(job.step.script)
+                if not upstream_scripts:
+                    del downstream.waiting[phenocode]
+                    downstream.add_ready_phenos([job.pheno])
+                    self._finish_expanded_if_done(downstream)
+        if time.time() > expanded.last_progress_time + 10:
+            expanded.last_progress_time = time.time()
+            print('[{}] Completed {} phenos ({} in progress, {} queued, {} waiting for inputs)'.format(
+                _get_name(job.step.script), len(expanded.task_seconds), len(expanded.running), len(expanded.queued), len(expanded.waiting)), flush=True)
+        self._finish_expanded_if_done(expanded)
+
+    def _finish_expanded_if_done(self, expanded:_ExpandedStep) -> None:
+        if expanded.is_done or expanded.get_unfinished_phenocodes(): return
+        expanded.is_done = True
+        self.done.add(expanded.step.script)
+        expanded.parallelizer._save_task_seconds(expanded.stage.cmd, expanded.task_seconds)
+        print('==> Completed `pheweb {}` in {} ({} phenos, {} already done)'.format(
+            _get_name(expanded.step.script), fmt_seconds(time.time() - expanded.start_time), len(expanded.task_seconds), expanded.num_already_done), flush=True)
+
+
+def _run_job(write_conn:Any, parent_overrides:Dict[str,Any], num_procs:int, f:Callable, *args:Any) -> None:
+    os.dup2(write_conn.fileno(), 1)
+    os.dup2(write_conn.fileno(), 2)
+    write_conn.close()
+    sys.stdout.reconfigure(line_buffering=True)  # type: ignore
+    conf.overrides.update(parent_overrides)
+    # Limit this job to its share of `num_procs`, including for any commands with their own `num_procs`.
+    own_num_procs = conf.overrides.get('num_procs')
+    limited_num_procs = {'*': num_procs}
+    if isinstance(own_num_procs, dict):
+        limited_num_procs.update({cmd: min(int(n), num_procs) for cmd, n in own_num_procs.items() if cmd != '*'})
+    conf.overrides['num_procs'] = limited_num_procs
+    f(*args)
+
+def _run_pheno_stage(convert:Callable, pheno:Dict[str,Any]) -> None:
+    x = convert(pheno)
+    if isinstance(x, GeneratorType):
+        for _ in x: pass
@@ -3,30 +3,36 @@
 This script creates json files which can be used to render QQ plots.
 '''
 
-# TODO: share the `VariantFileReader` with `manhattan.py`.
+# Note: `pheweb manhattan-qq` makes these json files in the same pass over each pheno_gz file as the manhattan json files.
 # TODO: make gc_lambda for maf strata, and show them if they're >1.1?
 # TODO: copy some changes from <https://github.com/statgen/encore/blob/master/plot-epacts-output/make_qq_json.py>
 
-# TODO: Reduce memory usage by binning the (twosigfigs(maf), rounded(neglogpval,2)) for all variants with neglogpval<2.
-#       If manhattan and qq were computed together, we could re-use some information from the first pass.
+# Note: with `approximate_qq`, `QQSketch` bins the (maf, rounded(neglogpval,2)) for all variants with neglogpval<2, to reduce memory usage.
 
 
 # NOTE: `qval` means `-log10(pvalue)`
 
 from ..utils import round_sig, approx_equal, get_phenolist, PheWebError
-from ..file_utils import VariantFileReader, write_json, get_pheno_filepath
-from .load_utils import get_maf, parallelize_per_pheno, get_phenos_subset
+from .. import conf
+from ..file_utils import VariantFileReader, BinaryVariantFileReader, is_binary_variant_file, write_json, get_pheno_filepath
+from .load_utils import get_maf, get_maf_array, parallelize_per_pheno, get_phenos_subset
 
-from typing import Dict,Any,List,Iterator,Set,Tuple
+from typing import Dict,Any,List,Iterator,Tuple,Callable,Optional
 import argparse, itertools
+import array
 import boltons.mathutils
-import boltons.iterutils
 import math
 import scipy.stats
 import numpy as np
 
 NUM_BINS = 400
 NUM_MAF_RANGES = 4
+QQ_CHUNK_SIZE = 2**20
+# For `approximate_qq`, see `QQSketch`:
+APPROX_QQ_QVAL_CUTOFF = 2
+APPROX_QQ_QVAL_BIN_WIDTH = 0.01
+APPROX_QQ_MAF_BINS_PER_DECADE = 100
+APPROX_QQ_MIN_LOG10_MAF = -8
 
 
 def run(argv:List[str]) -> None:
@@ -44,19 +50,27 @@ def run(argv:List[str]) -> None:
         phenos = phenos,
     )
 
-def get_input_filepaths(pheno:dict) -> List[str]: return [get_pheno_filepath('pheno_gz', pheno['phenocode'])]
+def get_input_filepaths(pheno:dict) -> List[str]: return [get_pheno_filepath(_get_input_kind(), pheno['phenocode'])]
 def get_output_filepaths(pheno:dict) -> List[str]: return [get_pheno_filepath('qq', pheno['phenocode'], must_exist=False)]
+def _get_input_kind() -> str: return 'pheno_bin' if conf.should_write_binary_variant_files() else 'pheno_gz'
 
 def make_json_file(pheno:Dict[str,Any]) -> None:
     make_json_file_explicit(
-        get_pheno_filepath('pheno_gz', pheno['phenocode']),
+        get_pheno_filepath(_get_input_kind(), pheno['phenocode']),
         get_pheno_filepath('qq', pheno['phenocode'], must_exist=False),
         pheno
     )
 
 def make_json_file_explicit(in_filepath:str, out_filepath:str, pheno:Dict[str,Any]) -> None:
+    if conf.should_approximate_qq():
+        write_json(filepath=out_filepath, data=get_qq_sketch(in_filepath, pheno).get_qq_data())
+        return
     # Store all variants in a dataframe with columns (qval, maf) or just (qval)
     variants = get_variants_df(in_filepath, pheno)
+    write_json(filepath=out_filepath, data=get_qq_data(variants))
+
+def get_qq_data(variants:np.ndarray) -> Dict[str,Any]:
+    '''Returns the data for the QQ json file, given a dataframe like `get_variants_df()` returns.  This sorts `variants`.'''
     rv: Dict[str,Any] = {}
     if 'maf' in variants.dtype.fields:  # type:ignore
         rv['by_maf'] = make_qq_stratified(variants)
@@ -65,7 +79,7 @@ def make_json_file_explicit(in_filepath:str, out_filepath:str, pheno:Dict[str,An
     else:
         rv['overall'] = make_qq_unstratified(variants, include_qq=True)
         rv['ci'] = list(get_confidence_intervals(len(variants)))
-    write_json(filepath=out_filepath, data=rv)
+    return rv
 
 def get_variants_df(in_filepath:str, pheno:Dict[str,Any]) -> np.ndarray:
     # I'm making a dataframe with either the columns [qval maf] or just [qval], depending on whether we can calculate maf from the fields we have.
@@ -73,6 +87,8 @@ def get_variants_df(in_filepath:str, pheno:Dict[str,Any]) -> np.ndarray:
     # I'm avoid pandas because it's a little fragile and magic and it was broken on my mac.
     # And anyways pd.DataFrame() allows passing in an iterator, but then it just calls list() on it, so it temporarily uses python's list overhead.
     # Instead, I'm using np.fromiter() to make a "structured array".
+    if is_binary_variant_file(in_filepath):
+        return get_variants_df_from_binary(in_filepath, pheno)
     with VariantFileReader(in_filepath) as variant_dicts:
         try: first_variant = next(iter(variant_dicts))
         except StopIteration: raise PheWebError("No variants found in {}".format(in_filepath))
@@ -87,6 +103,44 @@ def get_maf_qval_pairs(in_filepath:str, pheno:Dict[str,Any]) -> Iterator[Tuple[f
             maf: float = get_maf(v, pheno) or 0
             qval: float = 1000 if v['pval']==0 else -math.log10(v['pval'])
             yield (maf, qval)
+def get_variants_df_from_binary(in_filepath:str, pheno:Dict[str,Any]) -> np.ndarray:
+    # Same as `get_variants_df()`, but with whole columns at a time.
+    with BinaryVariantFileReader(in_filepath) as reader:
+        blocks = list(reader.get_blocks())
+    if not blocks: raise PheWebError("No variants found in {}".format(in_filepath))
+    has_maf = get_maf_array(blocks[0], pheno, is_checked=np.zeros(len(blocks[0]['pval']), dtype=bool)) is not None
+    variants = np.empty(sum(len(block['pval']) for block in blocks), dtype=[('maf',np.float32),('qval',np.float32)] if has_maf else [('qval',np.float32)])
+    offset = 0
+    for block in blocks:
+        block_slice = slice(offset, offset + len(block['pval']))
+        with np.errstate(divide='ignore'):
+            variants['qval'][block_slice] = np.where(block['pval']==0, 1000, -np.log10(block['pval']))
+        if has_maf:
+            variants['maf'][block_slice] = get_maf_array(block, pheno, is_checked=np.ones(len(block['pval']), dtype=bool))
+        offset = block_slice.stop
+    return variants
+
+def get_qq_sketch(in_filepath:str, pheno:Dict[str,Any]) -> 'QQSketch':
+    # Like `get_variants_df()`, but only ever holds one chunk of variants (plus the few with large qvals).
+    if is_binary_variant_file(in_filepath):
+        with BinaryVariantFileReader(in_filepath) as reader:
+            sketch = None
+            for block in reader.get_blocks():
+                mafs = get_maf_array(block, pheno, is_checked=np.ones(len(block['pval']), dtype=bool))
+                if sketch is None: sketch = QQSketch(has_maf=mafs is not None)
+                with np.errstate(divide='ignore'):
+                    sketch.add(np.where(block['pval']==0, 1000, -np.log10(block['pval'])), mafs)
+        if sketch is None: raise PheWebError("No variants found in {}".format(in_filepath))
+        return sketch
+    with VariantFileReader(in_filepath) as variant_dicts:
+        try: first_variant = next(iter(variant_dicts))
+        except StopIteration: raise PheWebError("No variants found in {}".format(in_filepath))
+    sketch = QQSketch(has_maf=get_maf(first_variant, pheno) is not None)
+    maf_qval_pairs = get_maf_qval_pairs(in_filepath, pheno)
+    while True:
+        chunk = np.fromiter(itertools.islice(maf_qval_pairs, QQ_CHUNK_SIZE), dtype=[('maf',np.float32),('qval',np.float32)])
+        if len(chunk) == 0: return sketch
+        sketch.add(chunk['qval'], chunk['maf'] if sketch.has_maf else None)
 
 
 def make_qq_stratified(variants:np.ndarray) -> List[Dict[str,Any]]:
@@ -120,25 +174,207 @@ def make_qq_unstratified(variants:np.ndarray, include_qq:bool) -> Dict[str,Any]:
     if include_qq:
         rv['qq'] = compute_qq(qvals)
     rv['count'] = len(qvals)
-    rv['gc_lambda'] = {}
+    rv['gc_lambda'] = make_gc_lambdas(lambda quantile: gc_value_from_list(qvals, quantile))
+    return rv
+
+def make_gc_lambdas(get_gc_value:Callable[[float],float]) -> Dict[str,float]:
+    rv: Dict[str,float] = {}
     for perc in ['0.5', '0.1', '0.01', '0.001']:
-        gc = gc_value_from_list(qvals, float(perc))
+        gc = get_gc_value(float(perc))
         if math.isnan(gc) or abs(gc) == math.inf:
             print('WARNING: got gc_value {!r}'.format(gc))
         else:
-            rv['gc_lambda'][perc] = round_sig(gc, 5)
+            rv[perc] = round_sig(gc, 5)
     return rv
 
 
+class QQSketch:
+    '''
+    Summarizes the qvals (and mafs) of a phenotype's variants in bounded memory, for `approximate_qq`.
+
+    Variants with `qval < APPROX_QQ_QVAL_CUTOFF` are only counted, in histograms with bins `APPROX_QQ_QVAL_BIN_WIDTH` wide.
+    Under the null, that's ~99% of variants.  Variants with larger qvals are kept exactly.
+    Mafs are counted in log-spaced bins (`APPROX_QQ_MAF_BINS_PER_DECADE` per decade), which act as a quantile sketch for the maf strata.
+    There's one qval histogram per maf bin, so that each maf stratum gets exactly the qvals of its variants.
+
+    Compared to `get_qq_data()`:
+      - each qval below the cutoff (including the ones used for gc_lambda) is off by at most `APPROX_QQ_QVAL_BIN_WIDTH/2`.
+      - each maf stratum has the same count, but variants whose mafs are within one maf bin (~2.3%) of a boundary between strata
+        may be in either stratum, so `maf_range` may be off by that much.
+    '''
+    def __init__(self, has_maf:bool):
+        self.has_maf = has_maf
+        self._num_maf_bins = 2 + -APPROX_QQ_MIN_LOG10_MAF * APPROX_QQ_MAF_BINS_PER_DECADE if has_maf else 1  # bin 0 is for maf=0
+        self._num_qval_bins = 1 + int(round(APPROX_QQ_QVAL_CUTOFF / APPROX_QQ_QVAL_BIN_WIDTH))
+        self._hist = np.zeros((self._num_maf_bins, self._num_qval_bins), dtype=np.int64)
+        self._min_mafs = np.full(self._num_maf_bins, np.inf, dtype=np.float32)
+        self._max_mafs = np.full(self._num_maf_bins, -np.inf, dtype=np.float32)
+        self._tail_qvals = array.array('f')
+        self._tail_maf_bins = array.array('H')
+
+    def add(self, qvals:np.ndarray, mafs:Optional[np.ndarray] = None) -> None:
+        qvals = np.asarray(qvals, dtype=np.float32)
+        if self.has_maf:
+            assert mafs is not None
+            mafs = np.asarray(mafs, dtype=np.float32)
+            maf_bins = self._get_maf_bins(mafs)
+            np.minimum.at(self._min_mafs, maf_bins, mafs)
+            np.maximum.at(self._max_mafs, maf_bins, mafs)
+        else:
+            maf_bins = np.zeros(len(qvals), dtype=np.int64)
+        is_tail = qvals >= APPROX_QQ_QVAL_CUTOFF
+        self._tail_qvals.frombytes(qvals[is_tail].tobytes())
+        self._tail_maf_bins.frombytes(maf_bins[is_tail].astype(np.uint16).tobytes())
+        qval_bins = np.clip(np.rint(qvals[~is_tail] / APPROX_QQ_QVAL_BIN_WIDTH), 0, self._num_qval_bins-1).astype(np.int64)
+        self._hist += np.bincount(maf_bins[~is_tail] * self._num_qval_bins + qval_bins, minlength=self._hist.size).reshape(self._hist.shape)
+
+    def merge(self, other:'QQSketch') -> None:
+        '''Adds the variants that `other` summarized, as if they'd been passed to `self.add()`.'''
+        if other.has_maf != self.has_maf: raise PheWebError("Can't merge a QQSketch with mafs and one without")
+        self._hist += other._hist
+        np.minimum(self._min_mafs, other._min_mafs, out=self._min_mafs)
+        np.maximum(self._max_mafs, other._max_mafs, out=self._max_mafs)
+        self._tail_qvals.extend(other._tail_qvals)
+        self._tail_maf_bins.extend(other._tail_maf_bins)
+
+    def _get_maf_bins(self, mafs:np.ndarray) -> np.ndarray:
+        maf_bins = np.zeros(len(mafs), dtype=np.int64)
+        is_positive = mafs > 0
+        log_bins = np.floor((np.log10(mafs[is_positive]) - APPROX_QQ_MIN_LOG10_MAF) * APPROX_QQ_MAF_BINS_PER_DECADE)
+        maf_bins[is_positive] = 1 + np.clip(log_bins, 0, self._num_maf_bins-2).astype(np.int64)
+        return maf_bins
+
+    def get_qq_data(self) -> Dict[str,Any]:
+        '''Returns the same structure as `get_qq_data()`.'''
+        # For each maf bin, the qvals are a run for each histogram bin, followed by a run of one for each tail variant.
+        hist_qvals = np.arange(self._num_qval_bins) * APPROX_QQ_QVAL_BIN_WIDTH
+        tail_qvals = np.frombuffer(self._tail_qvals, dtype=np.float32).astype(np.float64)
+        tail_maf_bins = np.frombuffer(self._tail_maf_bins, dtype=np.uint16)
+        tail_order = np.argsort(tail_maf_bins, kind='stable')
+        tail_bin_starts = np.searchsorted(tail_maf_bins[tail_order], np.arange(self._num_maf_bins+1))
+        bin_runs = []
+        for maf_bin in range(self._num_maf_bins):
+            bin_tail_qvals = tail_qvals[tail_order[tail_bin_starts[maf_bin]:tail_bin_starts[maf_bin+1]]]
+            bin_runs.append((np.concatenate([hist_qvals, bin_tail_qvals]),
+                             np.concatenate([self._hist[maf_bin], np.ones(len(bin_tail_qvals), dtype=np.int64)])))
+        num_variants = int(self._hist.sum()) + len(tail_qvals)
+        if num_variants == 0: raise PheWebError("No variants found")
+
+        rv: Dict[str,Any] = {}
+        if self.has_maf:
+            strata = self._get_strata(bin_runs, num_variants)
+            rv['by_maf'] = [{
+                'maf_range': stratum['maf_range'],
+                'count': int(stratum['counts'].sum()),
+                'qq': compute_qq_from_counts(stratum['qvals'], stratum['counts']),
+            } for stratum in strata]
+            qvals, counts = _merge_runs([(stratum['qvals'], stratum['counts']) for stratum in strata])
+            rv['overall'] = {'count': num_variants, 'gc_lambda': self._make_gc_lambdas(qvals, counts)}
+            rv['ci'] = list(get_confidence_intervals(num_variants / len(rv['by_maf'])))
+        else:
+            qvals, counts = _merge_runs(bin_runs)
+            rv['overall'] = {'qq': compute_qq_from_counts(qvals, counts), 'count': num_variants, 'gc_lambda': self._make_gc_lambdas(qvals, counts)}
+            rv['ci'] = list(get_confidence_intervals(num_variants))
+        return rv
+
+    def _get_strata(self, bin_runs:List[Tuple[np.ndarray,np.ndarray]], num_variants:int) -> List[Dict[str,Any]]:
+        # Like `make_qq_stratified()`, stratum `i` gets the variants from `num_variants*i//NUM_MAF_RANGES` to `num_variants*(i+1)//NUM_MAF_RANGES` in order of maf.
+        # When a maf bin is split between strata, each stratum gets the same fraction of each of its runs, so that the split doesn't depend on qval.
+        stratum_sizes = [num_variants*(i+1)//NUM_MAF_RANGES - num_variants*i//NUM_MAF_RANGES for i in range(NUM_MAF_RANGES)]
+        strata: List[Dict[str,Any]] = [{'runs': [], 'min_maf': math.inf, 'max_maf': -math.inf} for _ in range(NUM_MAF_RANGES)]
+        stratum_idx, num_left_in_stratum = 0, stratum_sizes[0]
+        for maf_bin, (qvals, counts) in enumerate(bin_runs):
+            while counts.sum() > 0:
+                while num_left_in_stratum == 0:
+                    stratum_idx += 1
+                    num_left_in_stratum = stratum_sizes[stratum_idx]
+                taken_counts = counts if counts.sum() <= num_left_in_stratum else _split_counts(counts, num_left_in_stratum)
+                strata[stratum_idx]['runs'].append((qvals, taken_counts))
+                strata[stratum_idx]['min_maf'] = min(strata[stratum_idx]['min_maf'], float(self._min_mafs[maf_bin]))
+                strata[stratum_idx]['max_maf'] = max(strata[stratum_idx]['max_maf'], float(self._max_mafs[maf_bin]))
+                counts = counts - taken_counts
+                num_left_in_stratum -= int(taken_counts.sum())
+        for stratum in strata:
+            stratum['qvals'], stratum['counts'] = _merge_runs(stratum['runs'])
+            stratum['maf_range'] = (stratum['min_maf'], stratum['max_maf'])
+        # A stratum is only empty if there are fewer than NUM_MAF_RANGES variants, so it just borrows the next stratum's maf.
+        for i in reversed(range(NUM_MAF_RANGES-1)):
+            if strata[i]['min_maf'] == math.inf: strata[i]['maf_range'] = (strata[i+1]['min_maf'],)*2
+        return strata
+
+    def _make_gc_lambdas(self, qvals:np.ndarray, counts:np.ndarray) -> Dict[str,float]:
+        # Like `gc_value_from_list()`, using the qval of the variant at `int(num_variants * quantile)`.
+        cumulative_counts = np.cumsum(counts)
+        def get_gc_value(quantile:float) -> float:
+            qval = qvals[np.searchsorted(cumulative_counts, int(cumulative_counts[-1] * quantile), side='right')]
+            return gc_value(10 ** -qval, quantile)
+        return make_gc_lambdas(get_gc_value)
+
+def _split_counts(counts:np.ndarray, num:int) -> np.ndarray:
+    '''Returns counts that add up to `num`, each at most (and roughly proportional to) the corresponding one of `counts`.'''
+    exact = counts * (num / counts.sum())
+    rv = np.floor(exact).astype(np.int64)
+    rv[np.argsort(rv - exact, kind='stable')[:num - rv.sum()]] += 1
+    return rv
+
+def _merge_runs(runs:List[Tuple[np.ndarray,np.ndarray]]) -> Tuple[np.ndarray,np.ndarray]:
+    '''Combines runs `(qvals, counts)` into one run for each distinct qval, in decreasing order of qval.'''
+    qvals, idxs = np.unique(np.concatenate([run[0] for run in runs]), return_inverse=True)
+    counts = np.bincount(idxs, weights=np.concatenate([run[1] for run in runs]), minlength=len(qvals)).astype(np.int64)
+    is_nonempty = counts > 0
+    return qvals[is_nonempty][::-1], counts[is_nonempty][::-1]
+
+
 def compute_qq(qvals:np.ndarray) -> Dict[str,Any]:
     # qvals must be in decreasing order.
     # Decreasing order (from strongest pvalue to weakest) works well because we it lets us use `(idx+0.5)/len(qvals)` as the expected pvalue.
-    assert all(a >= b for a,b in boltons.iterutils.pairwise_iter(qvals))
+    assert np.all(np.diff(qvals) <= 0)
 
     if len(qvals) == 0 or qvals[0] == 0:
         return {}  # the js detects that the values for each key are undefined
 
     max_exp_qval = -math.log10(0.5 / len(qvals))
+    max_obs_qval = _get_max_obs_qval(qvals, max_exp_qval)
+
+    # Each occupied bin `(exp_bin, obs_bin)` is packed into one int, so that `np.unique()` can find them.
+    occupied_bins = np.unique(np.concatenate([
+        _get_packed_bins(qvals, start, min(start + QQ_CHUNK_SIZE, len(qvals)), max_exp_qval, max_obs_qval)
+        for start in range(0, len(qvals), QQ_CHUNK_SIZE)
+    ]))
+    return _unpack_bins(occupied_bins, max_exp_qval, max_obs_qval)
+
+def compute_qq_from_counts(qvals:np.ndarray, counts:np.ndarray) -> Dict[str,Any]:
+    '''Like `compute_qq(np.repeat(qvals, counts))`, but without making that array.'''
+    # qvals must be in strictly decreasing order.
+    assert np.all(np.diff(qvals) < 0) and np.all(counts > 0)
+    num_variants = int(counts.sum())
+    if num_variants == 0 or qvals[0] == 0:
+        return {}
+
+    max_exp_qval = -math.log10(0.5 / num_variants)
+    max_obs_qval = _get_max_obs_qval(qvals, max_exp_qval)
+    is_shown = ~(qvals > max_obs_qval)
+    obs_bins = (qvals / max_obs_qval * NUM_BINS).astype(np.int64)
+    last_idxs = np.cumsum(counts) - 1
+
+    # After the first `num_separate` variants, consecutive variants are less than one `exp_bin` apart,
+    # so a run of variants occupies every `exp_bin` from its last variant to its first.
+    # Before that, variants can skip `exp_bin`s, so they're binned separately, like `compute_qq()` does.
+    num_separate = min(num_variants, math.ceil(NUM_BINS / (max_exp_qval * math.log(10))))
+    separate_idxs = np.arange(num_separate)
+    separate_runs = np.searchsorted(last_idxs, separate_idxs)
+    separate_idxs, separate_runs = separate_idxs[is_shown[separate_runs]], separate_runs[is_shown[separate_runs]]
+    packed_bins = [_get_exp_bins(separate_idxs, num_variants, max_exp_qval) * (NUM_BINS+1) + obs_bins[separate_runs]]
+
+    is_expanded = is_shown & (last_idxs >= num_separate)
+    first_exp_bins = _get_exp_bins(np.maximum(last_idxs - counts + 1, num_separate)[is_expanded], num_variants, max_exp_qval)
+    last_exp_bins = _get_exp_bins(last_idxs[is_expanded], num_variants, max_exp_qval)
+    run_lengths = first_exp_bins - last_exp_bins + 1
+    run_offsets = np.arange(run_lengths.sum()) - np.repeat(np.cumsum(run_lengths) - run_lengths, run_lengths)
+    packed_bins.append((np.repeat(last_exp_bins, run_lengths) + run_offsets) * (NUM_BINS+1) + np.repeat(obs_bins[is_expanded], run_lengths))
+    return _unpack_bins(np.unique(np.concatenate(packed_bins)), max_exp_qval, max_obs_qval)
+
+def _get_max_obs_qval(qvals:np.ndarray, max_exp_qval:float) -> Any:
     # Our QQ plot will only show `obs_qval` up to `ceil(2*max_exp_pval)`.
     # So we can drop any obs_qval above that, to save space and make sure the visible range gets all the NUM_BINS.
 
@@ -148,23 +384,16 @@ def compute_qq(qvals:np.ndarray) -> Dict[str,Any]:
                                            lower = max_exp_qval,
                                            upper = math.ceil(2*max_exp_qval))
     if qvals[0] > max_obs_qval:
-        for qval in qvals:
-            if qval <= max_obs_qval:
-                max_obs_qval = qval
-                break
-
-    occupied_bins: Set[Tuple[int,int]] = set()
-    for i, obs_qval in enumerate(qvals):
-        if obs_qval > max_obs_qval: continue
-        exp_qval = -math.log10( (i+0.5) / len(qvals))
-        exp_bin = int(exp_qval / max_exp_qval * NUM_BINS)
-        # TODO: it'd be great if the `obs_bin`s started right at the lowest qval in that `exp_bin`.
-        #       that way we could have fewer bins but still get a nice straight diagonal line without that stair-stepping appearance.
-        obs_bin = int(obs_qval / max_obs_qval * NUM_BINS)
-        occupied_bins.add( (exp_bin,obs_bin) )
-
+        # `qvals` is decreasing, so `-qvals` is increasing and we can find the first `qval <= max_obs_qval` by bisection.
+        neg_qvals, neg_max_obs_qval = _with_scalar_precision(-qvals, -max_obs_qval)
+        idx = np.searchsorted(neg_qvals, neg_max_obs_qval, side='left')
+        if idx < len(qvals):
+            max_obs_qval = qvals[idx]
+    return max_obs_qval
+
+def _unpack_bins(occupied_bins:np.ndarray, max_exp_qval:float, max_obs_qval:Any) -> Dict[str,Any]:
     bins = []
-    for exp_bin, obs_bin in occupied_bins:
+    for exp_bin, obs_bin in zip((occupied_bins // (NUM_BINS+1)).tolist(), (occupied_bins % (NUM_BINS+1)).tolist()):
         assert 0 <= exp_bin <= NUM_BINS, exp_bin
         assert 0 <= obs_bin <= NUM_BINS, obs_bin
         bins.append((
@@ -177,10 +406,44 @@ def compute_qq(qvals:np.ndarray) -> Dict[str,Any]:
         'max_exp_qval': max_exp_qval,
     }
 
-
-def gc_value_from_list(qvals:List[float], quantile:float = 0.5) -> float:
+def _get_packed_bins(qvals:np.ndarray, start:int, stop:int, max_exp_qval:float, max_obs_qval:Any) -> np.ndarray:
+    '''Returns `exp_bin * (NUM_BINS+1) + obs_bin` for each of `qvals[start:stop]` that's shown in the plot.'''
+    # Work on one chunk at a time, so that the float64 temporaries stay small even when `qvals` has 100M variants.
+    obs_qvals, max_obs_qval = _with_scalar_precision(qvals[start:stop], max_obs_qval)
+    is_shown = ~(obs_qvals > max_obs_qval)
+    obs_qvals = obs_qvals[is_shown]
+    idxs = np.arange(start, stop)[is_shown]
+
+    exp_bins = _get_exp_bins(idxs, len(qvals), max_exp_qval)
+
+    # TODO: it'd be great if the `obs_bin`s started right at the lowest qval in that `exp_bin`.
+    #       that way we could have fewer bins but still get a nice straight diagonal line without that stair-stepping appearance.
+    obs_ratios = obs_qvals / max_obs_qval
+    obs_ratios, num_bins = _with_scalar_precision(obs_ratios, NUM_BINS)
+    obs_bins = (obs_ratios * num_bins).astype(np.int64)
+    return exp_bins * (NUM_BINS+1) + obs_bins
+
+def _get_exp_bins(idxs:np.ndarray, num_variants:int, max_exp_qval:float) -> np.ndarray:
+    '''Returns `int(exp_qval / max_exp_qval * NUM_BINS)` for the variant at each of `idxs`.'''
+    exp_scaled = -np.log10((idxs + 0.5) / num_variants) / max_exp_qval * NUM_BINS
+    exp_bins = exp_scaled.astype(np.int64)
+    # `np.log10()` and `math.log10()` might disagree in the last bit, which only matters right next to a bin boundary.
+    for i in np.flatnonzero(np.abs(exp_scaled - np.rint(exp_scaled)) < 1e-9):
+        exp_bins[i] = int(-math.log10((int(idxs[i]) + 0.5) / num_variants) / max_exp_qval * NUM_BINS)
+    return exp_bins
+
+def _with_scalar_precision(arr:np.ndarray, x:Any) -> Tuple[np.ndarray,Any]:
+    '''
+    Returns `arr` and `x` converted to the type that numpy uses for arithmetic between `arr[0]` and `x`, so that operations on the whole array
+    round exactly like the same operations on each element would.  (eg, `np.float32 / float` is done in float64, but `np.ndarray[float32] / float` isn't.)
+    '''
+    scalar_type = type(arr.dtype.type(1) * x)
+    return arr.astype(scalar_type, copy=False), scalar_type(x)
+
+
+def gc_value_from_list(qvals:np.ndarray, quantile:float = 0.5) -> float:
     # qvals must be in decreasing order.
-    assert all(a >= b for a,b in boltons.iterutils.pairwise_iter(qvals))
+    assert np.all(np.diff(qvals) <= 0)
     qval = qvals[int(len(qvals) * quantile)]
     pval = 10 ** -qval
     return gc_value(pval, quantile)
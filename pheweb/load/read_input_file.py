@@ -2,12 +2,16 @@
 from ..utils import chrom_order, chrom_order_list, chrom_aliases, PheWebError
 from .. import parse_utils
 from .. import conf
-from ..file_utils import read_maybe_gzip
-from .load_utils import get_maf
+from ..file_utils import read_maybe_gzip, read_maybe_gzip_threaded
+from .load_utils import get_maf, get_maf_array
 
 import itertools
 import re
 import boltons.iterutils
+import numpy as np
+
+
+COLUMNAR_CHUNK_NUM_LINES = 100_000
 
 
 class PhenoReader:
@@ -17,18 +21,25 @@ class PhenoReader:
     If `minimum_maf` is defined, variants that don't meet that threshold (via MAF, AF, or AC/NS) are dropped.
     '''
 
-    def __init__(self, pheno, minimum_maf=0):
+    def __init__(self, pheno, minimum_maf=0, config=None):
         self._pheno = pheno
         self._minimum_maf = minimum_maf or 0
+        self._config = config or conf.get_loading_config()
         self.fields, self.filepaths = self._get_fields_and_filepaths(pheno['assoc_files'])
 
     def get_variants(self):
         yield from self._order_refalt_lexicographically(
             itertools.chain.from_iterable(
-                AssocFileReader(filepath, self._pheno).get_variants(minimum_maf=self._minimum_maf) for filepath in self.filepaths))
+                AssocFileReader(filepath, self._pheno, self._config).get_variants(minimum_maf=self._minimum_maf) for filepath in self.filepaths))
+
+    def get_variant_columns(self):
+        '''Like `get_variants()`, but yields chunks of variants as columns (see `AssocFileReader.get_variant_columns()`).'''
+        yield from self._order_refalt_lexicographically_columns(
+            itertools.chain.from_iterable(
+                AssocFileReader(filepath, self._pheno, self._config).get_variant_columns(minimum_maf=self._minimum_maf) for filepath in self.filepaths))
 
     def get_info(self):
-        infos = [AssocFileReader(filepath, self._pheno).get_info() for filepath in self.filepaths]
+        infos = [AssocFileReader(filepath, self._pheno, self._config).get_info() for filepath in self.filepaths]
         for info in infos[1:]:
             if info != infos[0]:
                 raise PheWebError(
@@ -59,11 +70,69 @@ class PhenoReader:
             for v in sorted(tied_variants, key=lambda v:(v['ref'], v['alt'])):
                 yield v
 
+    def _order_refalt_lexicographically_columns(self, chunks):
+        # Same as `_order_refalt_lexicographically()`, but for chunks of columns.
+        # The variants at the last chrom-pos of each chunk are held back, because the next chunk might have more variants at that chrom-pos.
+        prev_chrom_index, prev_pos = -1, -1
+        held_back = None
+        for chunk in itertools.chain(chunks, [None]):
+            if chunk is None:
+                if held_back is None: return
+                chunk, held_back = held_back, None
+                is_last_chunk = True
+            else:
+                if held_back is not None: chunk, held_back = {field: held_back[field] + chunk[field] for field in chunk}, None
+                is_last_chunk = False
+            num_variants = len(chunk['chrom'])
+            if num_variants == 0: continue
+
+            # `dict.fromkeys()` keeps the order that chroms appear, so an unknown chrom is reported just like in `get_variants()`.
+            chrom_index_for_chrom = {chrom: self._get_chrom_index(chrom) for chrom in dict.fromkeys(chunk['chrom'])}
+            chrom_indexes = np.array([chrom_index_for_chrom[chrom] for chrom in chunk['chrom']], dtype=np.int64)
+            positions = np.array(chunk['pos'], dtype=np.int64)
+            prev_chrom_indexes = np.concatenate(([prev_chrom_index], chrom_indexes[:-1]))
+            prev_positions = np.concatenate(([prev_pos], positions[:-1]))
+            is_chrom_out_of_order = chrom_indexes < prev_chrom_indexes
+            is_pos_out_of_order = (chrom_indexes == prev_chrom_indexes) & (positions < prev_positions)
+            if np.any(is_chrom_out_of_order | is_pos_out_of_order):
+                idx = np.flatnonzero(is_chrom_out_of_order | is_pos_out_of_order)[0]
+                if is_chrom_out_of_order[idx]:
+                    raise PheWebError(
+                        "The chromosomes in your file appear to be in the wrong order.\n" +
+                        "The required order is: {!r}\n".format(chrom_order_list) +
+                        "But in your file, the chromosome {!r} came after the chromosome {!r}\n".format(
+                            chunk['chrom'][idx], chrom_order_list[prev_chrom_indexes[idx]]))
+                raise PheWebError(
+                    "The positions in your file appear to be in the wrong order.\n" +
+                    "In your file, the position {!r} came after the position {!r} on chromsome {!r}\n".format(
+                        chunk['pos'][idx], int(prev_positions[idx]), chunk['chrom'][idx]))
+            prev_chrom_index, prev_pos = int(chrom_indexes[-1]), int(positions[-1])
+
+            is_tied_with_prev = (chrom_indexes[1:] == chrom_indexes[:-1]) & (positions[1:] == positions[:-1])
+            if not is_last_chunk:
+                num_to_hold_back = 1
+                while num_to_hold_back < num_variants and is_tied_with_prev[-num_to_hold_back]: num_to_hold_back += 1
+                held_back = {field: column[-num_to_hold_back:] for field,column in chunk.items()}
+                chunk = {field: column[:-num_to_hold_back] for field,column in chunk.items()}
+                is_tied_with_prev = is_tied_with_prev[:num_variants-num_to_hold_back-1]
+                num_variants -= num_to_hold_back
+                if num_variants == 0: continue
+
+            if np.any(is_tied_with_prev):
+                # Sort each group of tied variants by (ref, alt), like `sorted()` does.
+                order = list(range(num_variants))
+                group_starts = np.flatnonzero(~is_tied_with_prev) + 1
+                for start, end in zip(itertools.chain([0], group_starts), itertools.chain(group_starts, [num_variants])):
+                    if end - start > 1:
+                        order[start:end] = sorted(range(start, end), key=lambda idx:(chunk['ref'][idx], chunk['alt'][idx]))
+                chunk = {field: [column[idx] for idx in order] for field,column in chunk.items()}
+            yield chunk
+
     def _get_fields_and_filepaths(self, filepaths):
         # also sets `self._fields`
         assoc_files = [{'filepath': filepath} for filepath in filepaths]
         for assoc_file in assoc_files:
-            ar = AssocFileReader(assoc_file['filepath'], self._pheno)
+            ar = AssocFileReader(assoc_file['filepath'], self._pheno, self._config)
             v = next(ar.get_variants())
             assoc_file['chrom'], assoc_file['pos'] = v['chrom'], v['pos']
             assoc_file['fields'] = list(v)
@@ -93,10 +162,18 @@ class AssocFileReader:
     # TODO: use `pandas.read_csv(src_filepath, usecols=[...], converters={...}, iterator=True, verbose=True, na_values='.', sep=None)
     #   - first without `usecols`, to parse the column names, and then a second time with `usecols`.
 
-    def __init__(self, filepath, pheno):
+    def __init__(self, filepath, pheno, config=None):
         self.filepath = filepath
         self._pheno = pheno
+        self._config = config or conf.get_loading_config()
+        self._parser_for_field = parse_utils.get_parser_for_field(self._config.pval_is_neglog10)
+        self._column_parser_for_field = parse_utils.get_column_parser_for_field(self._config.pval_is_neglog10)
+        self._num_decompression_threads = conf.get_num_decompression_threads()
 
+    def _open(self):
+        if self._num_decompression_threads > 0:
+            return read_maybe_gzip_threaded(self.filepath, num_threads=self._num_decompression_threads)
+        return read_maybe_gzip(self.filepath)
 
     def get_variants(self, minimum_maf=0, use_per_pheno_fields=False):
         if use_per_pheno_fields:
@@ -104,57 +181,111 @@ class AssocFileReader:
         else:
             fieldnames_to_check = [fieldname for fieldname,fieldval in itertools.chain(parse_utils.per_variant_fields.items(), parse_utils.per_assoc_fields.items()) if fieldval['from_assoc_files']]
 
-        with read_maybe_gzip(self.filepath) as f:
-
-            try:
-                header_line = next(f)
-            except Exception as exc:
-                raise PheWebError("Failed to read from file {} - is it empty?".format(self.filepath)) from exc
-
-            if header_line.count('\t') >= 4: delimiter = '\t'
-            elif header_line.count(' ') >= 4: delimiter = ' '
-            elif header_line.count(',') >= 4: delimiter = ','
-            else: raise PheWebError("Cannot guess what delimiter to use to parse the header line {!r} in file {!r}".format(header_line, self.filepath))
-
-            colnames = [colname.strip('"\' ').lower() for colname in header_line.rstrip('\n\r').split(delimiter)]
-            colidx_for_field = self._parse_header(colnames, fieldnames_to_check)
-            # Special case for `MARKER_ID`
-            if 'marker_id' not in colnames:
-                marker_id_col = None
-            else:
-                marker_id_col = colnames.index('marker_id')
-                colidx_for_field['ref'] = None # This is just to mark that we have 'ref', but it doesn't come from a column.
-                colidx_for_field['alt'] = None
-                # TODO: this sort of provides a mapping for chrom and pos, but those are usually doubled anyways.
-                # TODO: maybe we should allow multiple columns to map to each key, and then just assert that they all agree.
-            self._assert_all_fields_mapped(colnames, fieldnames_to_check, colidx_for_field)
+        with self._open() as f:
+            delimiter, colnames, colidx_for_field, marker_id_col = self._read_header(f, fieldnames_to_check)
 
             if use_per_pheno_fields:
+                parse_variant = self._make_variant_parser(colnames, colidx_for_field)
                 for line in f:
                     values = line.rstrip('\n\r').split(delimiter)
-                    variant = self._parse_variant(values, colnames, colidx_for_field)
+                    variant = parse_variant(values)
                     yield variant
 
             else:
-                for line in f:
-                    values = line.rstrip('\n\r').split(delimiter)
-                    variant = self._parse_variant(values, colnames, colidx_for_field)
-
-                    if variant['pval'] == '': continue
-
-                    maf = get_maf(variant, self._pheno) # checks for agreement
-                    if maf is not None and maf < minimum_maf:
-                        continue
-
-                    if marker_id_col is not None:
-                        chrom2, pos2, variant['ref'], variant['alt'] = AssocFileReader.parse_marker_id(values[marker_id_col])
-                        assert variant['chrom'] == chrom2, (values, variant, chrom2)
-                        assert variant['pos'] == pos2, (values, variant, pos2)
-
-                    if variant['chrom'] in chrom_aliases:
-                        variant['chrom'] = chrom_aliases[variant['chrom']]
+                rows = (line.rstrip('\n\r').split(delimiter) for line in f)
+                yield from self._get_variants_from_rows(rows, colnames, colidx_for_field, marker_id_col, minimum_maf)
+
+    def get_variant_columns(self, minimum_maf=0, chunk_num_lines=None):
+        '''
+        Like `get_variants()`, but yields chunks of variants as columns, like `{'chrom': ['1', '1', ...], 'pos': [869334, 869335, ...], ...}`.
+        Each chunk is parsed by `parse_utils.get_column_parser_for_field()` and filtered with numpy arrays.
+        If anything in a chunk looks unusual, that chunk is re-parsed line-by-line like `get_variants()`, which also reports errors.
+        '''
+        fieldnames_to_check = [fieldname for fieldname,fieldval in itertools.chain(parse_utils.per_variant_fields.items(), parse_utils.per_assoc_fields.items()) if fieldval['from_assoc_files']]
+        with self._open() as f:
+            delimiter, colnames, colidx_for_field, marker_id_col = self._read_header(f, fieldnames_to_check)
+            while True:
+                lines = list(itertools.islice(f, chunk_num_lines or COLUMNAR_CHUNK_NUM_LINES))
+                if not lines: break
+                rows = [line.rstrip('\n\r').split(delimiter) for line in lines]
+                try:
+                    columns = self._get_variant_columns_from_rows(rows, colnames, colidx_for_field, marker_id_col, minimum_maf)
+                except Exception:
+                    variants = list(self._get_variants_from_rows(rows, colnames, colidx_for_field, marker_id_col, minimum_maf))
+                    columns = {field: [variant[field] for variant in variants] for field in colidx_for_field}
+                yield columns
 
-                    yield variant
+    def _read_header(self, f, fieldnames_to_check):
+        try:
+            header_line = next(f)
+        except Exception as exc:
+            raise PheWebError("Failed to read from file {} - is it empty?".format(self.filepath)) from exc
+
+        if header_line.count('\t') >= 4: delimiter = '\t'
+        elif header_line.count(' ') >= 4: delimiter = ' '
+        elif header_line.count(',') >= 4: delimiter = ','
+        else: raise PheWebError("Cannot guess what delimiter to use to parse the header line {!r} in file {!r}".format(header_line, self.filepath))
+
+        colnames = [colname.strip('"\' ').lower() for colname in header_line.rstrip('\n\r').split(delimiter)]
+        colidx_for_field = self._parse_header(colnames, fieldnames_to_check)
+        # Special case for `MARKER_ID`
+        if 'marker_id' not in colnames:
+            marker_id_col = None
+        else:
+            marker_id_col = colnames.index('marker_id')
+            colidx_for_field['ref'] = None # This is just to mark that we have 'ref', but it doesn't come from a column.
+            colidx_for_field['alt'] = None
+            # TODO: this sort of provides a mapping for chrom and pos, but those are usually doubled anyways.
+            # TODO: maybe we should allow multiple columns to map to each key, and then just assert that they all agree.
+        self._assert_all_fields_mapped(colnames, fieldnames_to_check, colidx_for_field)
+        return delimiter, colnames, colidx_for_field, marker_id_col
+
+    def _get_variants_from_rows(self, rows, colnames, colidx_for_field, marker_id_col, minimum_maf):
+        parse_variant = self._make_variant_parser(colnames, colidx_for_field)
+        for values in rows:
+            variant = parse_variant(values)
+
+            if variant['pval'] == '': continue
+
+            maf = get_maf(variant, self._pheno) # checks for agreement
+            if maf is not None and maf < minimum_maf:
+                continue
+
+            if marker_id_col is not None:
+                chrom2, pos2, variant['ref'], variant['alt'] = AssocFileReader.parse_marker_id(values[marker_id_col])
+                assert variant['chrom'] == chrom2, (values, variant, chrom2)
+                assert variant['pos'] == pos2, (values, variant, pos2)
+
+            if variant['chrom'] in chrom_aliases:
+                variant['chrom'] = chrom_aliases[variant['chrom']]
+
+            yield variant
+
+    def _get_variant_columns_from_rows(self, rows, colnames, colidx_for_field, marker_id_col, minimum_maf):
+        # This must match `_get_variants_from_rows()`, but it doesn't need to explain problems, because that's done by re-parsing with `_get_variants_from_rows()`.
+        if any(len(values) != len(colnames) for values in rows): raise PheWebError("wrong number of values")
+        unparsed_columns = list(zip(*rows))
+        columns = {field: self._column_parser_for_field[field](unparsed_columns[colidx])
+                   for field, colidx in colidx_for_field.items() if colidx is not None}
+
+        is_kept = np.array([pval != '' for pval in columns['pval']], dtype=bool)
+        mafs = get_maf_array(columns, self._pheno, is_kept) # checks for agreement
+        if mafs is not None:
+            is_kept &= ~(mafs < minimum_maf)
+        is_kept_list = is_kept.tolist()
+        columns = {field: list(itertools.compress(column, is_kept_list)) for field,column in columns.items()}
+
+        if marker_id_col is not None:
+            cpras = [AssocFileReader.parse_marker_id(marker_id) for marker_id in itertools.compress(unparsed_columns[marker_id_col], is_kept_list)]
+            if [cpra[0] for cpra in cpras] != columns['chrom'] or [cpra[1] for cpra in cpras] != columns['pos']:
+                raise PheWebError("MARKER_ID disagrees with chrom or pos")
+            columns['ref'] = [cpra[2] for cpra in cpras]
+            columns['alt'] = [cpra[3] for cpra in cpras]
+
+        if not chrom_aliases.keys().isdisjoint(columns['chrom']):
+            columns['chrom'] = [chrom_aliases.get(chrom, chrom) for chrom in columns['chrom']]
+
+        return columns
 
     def get_info(self):
         infos = []
@@ -178,6 +309,27 @@ class AssocFileReader:
                     "- parsed from a later line:\n    {}".format(info))
         return infos[0]
 
+    def _make_variant_parser(self, colnames, colidx_for_field):
+        '''
+        Returns a function that's equivalent to `self._parse_variant(values, colnames, colidx_for_field)`.
+        It's generated once per file, so that each line is parsed without looking up the columns and parsers of every field.
+        If a line fails, it's re-parsed by `_parse_variant()` to explain the problem.
+        '''
+        fields = [field for field, colidx in colidx_for_field.items() if colidx is not None]
+        namespace = {'parser{}'.format(i): self._parser_for_field[field] for i, field in enumerate(fields)}
+        namespace['num_colnames'] = len(colnames)
+        code = 'def parse_fields(values):\n' + \
+               '    if len(values) != num_colnames: raise IndexError()\n' + \
+               '    return {' + ', '.join('{!r}: parser{}(values[{}])'.format(field, i, colidx_for_field[field]) for i, field in enumerate(fields)) + '}\n'
+        exec(code, namespace)
+        parse_fields = namespace['parse_fields']
+        def parse_variant(values):
+            try:
+                return parse_fields(values)
+            except Exception:
+                return self._parse_variant(values, colnames, colidx_for_field)
+        return parse_variant
+
     def _parse_variant(self, values, colnames, colidx_for_field):
         # `values`: [str]
 
@@ -193,7 +345,7 @@ class AssocFileReader:
         variant = {}
         for field, colidx in colidx_for_field.items():
             if colidx is not None:
-                parse = parse_utils.parser_for_field[field]
+                parse = self._parser_for_field[field]
                 value = values[colidx]
                 try:
                     variant[field] = parse(value)
@@ -206,14 +358,14 @@ class AssocFileReader:
 
     def _parse_header(self, colnames, fieldnames_to_check):
         colidx_for_field = {} # which column (by number, not name) holds the value for the field (the key)
-        field_aliases = conf.get_field_aliases()  # {alias: field_name}
+        field_aliases = self._config.field_aliases  # {alias: field_name}
         for colidx, colname in enumerate(colnames):
             if colname in field_aliases and field_aliases[colname] in fieldnames_to_check:
                 field_name = field_aliases[colname]
                 if field_name in colidx_for_field:
                     raise PheWebError(
                         "PheWeb found two different ways of mapping the field_name {!r} to the columns {!r}.\n".format(field_name, colnames) +
-                        "field_aliases = {!r}.\n".format(field_aliases) +
+                        "field_aliases = {!r}.\n".format(dict(field_aliases)) +
                         "File = {}\n".format(self.filepath))
                 colidx_for_field[field_name] = colidx
         return colidx_for_field
@@ -227,7 +379,7 @@ class AssocFileReader:
                 "Some required fields weren't successfully mapped to the columns of an input file.\n" +
                 "The file is {!r}.\n".format(self.filepath) +
                 "The fields that were required but not present are: {!r}\n".format(missing_required_fieldnames) +
-                "field_aliases = {}:\n".format(conf.get_field_aliases()) +
+                "field_aliases = {}:\n".format(dict(self._config.field_aliases)) +
                 "Here are all the column names from that file: {!r}\n".format(colnames))
             if colidx_for_field:
                 err_message += (
@@ -1,21 +1,38 @@
 
-from ..utils import chrom_order, get_phenolist, PheWebError
-from .. import conf
-from ..file_utils import VariantFileReader, VariantFileWriter, get_filepath, get_pheno_filepath, make_basedir, get_dated_tmp_path, get_tmp_path
-from .load_utils import get_maf, mtime, indent, ProgressBar
+'''
+This script makes a list of every variant that is in any phenotype.
+If `sites_file` is set (eg, to an imputation panel that's already annotated), that list is used instead, so this only checks its header.
+
+The chromosomes are split into one contiguous group per process, so that the groups are merged in parallel.
+For each group, the variants from all phenotypes are merged in a single pass with a heap (via `heapq.merge()`).
+Each `parsed/*` file is bgzipped with a tabix index, so each group starts reading at its first chromosome instead of decompressing the earlier ones.
+Then the per-group files (which are gzip members without headers) are concatenated in order.
+'''
 
-import contextlib
+from ..utils import chrom_order, chrom_order_list, get_phenolist, PheWebError
+from .. import conf
+from .. import parse_utils
+from ..file_utils import VariantFileReader, get_filepath, get_pheno_filepath, get_tmp_path, read_maybe_gzip, get_virtual_offset, read_bgzip_from, get_tabix_chrom_virtual_offsets
+from .load_utils import mtime, Parallelizer
+from .build_manifest import should_rebuild, record_build
+
+from boltons.fileutils import AtomicSaver
+import boltons.iterutils
+import csv
+import gzip
+import heapq
 import os
-import random
-import multiprocessing
-import bisect
-import traceback
+import shutil
+from typing import List,Dict,Any,Iterator,Tuple,Optional,Set
 
 
-MAX_NUM_FILES_TO_MERGE_AT_ONCE = 8 # I have no idea what's fastest.  Maybe #files / #cpus?
-MIN_NUM_FILES_TO_MERGE_AT_ONCE = 4 # Try to avoid ever merging fewer than this many files at a time.
+READ_BUFFER_SIZE = 2**16  # Small, because we open every phenotype at once.
+NUM_FILE_DESCRIPTORS_TO_LEAVE_UNUSED = 100
+# Approximate length of each chromosome in megabases (GRCh38), used to balance the chromosome groups.
+approx_chrom_lengths = dict(zip(chrom_order_list, [
+    249, 242, 198, 190, 181, 171, 159, 145, 138, 134, 135, 133, 114, 107, 102, 90, 83, 80, 59, 64, 47, 51, 156, 57, 1]))
 
-def run(argv):
+def run(argv:List[str]) -> None:
     out_filepath = get_filepath('unanno', must_exist=False)
 
     force = False
@@ -32,210 +49,172 @@ def run(argv):
         )
         exit(1)
 
-    manna = MergeManager()
+    sites_file = conf.get_sites_file()
+    if sites_file:
+        check_sites_file(sites_file)
+        print('`sites_file` is set, so {!r} is used as the list of sites.'.format(sites_file))
+        return
+
+    input_filepaths = [get_pheno_filepath('parsed', pheno['phenocode']) for pheno in get_phenolist()]
 
-    # TODO: If a phenotype is removed, this still reports that the list of sites is up-to-date.  How to check that?
+    # Without `build_manifest`, if a phenotype is removed, this still reports that the list of sites is up-to-date.
     if os.path.exists(out_filepath) and not force:
-        if mtime(out_filepath) >= max(mtime(f['filepath']) for f in manna.files):
+        by_mtime = mtime(out_filepath) < max(mtime(filepath) for filepath in input_filepaths)
+        if not should_rebuild('sites', input_filepaths, [out_filepath], by_mtime=by_mtime):
             print('The list of sites is up-to-date!')
             return
 
-    taskq = multiprocessing.Queue()
-    retq  = multiprocessing.Queue()
-    procs = [multiprocessing.Process(target=mp_target, args=(taskq, retq)) for _ in range(manna.n_procs)]
-    for p in procs: p.start()
-    for p in procs: manna.put_task(taskq)
-
-    with ProgressBar() as progressbar:
-        def update_progressbar():
-            progressbar.set_message('Working set contains {} input files and {} merged files, with {:2} tasks in progress and {} elapsed'.format(
-                sum(f['type'] == 'input' for f in manna.files),
-                sum(f['type'] == 'merged' for f in manna.files),
-                manna.n_procs,
-                progressbar.fmt_elapsed()
-            ))
-        update_progressbar()
-        while True:
-            ret = retq.get()
-            if ret['type'] == 'warning':
-                progressbar.prepend_message(ret['warning_str'])
-            else:
-                manna.apply_ret(ret)
-                if manna.put_task(taskq) == 'ALLDONE': break
-                update_progressbar()
-        update_progressbar()
-
-    for p in procs:
-        p.join()
-        assert p.exitcode == 0
-    make_basedir(out_filepath)
-    os.rename(manna.files[0]['filepath'], out_filepath)
-
-
-class MergeManager:
-    '''Keeps track of what needs to get merged next.'''
-    def __init__(self):
-        self.n_procs = conf.get_num_procs(cmd='sites')
-        self.files = []
-        for pheno in get_phenolist():
-            filepath = get_pheno_filepath('parsed', pheno['phenocode'])
-            self.files.append({
-                'type': 'input',
-                'filepath': filepath,
-                'pheno': pheno,
-            })
-    def apply_ret(self, ret):
-        if ret['type'] == 'task-completion':
-            self.files.append({
-                'type': 'merged',
-                'filepath': ret['task']['out_filepath'],
-            })
-        elif ret['type'] == 'exception':
-            exc_filepath = get_dated_tmp_path('exception')
-            with open(exc_filepath, 'wt') as f:
-                f.write(
-                    "Child process had exception:\n" + indent(ret['exception_str']) + '\n' +
-                    "Traceback:\n" + indent(ret['exception_tb']) + '\n'
-                )
-            raise PheWebError('Child process had exception, info dumped to {}'.format(exc_filepath))
-        else:
-            raise PheWebError('Unknown ret type: {}'.format(ret['type']))
-    def put_task(self, taskq):
-        if self.n_procs == 1 and len(self.files) == 1 and self.files[0]['type'] == 'merged':
-            # ALL DONE!
-            self.n_procs -= 1
-            taskq.put({'exit':True})
-            return 'ALLDONE'
-        elif len(self.files) == 0:
-            # NO WORK, TERMINATE WORKER
-            self.n_procs -= 1
-            taskq.put({'exit':True})
-        elif self.n_procs > 1 and len(self.files) < MIN_NUM_FILES_TO_MERGE_AT_ONCE:
-            # INSUFFICIENT WORK, TERMINATE WORKER
-            self.n_procs -= 1
-            taskq.put({'exit':True})
-        else:
-            # MAKE A TASK FOR THE WORKER
-            files_to_merge = self.files[:MAX_NUM_FILES_TO_MERGE_AT_ONCE]
-            self.files =     self.files[MAX_NUM_FILES_TO_MERGE_AT_ONCE:]
-            out_filepath = get_tmp_path('merging-{}'.format(random.randrange(1e10)))
-            taskq.put({
-                'files_to_merge': files_to_merge,
-                'out_filepath': out_filepath,
-            })
-
-
-def mp_target(taskq, retq):
-    for task in iter(taskq.get, {"exit":True}):
-        try:
-            for ret in merge(task['files_to_merge'], task['out_filepath']):
-                if isinstance(ret, dict) and ret['type'] == 'warning':
-                    retq.put(ret)
-                else:
-                    retq.put({
-                        'type': 'message',
-                        'message_str': 'unknown return type: {!r}'.format(ret),
-                    })
-            retq.put({
-                'type': 'task-completion',
-                'task': task,
-            })
-        except (Exception, KeyboardInterrupt) as exc:
-            retq.put({
-                'type': 'exception',
-                'task': task,
-                "exception_str": str(exc),
-                "exception_tb": traceback.format_exc(),
-            })
-
-def merge(files_to_merge, out_filepath):
-    # files_to_merge is like [
-    #   {filepath: "/foo/bar", type:"input", pheno:pheno},
-    #   {filepath: "/foo/bar", type:"merged"},
-    # ]
-    with contextlib.ExitStack() as exit_stack, \
-         VariantFileWriter(out_filepath) as writer:
-
-        readers = []
-        _reader_info = []
-        vlm = VariantListMerger()
-        for file_to_merge in files_to_merge:
-            reader = iter(exit_stack.enter_context(VariantFileReader(file_to_merge['filepath'], only_per_variant_fields=True)))
-            reader_id = len(readers)
-            readers.append(reader)
-            _reader_info.append(file_to_merge)
-
-            # insert the first variant of each pheno into the VariantListMerger
-            try:
-                v = next(reader)
-            except StopIteration:
-                yield {
-                    'type': 'warning',
-                    'warning_str': 'Warning: {!r} didnt even have ONE variant that passed the MAF thresholds.'.format(_reader_info[reader_id]['filepath']),
-                }
-            vlm.insert(v, reader_id)
-
-        # each time we pop the leftmost variant from the VariantListMerger, fetch a new variant from each pheno that contained that variant
-        n_variants = 0
-        while vlm:
-            assert len(vlm) <= len(files_to_merge), repr(vlm)
-            v, reader_ids = vlm.pop()
-            writer.write(v)
-            n_variants += 1
-            for reader_id in reader_ids:
-                try:
-                    new_v = next(readers[reader_id])
-                except StopIteration:
-                    readers[reader_id] = None
-                else:
-                    vlm.insert(new_v, reader_id)
-
-        assert all(reader is None for reader in readers), list(zip(_reader_info, readers))
-
-    for file_to_merge in files_to_merge:
-        if file_to_merge['type'] == 'merged':
-            os.remove(file_to_merge['filepath'])
-    #print('{:8} variants in {} <- {}'.format(n_variants, os.path.basename(out_filepath), [os.path.basename(f['filepath']) for f in files_to_merge]))
-
-class VariantListMerger:
+    tasks = [{'chroms': chroms, 'filepaths': input_filepaths} for chroms in get_chrom_groups(conf.get_num_procs('sites'))]
+    group_filepaths: Dict[int,Optional[str]] = {}
+    nonempty_filepaths: Set[str] = set()
+    for ret in Parallelizer().run_single_tasks(tasks, merge_chrom_group, cmd='sites'):
+        group_filepaths[chrom_order[ret['task']['chroms'][0]]] = ret['value']['filepath']
+        nonempty_filepaths.update(ret['value']['nonempty_filepaths'])
+    for filepath in input_filepaths:
+        if filepath not in nonempty_filepaths:
+            print('Warning: {!r} didnt even have ONE variant that passed the MAF thresholds.'.format(filepath))
+
+    with AtomicSaver(out_filepath, text_mode=False, part_file=get_tmp_path(out_filepath), overwrite_part=True, rm_part_on_exc=False) as f:
+        with gzip.open(f, 'wt', compresslevel=2) as f_gzip:
+            csv.writer(f_gzip, dialect='pheweb-internal-dialect').writerow(['chrom', 'pos', 'ref', 'alt'])
+        for _, group_filepath in sorted(group_filepaths.items()):
+            if group_filepath is not None:
+                with open(group_filepath, 'rb') as f_group:
+                    shutil.copyfileobj(f_group, f)
+                os.remove(group_filepath)
+    record_build('sites', input_filepaths)
+
+
+def check_sites_file(filepath:str) -> None:
+    '''Checks that the header of a sites file from `sites_file` looks like one made by `pheweb add-genes`.'''
+    if not os.path.exists(filepath):
+        raise PheWebError("`sites_file` is set to {!r}, which doesn't exist.".format(filepath))
+    with VariantFileReader(filepath) as reader:
+        fields = reader.fields
+    if fields[:4] != ['chrom', 'pos', 'ref', 'alt']:
+        raise PheWebError("The sites file {!r} must begin with the columns chrom, pos, ref and alt, but its columns are {!r}".format(filepath, fields))
+    missing_fields = [field for field in ['rsids', 'nearest_genes'] if field not in fields]
+    if missing_fields:
+        raise PheWebError("The sites file {!r} is missing the columns {!r}, so it hasn't been annotated like one made by `pheweb add-genes`".format(filepath, missing_fields))
+    per_assoc_fields = [field for field in fields if field not in parse_utils.per_variant_fields]
+    if per_assoc_fields:
+        raise PheWebError("The sites file {!r} has columns that aren't per-variant: {!r}".format(filepath, per_assoc_fields))
+
+
+def get_chrom_groups(num_groups:int, chrom_lengths:Optional[Dict[str,int]] = None) -> List[List[str]]:
+    '''
+    Splits `chrom_order_list` into up to `num_groups` contiguous groups of similar total length.
+    The lengths are `chrom_lengths` if it's given (with 0 for any missing chrom), and otherwise `approx_chrom_lengths`.
+    '''
+    if chrom_lengths is None: chrom_lengths = approx_chrom_lengths
+    total_length = sum(chrom_lengths.get(chrom, 0) for chrom in chrom_order_list)
+    groups: List[List[str]] = [[]]
+    cumulative_length = 0
+    for chrom in chrom_order_list:
+        if groups[-1] and len(groups) < num_groups and cumulative_length >= total_length * len(groups) / num_groups:
+            groups.append([])
+        groups[-1].append(chrom)
+        cumulative_length += chrom_lengths.get(chrom, 0)
+    return groups
+assert get_chrom_groups(1) == [chrom_order_list]
+assert sum(get_chrom_groups(4), []) == chrom_order_list
+assert get_chrom_groups(2, {'1': 10, '2': 10}) == [['1'], chrom_order_list[1:]]
+
+def split_file_into_chrom_groups(filepath:str, max_num_groups:int, min_bytes_per_group:int) -> List[Optional[List[str]]]:
     '''
-    Works like a heap for variants, where .pop() returns the variant with the smallest chrom-pos-ref-alt.
-    Also tracks which readers had the variant.
-    Variants must match EXACTLY.
+    Splits the bgzipped file `filepath` into up to `max_num_groups` groups of chroms with similar compressed sizes (using its tabix index),
+    with at least `min_bytes_per_group` in each.  Returns `[None]` (ie, "don't split") if it can't be split.
     '''
-    def __init__(self):
-        # self._q = blist.blist()  # TODO: see whether blist.blist() is more performant than [] (b/c blist1.3 raises DeprecationWarnings on py38)
-        self._q = []
-        # self._q is like sorted([(key, variant_dict, [reader_id, ...]), ...])
-        # key is like (chrom_idx, pos, ref, alt)
-
-    def insert(self, variant, reader_id):
-        # Delete extra keys that would cause two of the same variant to not look like a pair.
-        # This is useful if the user has replaced parsed files with symlinks to annotated files in order to save space.
-        # Require that variants match exactly, because if "chrM:1234:A:T" equals "chrMT:1234:A:T" then the merged file won't match the original files.
-        for key in [key for key in variant.keys() if key not in ('chrom', 'pos', 'ref', 'alt')]:
-            del variant[key]
-        key = self._key_from_variant(variant)
-        idx = bisect.bisect_left(self._q, (key,)) # note: (a,) < (a,b)
-        if idx == len(self._q) or self._q[idx][0] != key:
-            # new variant, so just insert
-            self._q.insert(idx, (key, variant, [reader_id]))
-        else:
-            # key matches, so variant must too
-            if variant != self._q[idx][1]:
-                raise PheWebError('trying to add {!r} to VariantMerger, but it already contains {!r} which has the same chrom-pos-ref-alt'.format(
-                    variant, self._q[idx][1]))
-            self._q[idx][2].append(reader_id)
-
-    def pop(self):
-        return self._q.pop(0)[1:3] # return (item, [tag, ...])
-
-    def __len__(self):
-        return len(self._q)
-
-    def __repr__(self):
-        return 'VariantMerger<_q={!r}>'.format(self._q)
-
-    @staticmethod
-    def _key_from_variant(v):
-        return (chrom_order[v['chrom']], v['pos'], v['ref'], v['alt'])
+    if get_virtual_offset(filepath, chrom_order_list) <= 0: return [None]  # no usable tabix index
+    chrom_starts = sorted((virtual_offset >> 16, chrom) for chrom, virtual_offset in get_tabix_chrom_virtual_offsets(filepath + '.tbi').items())
+    chrom_ends = [start for start, chrom in chrom_starts[1:]] + [os.stat(filepath).st_size]
+    chrom_lengths = {chrom: end - start for (start, chrom), end in zip(chrom_starts, chrom_ends)}
+    num_groups = min(max_num_groups, sum(chrom_lengths.values()) // min_bytes_per_group)
+    if num_groups <= 1: return [None]
+    return [chroms for chroms in get_chrom_groups(num_groups, chrom_lengths) if any(chrom in chrom_lengths for chrom in chroms)]
+
+def merge_chrom_group(task:Dict[str,Any]) -> Dict[str,Any]:
+    '''
+    Returns `{"filepath": <filepath>, "nonempty_filepaths": [...]}`, where `filepath` is a gzipped file of the variants on `task['chroms']`
+    (without a header), or None if there are none, and `nonempty_filepaths` are the input files that have variants on `task['chroms']`.
+    '''
+    out_filepath = get_tmp_path('sites-chr{}-chr{}.gz'.format(task['chroms'][0], task['chroms'][-1]))
+    nonempty_filepaths: Set[str] = set()
+    num_variants = merge(task['filepaths'], task['chroms'], out_filepath, max_num_files=_get_max_num_open_files(), nonempty_filepaths=nonempty_filepaths)
+    if num_variants == 0: os.remove(out_filepath)
+    return {'filepath': out_filepath if num_variants else None, 'nonempty_filepaths': sorted(nonempty_filepaths)}
+
+def merge(filepaths:List[str], chroms:List[str], out_filepath:str, *, max_num_files:int, has_header:bool = True,
+          nonempty_filepaths:Optional[Set[str]] = None) -> int:
+    '''
+    Writes the union of the variants on `chroms` in `filepaths` to `out_filepath`.  Returns the number of variants.
+    Adds the filepaths that have any variants on `chroms` to `nonempty_filepaths`.
+    '''
+    if len(filepaths) > max_num_files:
+        # We can't open every file at once, so merge them in batches first.
+        batch_filepaths: List[str] = []
+        for batch in boltons.iterutils.chunked(filepaths, max_num_files):
+            batch_filepath = get_tmp_path('sites-chr{}-chr{}-batch{}.gz'.format(chroms[0], chroms[-1], len(batch_filepaths)))
+            merge(batch, chroms, batch_filepath, max_num_files=max_num_files, has_header=has_header, nonempty_filepaths=nonempty_filepaths)
+            batch_filepaths.append(batch_filepath)
+        num_variants = merge(batch_filepaths, chroms, out_filepath, max_num_files=max_num_files, has_header=False)
+        for batch_filepath in batch_filepaths: os.remove(batch_filepath)
+        return num_variants
+
+    num_variants = 0
+    prev_cpra = None
+    with gzip.open(out_filepath, 'wt', compresslevel=2) as f:
+        writer = csv.writer(f, dialect='pheweb-internal-dialect')
+        # Each file yields `(chrom_idx, pos, ref, alt)` in order, so the merged stream is in order and duplicates are adjacent.
+        for cpra in heapq.merge(*(get_cpras(filepath, chroms, has_header=has_header, nonempty_filepaths=nonempty_filepaths) for filepath in filepaths)):
+            if cpra != prev_cpra:
+                writer.writerow((chrom_order_list[cpra[0]],) + cpra[1:])
+                num_variants += 1
+                prev_cpra = cpra
+    return num_variants
+
+def get_cpras(filepath:str, chroms:List[str], has_header:bool = True, nonempty_filepaths:Optional[Set[str]] = None) -> Iterator[Tuple[int,int,str,str]]:
+    '''
+    Yields `(chrom_idx, pos, ref, alt)` for each variant on `chroms`, which must be contiguous in `chrom_order_list`.
+    If the file has a tabix index, reading starts at the first of `chroms`.  Stops reading once it passes `chroms`.
+    If there are any such variants, adds `filepath` to `nonempty_filepaths`.
+    '''
+    first_chrom_idx, last_chrom_idx = chrom_order[chroms[0]], chrom_order[chroms[-1]]
+    virtual_offset = get_virtual_offset(filepath, chroms)
+    if virtual_offset == -1: return
+    # `merge()` has every file open at once, so the header is read and closed before the variants are read.
+    if has_header:
+        with read_maybe_gzip(filepath, buffer_size=READ_BUFFER_SIZE) as f:
+            colnames = next(csv.reader(f, dialect='pheweb-internal-dialect'), None)
+        if colnames is None: return
+        if colnames[0].startswith('#'): colnames[0] = colnames[0][1:]
+        pos_col, ref_col, alt_col = (colnames.index(field) for field in ['pos', 'ref', 'alt'])
+        assert colnames.index('chrom') == 0, colnames
+    else:
+        pos_col, ref_col, alt_col = 1, 2, 3
+    with (read_bgzip_from(filepath, virtual_offset, buffer_size=READ_BUFFER_SIZE) if virtual_offset > 0 else read_maybe_gzip(filepath, buffer_size=READ_BUFFER_SIZE)) as f:
+        if has_header and virtual_offset == 0: next(f)
+        # Splitting on tabs is safe because chrom, pos, ref and alt never need escaping.
+        # Lines on earlier chromosomes are skipped after only looking at the chrom.
+        for line in f:
+            chrom_idx = chrom_order[line[:line.index('\t')]]
+            if chrom_idx < first_chrom_idx: continue
+            if chrom_idx > last_chrom_idx: return
+            if nonempty_filepaths is not None:
+                nonempty_filepaths.add(filepath)
+                nonempty_filepaths = None
+            row = line.split('\t')
+            yield (chrom_idx, int(row[pos_col]), row[ref_col], row[alt_col].rstrip('\n'))
+
+def _get_max_num_open_files() -> int:
+    import resource
+    soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit != resource.RLIM_INFINITY and (hard_limit == resource.RLIM_INFINITY or soft_limit < hard_limit):
+        new_soft_limit = 2**16 if hard_limit == resource.RLIM_INFINITY else min(hard_limit, 2**16)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft_limit, hard_limit))
+            soft_limit = new_soft_limit
+        except (ValueError, OSError):
+            pass
+    if soft_limit == resource.RLIM_INFINITY: soft_limit = 2**16
+    return max(2, soft_limit - NUM_FILE_DESCRIPTORS_TO_LEAVE_UNUSED)
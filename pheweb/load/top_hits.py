@@ -2,8 +2,10 @@
 from ..utils import get_phenolist
 from .. import conf
 from ..file_utils import write_json, write_heterogenous_variantfile, get_filepath, get_pheno_filepath
+from .build_manifest import should_rebuild, record_build
 
 import json
+import os
 from pathlib import Path
 from typing import Dict,Any,List,Iterator
 
@@ -36,11 +38,12 @@ def should_run() -> bool:
     if not all(fp.exists() for fp in output_filepaths):
         return True
     oldest_output_mtime = min(fp.stat().st_mtime for fp in output_filepaths)
-    input_filepaths = [Path(get_pheno_filepath('manhattan', pheno['phenocode'])) for pheno in get_phenolist()]
-    newest_input_mtime = max(fp.stat().st_mtime for fp in input_filepaths)
-    if newest_input_mtime > oldest_output_mtime:
-        return True
-    return False
+    input_filepaths = _get_input_filepaths()
+    newest_input_mtime = max(os.stat(fp).st_mtime for fp in input_filepaths)
+    return should_rebuild('top-hits', input_filepaths, [str(fp) for fp in output_filepaths], by_mtime=newest_input_mtime > oldest_output_mtime)
+
+def _get_input_filepaths() -> List[str]:
+    return [get_pheno_filepath('manhattan', pheno['phenocode']) for pheno in get_phenolist()]
 
 def run(argv:List[str]) -> None:
     out_filepath_json = get_filepath('top-hits', must_exist=False)
@@ -82,3 +85,5 @@ just the top phenotype for each, use `pheweb top-loci`.
         stringify_assocs(hits)
         write_heterogenous_variantfile(out_filepath_tsv, hits, use_gzip=False)
         print("wrote {} hits to {}".format(len(hits), out_filepath_tsv))
+
+    record_build('top-hits', _get_input_filepaths())
@@ -3,10 +3,11 @@ from .utils import PheWebError
 from . import conf
 #import sys
 
+import functools
 import itertools
 from collections import OrderedDict,Counter
 import typing as ty
-from typing import Dict,Any
+from typing import Dict,Any,List,Sequence,Optional
 
 
 def scientific_int(s:str) -> int:
@@ -21,6 +22,7 @@ def scientific_int(s:str) -> int:
 
 
 null_values = ['', '.', 'NA', 'N/A', 'n/a', 'nan', '-nan', 'NaN', '-NaN', 'null', 'NULL']
+_null_values_set = frozenset(null_values)
 
 default_field = {
     'aliases': [],
@@ -195,8 +197,8 @@ class Field:
     def __init__(self, d):
         self._d = d
 
-    def parse(self, value):
-        '''parse from input file'''
+    def parse(self, value, pval_is_neglog10=None):
+        '''parse from input file.  If `pval_is_neglog10` isn't given, it comes from `conf`.'''
         # nullable
         if self._d['nullable'] and value in null_values:
             return ''
@@ -204,7 +206,7 @@ class Field:
         x = self._d['type'](value)
 
         # It's POSSIBLE that conversion of -log10 representation is required
-        if 'could_be_neglog10' in self._d and self._d['could_be_neglog10'] and conf.pval_is_neglog10():
+        if 'could_be_neglog10' in self._d and self._d['could_be_neglog10'] and (conf.pval_is_neglog10() if pval_is_neglog10 is None else pval_is_neglog10):
             x = 10**-x
 
         # range
@@ -223,6 +225,91 @@ class Field:
         if 'decimals' in self._d:
             x = round(x, self._d['decimals'])
         return x
+    def make_parser(self, pval_is_neglog10:bool) -> ty.Callable[[str],ty.Any]:
+        '''
+        returns a function that gives the same result as `self.parse(value, pval_is_neglog10)`,
+        but which checks which steps apply to this field only once instead of for every value.
+        '''
+        convert = self._d['type']
+        nullable = self._d['nullable']
+        neglog10 = bool(self._d.get('could_be_neglog10')) and pval_is_neglog10
+        range_min, range_max = self._d.get('range', (None, None))
+        sigfigs = self._d.get('sigfigs')
+        proportion_sigfigs = self._d.get('proportion_sigfigs')
+        decimals = self._d.get('decimals')
+        if not nullable and not neglog10 and range_min is None and range_max is None and \
+           sigfigs is None and proportion_sigfigs is None and decimals is None:
+            return convert
+        round_sig = utils.round_sig
+        def parse(value:str) -> ty.Any:
+            if nullable and value in _null_values_set:
+                return ''
+            x = convert(value)
+            if neglog10:
+                x = 10**-x
+            assert range_min is None or x >= range_min
+            assert range_max is None or x <= range_max
+            if sigfigs is not None:
+                x = round_sig(x, sigfigs)
+            if proportion_sigfigs is not None:
+                if 0 <= x < 0.5:
+                    x = round_sig(x, proportion_sigfigs)
+                elif 0.5 <= x <= 1:
+                    x = 1 - round_sig(1-x, proportion_sigfigs)
+                else:
+                    raise utils.PheWebError('cannot use proportion_sigfigs on a number outside [0-1]')
+            if decimals is not None:
+                x = round(x, decimals)
+            return x
+        return parse
+    def parse_column(self, values:Sequence[str], pval_is_neglog10:Optional[bool] = None) -> List[Any]:
+        '''
+        parse a whole column from an input file, giving the same result as `[self.parse(value, pval_is_neglog10) for value in values]`.
+        Any value that `.parse()` might reject raises an unhelpful exception, so callers should fall back to `.parse()` to report it.
+        '''
+        import numpy as np
+        is_null = None
+        if self._d['nullable'] and not _null_values_set.isdisjoint(values):
+            is_null = np.array([value in _null_values_set for value in values], dtype=bool)
+            values = ['0' if null else value for value,null in zip(values, is_null)]  # placeholder that passes every check
+        if self._d['type'] is str:
+            rv = list(values)
+        elif self._d['type'] is float:
+            x = np.array(values, dtype=np.float64)
+            if 'could_be_neglog10' in self._d and self._d['could_be_neglog10'] and (conf.pval_is_neglog10() if pval_is_neglog10 is None else pval_is_neglog10):
+                x = 10 ** -x
+            if not np.all(np.isfinite(x)): raise ValueError("found a non-finite value")
+            if 'range' in self._d:
+                if self._d['range'][0] is not None and not np.all(x >= self._d['range'][0]): raise ValueError("found a value below the range")
+                if self._d['range'][1] is not None and not np.all(x <= self._d['range'][1]): raise ValueError("found a value above the range")
+            int_value_for_idx: Dict[int,int] = {}  # `utils.round_sig()` returns the int `0` for zero, which gets written as "0" instead of "0.0".
+            if 'sigfigs' in self._d:
+                int_value_for_idx.update((idx, 0) for idx in np.flatnonzero(x == 0))
+                x = utils.round_sig_array(x, self._d['sigfigs'])
+            if 'proportion_sigfigs' in self._d:
+                if not np.all((0 <= x) & (x <= 1)): raise utils.PheWebError('cannot use proportion_sigfigs on a number outside [0-1]')
+                is_upper = (x >= 0.5)
+                int_value_for_idx.update((idx, 0) for idx in np.flatnonzero(x == 0))
+                int_value_for_idx.update((idx, 1) for idx in np.flatnonzero(x == 1))
+                x = np.where(is_upper,
+                             1 - utils.round_sig_array(1 - x, self._d['proportion_sigfigs']),
+                             utils.round_sig_array(x, self._d['proportion_sigfigs']))
+            if 'decimals' in self._d:
+                x = utils.round_array(x, self._d['decimals'])
+                int_value_for_idx.clear()  # `round()` always returns a float
+            rv = x.tolist()
+            for idx, value in int_value_for_idx.items(): rv[idx] = value
+        elif self._d['type'] in (int, scientific_int):
+            x = np.array(values, dtype=np.int64)  # rejects "1.23e2", which will fall back to `scientific_int()`
+            if 'range' in self._d:
+                if self._d['range'][0] is not None and not np.all(x >= self._d['range'][0]): raise ValueError("found a value below the range")
+                if self._d['range'][1] is not None and not np.all(x <= self._d['range'][1]): raise ValueError("found a value above the range")
+            rv = x.tolist()
+        else:
+            rv = [self.parse(value, pval_is_neglog10) for value in values]
+        if is_null is not None:
+            for idx in np.flatnonzero(is_null): rv[idx] = ''
+        return rv
     def read(self, value):
         '''read from internal file'''
         if self._d['nullable'] and value == '':
@@ -249,12 +336,22 @@ for field_name, field_dict in fields.items():
 
 # Build readers/parsers
 parser_for_field: ty.Dict[str,ty.Callable[[str],ty.Any]] = {}
+column_parser_for_field: ty.Dict[str,ty.Callable[[Sequence[str]],List[ty.Any]]] = {}
 reader_for_field: ty.Dict[str,ty.Callable[[str],ty.Any]] = {}
+_field_objs: ty.Dict[str,Field] = {}
 for field_name, field_dict in fields.items():
     obj = Field(field_dict)
+    _field_objs[field_name] = obj
     parser_for_field[field_name] = obj.parse
+    column_parser_for_field[field_name] = obj.parse_column
     reader_for_field[field_name] = obj.read
 
+# Like `parser_for_field` and `column_parser_for_field`, but with `pval_is_neglog10` decided up front instead of looked up for every value.
+def get_parser_for_field(pval_is_neglog10:bool) -> ty.Dict[str,ty.Callable[[str],ty.Any]]:
+    return {field_name: obj.make_parser(pval_is_neglog10) for field_name, obj in _field_objs.items()}
+def get_column_parser_for_field(pval_is_neglog10:bool) -> ty.Dict[str,ty.Callable[[Sequence[str]],List[ty.Any]]]:
+    return {field_name: functools.partial(obj.parse_column, pval_is_neglog10=pval_is_neglog10) for field_name, obj in _field_objs.items()}
+
 
 
 def get_tooltip_underscoretemplate():
@@ -1,10 +1,9 @@
 
-from ..load.load_utils import get_maf
-from ..utils import get_phenolist, get_gene_tuples, pad_gene, PheWebError, vep_consqeuence_category
+from ..utils import get_phenolist, get_gene_tuples, pad_gene, PheWebError
 from .. import conf
 from .. import parse_utils
-from ..file_utils import get_filepath, get_pheno_filepath, VariantFileReader
-from .server_utils import get_variant, get_random_page, get_pheno_region, relative_redirect
+from ..file_utils import get_filepath, get_pheno_filepath
+from .server_utils import get_variant, get_random_page, get_pheno_region, get_filtered_manhattan, get_precomputed_filtered_manhattan_filepath, relative_redirect, cache as server_cache
 from .autocomplete import Autocompleter
 from .auth import GoogleSignIn
 from ..version import version as pheweb_version
@@ -152,34 +151,12 @@ def api_pheno_filtered(phenocode):
         try: max_maf = float(request.args['max_maf'])
         except Exception: abort(404, description="Failed to parse GET parameter `max_maf=`.")
     # Get variants according to filter
-    chosen_variants = []  # TODO: stream straight from VariantFileReader() -> Binner() without this intermediate list
-    weakest_pval_seen = 0
-    num_variants = 0
-    try: filepath = get_pheno_filepath('best_of_pheno', phenocode)
+    try: get_pheno_filepath('best_of_pheno', phenocode)
     except Exception: abort(404, description="Failed to find a best_of_pheno file.  Perhaps `pheweb best-of-pheno` wasn't run.")
-    with VariantFileReader(filepath) as vfr:
-        for v in vfr:
-            num_variants += 1
-            if v['pval'] > weakest_pval_seen: weakest_pval_seen = v['pval']
-            if indel == 'true' and len(v['ref']) == 1 and len(v['alt']) == 1: continue
-            if indel == 'false' and (len(v['ref']) != 1 or len(v['alt']) != 1): continue
-            if min_maf is not None or max_maf is not None:
-                v_maf = get_maf(v, pheno)
-                if min_maf is not None and v_maf < min_maf: continue
-                if max_maf is not None and v_maf > max_maf: continue
-            if consequence_category:
-                csq = vep_consqeuence_category.get(v.get('consequence',''), '')
-                if consequence_category == 'lof' and csq != 'lof': continue
-                if consequence_category == 'nonsyn' and not csq: continue
-            chosen_variants.append(v)
-    from pheweb.load.manhattan import Binner
-    binner = Binner()
-    for variant in chosen_variants:
-        binner.process_variant(variant)
-    manhattan_data = binner.get_result()
-    manhattan_data['weakest_pval'] = weakest_pval_seen
-    #print(f'indel={indel} maf={min_maf}-{max_maf} #chosen={len(chosen_variants)} #bins={len(manhattan_data["variant_bins"])} #unbinned={len(manhattan_data["unbinned_variants"])} weakest_pval={weakest_pval_seen}')
-    return jsonify(manhattan_data)
+    precomputed_filepath = get_precomputed_filtered_manhattan_filepath(phenocode, indel, consequence_category, min_maf, max_maf)
+    if precomputed_filepath is not None:
+        return send_file(precomputed_filepath, mimetype='application/json')
+    return jsonify(get_filtered_manhattan(pheno, indel, consequence_category, min_maf, max_maf))
 
 
 @bp.route('/top_hits')
@@ -280,6 +257,12 @@ def api_region(phenocode:str):
         return jsonify(get_pheno_region(phenocode, chrom, pos_start, pos_end))
 
 
+@bp.route('/api/server-cache-stats.json')
+@check_auth
+def api_server_cache_stats():
+    return jsonify(server_cache.get_stats())
+
+
 @bp.route('/api/pheno/<phenocode>/correlations/')
 @check_auth
 def api_pheno_correlations(phenocode:str):
@@ -1,13 +1,92 @@
 
 from flask import url_for, Response, redirect
 
-from ..file_utils import MatrixReader, IndexedVariantFileReader, get_filepath
+from ..file_utils import get_variant_reader, IndexedVariantFileReader, VariantFileReader, get_filepath, get_pheno_filepath
+from .. import conf
 
 import random
 import re
 import itertools
 import json
-from typing import Optional,Dict,List,Any
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Optional,Dict,List,Any,Tuple,Hashable
+
+
+class LRUCache:
+    '''
+    A least-recently-used cache that holds at most `max_num_bytes` of values, where each value's size is roughly its length as json
+    (see `_estimate_num_bytes()`).  If `max_num_bytes` is 0, nothing is cached.
+    Keys should include the mtime of the file that the value came from, so that stale entries are never hit and just get evicted.
+    Each gunicorn worker has its own cache.
+    '''
+    _missing = object()
+
+    def __init__(self, max_num_bytes:int):
+        self.max_num_bytes = max_num_bytes
+        self._entries: 'OrderedDict[Hashable,Tuple[Any,int]]' = OrderedDict()  # key -> (value, num_bytes)
+        self._num_bytes = 0
+        self._lock = threading.Lock()
+        self.num_hits = 0
+        self.num_misses = 0
+
+    def get(self, key:Hashable, default:Any = _missing) -> Any:
+        '''Returns the value for `key` (and marks it as recently used), or else `default`.  Callers must not modify the value.'''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.num_misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.num_hits += 1
+            return entry[0]
+
+    def put(self, key:Hashable, value:Any) -> None:
+        if self.max_num_bytes <= 0: return
+        num_bytes = _estimate_num_bytes(value)
+        if num_bytes > self.max_num_bytes: return
+        with self._lock:
+            if key in self._entries:
+                self._num_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, num_bytes)
+            self._num_bytes += num_bytes
+            while self._num_bytes > self.max_num_bytes:
+                _, (_, evicted_num_bytes) = self._entries.popitem(last=False)
+                self._num_bytes -= evicted_num_bytes
+
+    def get_stats(self) -> Dict[str,int]:
+        with self._lock:
+            return {
+                'num_hits': self.num_hits,
+                'num_misses': self.num_misses,
+                'num_entries': len(self._entries),
+                'num_bytes': self._num_bytes,
+                'max_num_bytes': self.max_num_bytes,
+            }
+cache = LRUCache(max_num_bytes=conf.get_server_cache_megabytes() * 10**6)
+
+def _estimate_num_bytes(value:Any, max_num_sampled:int = 8) -> int:
+    '''
+    Estimates the length of `value` as json.  Long lists and dicts are estimated from `max_num_sampled` evenly-spaced elements,
+    because cached values are mostly many rows of similar variants, and serializing all of them on every miss would be slow.
+    '''
+    if isinstance(value, str): return len(value) + 2
+    if isinstance(value, (list, tuple)):
+        step = max(1, len(value) // max_num_sampled)
+        sampled = value[::step]
+        return 2 + len(value) * sum(1 + _estimate_num_bytes(v, max_num_sampled) for v in sampled) // max(1, len(sampled))
+    if isinstance(value, dict):
+        step = max(1, len(value) // max_num_sampled)
+        sampled_items = list(itertools.islice(value.items(), 0, None, step))
+        return 2 + len(value) * sum(4 + len(str(k)) + _estimate_num_bytes(v, max_num_sampled) for k, v in sampled_items) // max(1, len(sampled_items))
+    if isinstance(value, np.ndarray): return value.size * 8
+    return 8  # numbers, bools and None
+
+def _get_mtime(filepath:str) -> Optional[float]:
+    try: return os.stat(filepath).st_mtime
+    except FileNotFoundError: return None
 
 
 class _Get_Pheno_Region:
@@ -28,6 +107,15 @@ class _Get_Pheno_Region:
 
     @staticmethod
     def get_pheno_region(phenocode:str, chrom:str, pos_start:int, pos_end:int) -> dict:
+        cache_key = ('pheno_region', phenocode, chrom, pos_start, pos_end, _get_mtime(get_pheno_filepath('pheno_gz', phenocode, must_exist=False)))
+        ret = cache.get(cache_key, None)
+        if ret is None:
+            ret = _Get_Pheno_Region._get_pheno_region(phenocode, chrom, pos_start, pos_end)
+            cache.put(cache_key, ret)
+        return ret
+
+    @staticmethod
+    def _get_pheno_region(phenocode:str, chrom:str, pos_start:int, pos_end:int) -> dict:
         variants = []
         with IndexedVariantFileReader(phenocode) as reader:
             for v in reader.get_region(chrom, pos_start, pos_end+1):
@@ -49,6 +137,51 @@ class _Get_Pheno_Region:
 get_pheno_region = _Get_Pheno_Region.get_pheno_region
 
 
+class _GetFilteredManhattan:
+    @staticmethod
+    def get_filtered_manhattan(pheno:Dict[str,Any], indel:str, consequence_category:str, min_maf:Optional[float], max_maf:Optional[float]) -> dict:
+        '''Returns manhattan data (like `pheweb manhattan` makes) for only the variants in the phenotype's best_of_pheno file that pass the filters.'''
+        filepath = get_pheno_filepath('best_of_pheno', pheno['phenocode'])
+        cache_key = ('filtered_manhattan', pheno['phenocode'], indel, consequence_category, min_maf, max_maf, _get_mtime(filepath))
+        ret = cache.get(cache_key, None)
+        if ret is None:
+            ret = _GetFilteredManhattan._get_filtered_manhattan(pheno, filepath, indel, consequence_category, min_maf, max_maf)
+            cache.put(cache_key, ret)
+        return ret
+
+    @staticmethod
+    def get_precomputed_filepath(phenocode:str, indel:str, consequence_category:str, min_maf:Optional[float], max_maf:Optional[float]) -> Optional[str]:
+        '''Returns the filepath of the json that `pheweb best-of-pheno` precomputed for these filters, or None if there isn't an up-to-date one.'''
+        from ..load.best_of_pheno import get_filtered_manhattan_filepath
+        filepath = get_filtered_manhattan_filepath(phenocode, indel, consequence_category, min_maf, max_maf)
+        filepath_mtime = _get_mtime(filepath)
+        if filepath_mtime is None or filepath_mtime < os.stat(get_pheno_filepath('best_of_pheno', phenocode)).st_mtime: return None
+        return filepath
+
+    @staticmethod
+    def _get_filtered_manhattan(pheno:Dict[str,Any], filepath:str, indel:str, consequence_category:str, min_maf:Optional[float], max_maf:Optional[float]) -> dict:
+        from ..load.best_of_pheno import get_filter_mask, get_filtered_manhattan_data
+        filter_columns = _GetFilteredManhattan._get_filter_columns(pheno, filepath)
+        is_chosen = get_filter_mask(filter_columns, indel, consequence_category, min_maf, max_maf)
+        # Only the chosen variants are parsed, and they go straight into the binner.
+        with VariantFileReader(filepath) as vfr:
+            return get_filtered_manhattan_data(vfr.get_selected_variants(is_chosen.tolist()), filter_columns)
+
+    @staticmethod
+    def _get_filter_columns(pheno:Dict[str,Any], filepath:str) -> Dict[str,Any]:
+        '''Reads the columns that `pheweb best-of-pheno` wrote, or computes them if they're missing or out-of-date.'''
+        filters_filepath = get_pheno_filepath('best_of_pheno_filters', pheno['phenocode'], must_exist=False)
+        filters_mtime = _get_mtime(filters_filepath)
+        if filters_mtime is not None and filters_mtime >= os.stat(filepath).st_mtime:
+            with np.load(filters_filepath) as npz:
+                return dict(npz)
+        from ..load.best_of_pheno import get_filter_columns
+        with VariantFileReader(filepath) as vfr:
+            return get_filter_columns(list(vfr), pheno)
+get_filtered_manhattan = _GetFilteredManhattan.get_filtered_manhattan
+get_precomputed_filtered_manhattan_filepath = _GetFilteredManhattan.get_precomputed_filepath
+
+
 class _ParseVariant:
     chrom_regex = re.compile(r'(?:[cC][hH][rR])?([0-9XYMT]+)')
     chrom_pos_regex = re.compile(chrom_regex.pattern + r'[-_:/ ]([0-9]+)')
@@ -68,8 +201,19 @@ class _GetVariant:
     def get_variant(self, query:str) -> Optional[Dict[str,Any]]:
         chrom, pos, ref, alt = parse_variant(query)
         assert None not in [chrom, pos, ref, alt]
-        if not hasattr(self, '_matrix_reader'):
-            self._matrix_reader = MatrixReader()
+        # Every kind of matrix reader is made from files that `pheweb matrix` writes along with matrix.tsv.gz, so its mtime covers them all.
+        matrix_mtime = _get_mtime(get_filepath('matrix', must_exist=False))
+        cache_key = ('variant', chrom, pos, ref, alt, matrix_mtime)
+        v = cache.get(cache_key, False)
+        if v is False:
+            v = self._get_variant(chrom, pos, ref, alt, matrix_mtime)
+            cache.put(cache_key, v)
+        return v
+
+    def _get_variant(self, chrom:str, pos:int, ref:str, alt:str, matrix_mtime:Optional[float]) -> Optional[Dict[str,Any]]:
+        if getattr(self, '_matrix_mtime', None) != matrix_mtime:
+            self._matrix_reader = get_variant_reader()  # the reader reads the header/phenos when it's made, so remake it when the matrix changes
+            self._matrix_mtime = matrix_mtime
         with self._matrix_reader.context() as mr:
             v = mr.get_variant(chrom, pos, ref, alt)
         if v is None: return None
@@ -32,6 +32,42 @@ def round_sig(x:float, digits:int) -> float:
 assert round_sig(0.00123, 2) == 0.0012
 assert round_sig(1.59e-10, 2) == 1.6e-10
 
+def round_array(x:ty.Any, ndigits:ty.Any) -> ty.Any:
+    '''
+    Like `round(v, n)` for each float `v` in the numpy array `x`, where `ndigits` is an int or an array of ints.
+    `round()` is correctly rounded (half-to-even on the exact binary value) but `np.round()` isn't,
+    so any element where `np.round()` could disagree with `round()` gets rounded by `round()`.
+    '''
+    import numpy as np
+    x = np.asarray(x, dtype=np.float64)
+    ndigits = np.broadcast_to(np.asarray(ndigits, dtype=np.int64), x.shape)
+    scale = 10.0 ** np.clip(ndigits, 0, 22)  # powers of 10 up to 1e22 are exact in float64
+    scaled = x * scale
+    rv = np.rint(scaled) / scale  # division is correctly rounded, so this matches `round()` whenever `np.rint()` picks the right integer
+    with np.errstate(invalid='ignore'):
+        # `scaled` is within 1ulp of the true `x * 10**ndigits`, so `np.rint()` is only trustworthy away from ties.
+        dist_from_tie = np.abs(scaled - np.floor(scaled) - 0.5)
+        trustworthy = (ndigits >= 0) & (ndigits <= 22) & (np.abs(scaled) < 2**52) & (dist_from_tie > np.abs(scaled) * 2**-48)
+    for idx in np.flatnonzero(~trustworthy):
+        rv[idx] = round(float(x[idx]), int(ndigits[idx]))
+    return rv
+
+def round_sig_array(x:ty.Any, digits:int) -> ty.Any:
+    '''Like `round_sig(v, digits)` for each float `v` in the numpy array `x`, except that zeros stay floats.'''
+    import numpy as np
+    x = np.asarray(x, dtype=np.float64)
+    if not np.all(np.isfinite(x)): raise ValueError("Cannot round infinity or NaN")
+    nonzero = (x != 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log = np.log10(np.abs(x))
+        ndigits = np.where(nonzero, digits - 1 - np.floor(log), 0).astype(np.int64)
+        # `np.log10()` and `math.log10()` might disagree in the last bit, which only matters right next to a power of 10.
+        is_near_power_of_10 = nonzero & (np.abs(log - np.rint(log)) < 1e-9)
+    rv = round_array(x, ndigits)
+    for idx in np.flatnonzero(is_near_power_of_10):
+        rv[idx] = round_sig(float(x[idx]), digits)
+    return rv
+
 def approx_equal(a:float, b:float, tolerance:float = 1e-4) -> bool:
     return abs(a-b) <= max(abs(a), abs(b)) * tolerance
 assert approx_equal(42, 42.0000001)
@@ -0,0 +1,67 @@
+"""
+Checks that `pheweb augment-phenos` makes the same pheno_gz file (and a working tabix index) when it splits a phenotype into groups of chroms.
+"""
+import glob
+import gzip
+import json
+import os
+
+import pysam
+import pytest
+
+from pheweb import conf
+from pheweb.file_utils import VariantFileReader, IndexedVariantFileWriter, get_filepath, get_pheno_filepath, get_generated_path
+from pheweb.load import augment_phenos
+
+
+SITES = [{'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': alt, 'rsids': 'rs{}'.format(pos), 'nearest_genes': 'GENE{}'.format(chrom)}
+         for chrom in ['1', '2', '10', 'X'] for pos in range(100, 100000, 25) for alt in ['G', 'T']]
+PHENO_VARIANTS = [dict(chrom=site['chrom'], pos=site['pos'], ref=site['ref'], alt=site['alt'], pval=(i+1)/len(SITES), beta=i/10)
+                  for i, site in enumerate(SITES) if i % 3 != 0]
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmp_path))
+    monkeypatch.setitem(conf.overrides, 'num_procs', 3)
+    with open(get_filepath('phenolist', must_exist=False), 'w') as f:
+        json.dump([{'phenocode': 'a', 'assoc_files': []}], f)
+    with IndexedVariantFileWriter(get_filepath('sites', must_exist=False)) as writer:
+        writer.write_all(SITES)
+    with IndexedVariantFileWriter(get_pheno_filepath('parsed', 'a', must_exist=False)) as writer:
+        writer.write_all(PHENO_VARIANTS)
+    return tmp_path
+
+def _read_pheno_gz():
+    with gzip.open(get_pheno_filepath('pheno_gz', 'a'), 'rt') as f:
+        return f.read()
+
+
+def test_split_augment_matches_unsplit(data_dir, monkeypatch, capsys):
+    pheno = {'phenocode': 'a'}
+    augment_phenos.convert(pheno)
+    expected = _read_pheno_gz()
+    assert augment_phenos.split_pheno(pheno, 3) == [None]  # too small to split
+
+    monkeypatch.setattr(augment_phenos, 'MIN_BYTES_PER_PART', 1)
+    os.remove(get_pheno_filepath('pheno_gz', 'a'))
+    augment_phenos.run([])
+    assert 'Processing 1 phenos in 3 parts' in capsys.readouterr().out
+    assert _read_pheno_gz() == expected
+    assert not glob.glob(get_generated_path('tmp', 'augment-*'))
+
+    # The tabix index works, for `VariantFileReader(chroms=...)` and for `pysam`.
+    with VariantFileReader(get_pheno_filepath('pheno_gz', 'a'), chroms=['10']) as reader:
+        assert [(v['pos'], v['rsids']) for v in reader] == [(v['pos'], 'rs{}'.format(v['pos'])) for v in PHENO_VARIANTS if v['chrom'] == '10']
+    with pysam.TabixFile(get_pheno_filepath('pheno_gz', 'a')) as tabix_file:
+        assert [line.split('\t')[1] for line in tabix_file.fetch('X', 999, 1100)] == \
+            [str(v['pos']) for v in PHENO_VARIANTS if v['chrom'] == 'X' and 1000 <= v['pos'] <= 1100]
+
+def test_merge_parts_skips_empty_parts(data_dir):
+    pheno = {'phenocode': 'a'}
+    augment_phenos.convert(pheno)
+    expected = _read_pheno_gz()
+    parts = [augment_phenos.convert_part(pheno, chroms) for chroms in [['3', '4'], ['1', '2'], ['5', '6', '7', '8', '9', '10'], ['X']]]
+    assert parts[0]['fields'] is None
+    augment_phenos.merge_parts(pheno, [parts[1], parts[0], parts[2], parts[3]])
+    assert _read_pheno_gz() == expected
+    assert not any(os.path.exists(part['filepath']) for part in parts)
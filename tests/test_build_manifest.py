@@ -0,0 +1,34 @@
+from pheweb import conf
+from pheweb.load.build_manifest import should_rebuild, record_build
+
+import os
+
+
+def test_should_rebuild_uses_contents_and_config(tmp_path, monkeypatch):
+    monkeypatch.delenv('PHEWEB_DATADIR', raising=False)
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmp_path))
+    monkeypatch.setitem(conf.overrides, 'build_manifest', True)
+    monkeypatch.setitem(conf.overrides, 'matrix_num_shards', 0)
+    inputs = [str(tmp_path / name) for name in ['a', 'b']]
+    output = str(tmp_path / 'out')
+    for filepath in inputs + [output]:
+        with open(filepath, 'w') as f: f.write(os.path.basename(filepath))
+
+    # Without a record, the mtime decision is used, and an up-to-date output gets recorded.
+    assert should_rebuild('matrix', inputs, [output], by_mtime=True)
+    assert not should_rebuild('matrix', inputs, [output], by_mtime=False)
+
+    os.utime(inputs[0], (0, 10**10))  # newer than the output, but the same contents
+    assert not should_rebuild('matrix', inputs, [output], by_mtime=True)
+
+    with open(inputs[1], 'w') as f: f.write('changed')
+    assert should_rebuild('matrix', inputs, [output], by_mtime=False)
+    record_build('matrix', inputs)
+    assert not should_rebuild('matrix', inputs, [output], by_mtime=True)
+
+    assert should_rebuild('matrix', inputs[:1], [output], by_mtime=False)  # an input was removed
+    monkeypatch.setitem(conf.overrides, 'matrix_num_shards', 4)
+    assert should_rebuild('matrix', inputs, [output], by_mtime=False)
+    monkeypatch.setitem(conf.overrides, 'matrix_num_shards', 0)
+    os.remove(output)
+    assert should_rebuild('matrix', inputs, [output], by_mtime=False)
@@ -0,0 +1,178 @@
+from pheweb.file_utils import BinaryVariantFileReader, BinaryVariantFileWriter, get_tabix_chrom_virtual_offsets, read_maybe_gzip, read_maybe_gzip_threaded
+from pheweb.file_utils import VariantFileReader, VariantFileWriter, IndexedVariantFileWriter, convert_VariantFile_to_IndexedVariantFile, TabixFilePool
+import pheweb.file_utils
+import contextlib
+import gzip
+import os
+import pysam
+import pytest
+import random
+import shutil
+
+
+def test_binary_variant_file_roundtrip(tmpdir, monkeypatch):
+    monkeypatch.setattr(pheweb.file_utils, 'BINARY_BLOCK_NUM_VARIANTS', 2)
+    variants = [
+        {'chrom': '1', 'pos': 869334, 'ref': 'G', 'alt': 'A', 'rsids': 'rs1', 'pval': 0.12, 'beta': 1.3, 'af': 0.5800000000000001},
+        {'chrom': '1', 'pos': 869335, 'ref': 'G', 'alt': 'GT', 'rsids': '', 'pval': 1e-300, 'beta': '', 'af': 0.01},
+        {'chrom': '2', 'pos': 100, 'ref': 'C', 'alt': 'A', 'rsids': 'rs2,rs3', 'pval': 0, 'beta': -0.0035, 'af': 0.5},
+        {'chrom': 'X', 'pos': 5, 'ref': 'G', 'alt': 'A', 'rsids': 'rs1', 'pval': 1, 'beta': 12345.6, 'af': 1},
+    ]
+    filepath = str(tmpdir / 'pheno.bin')
+    with BinaryVariantFileWriter(filepath) as writer:
+        writer.write_all(variants[:1])
+        writer.write_columns({field: [v[field] for v in variants[1:]] for field in variants[0]})
+    with BinaryVariantFileReader(filepath) as reader:
+        assert reader.fields == list(variants[0])
+        assert list(reader) == variants
+        blocks = list(reader.get_blocks(chrom='1', start=869335, end=869336, decode_strings=True))
+        assert [list(block['alt']) for block in blocks] == [['GT']]
+
+
+def test_tabix_chrom_virtual_offsets(tmpdir):
+    tsv_filepath, gz_filepath = str(tmpdir / 'pheno.tsv'), str(tmpdir / 'pheno.gz')
+    with open(tsv_filepath, 'w') as f:
+        f.write('chrom\tpos\tref\talt\tpval\n')
+        for chrom in ['1', '2', 'X']:
+            for pos in range(1, 20000, 3):
+                f.write('{}\t{}\tA\tG\t0.5\n'.format(chrom, pos))
+    pysam.tabix_compress(tsv_filepath, gz_filepath)
+    pysam.tabix_index(gz_filepath, seq_col=0, start_col=1, end_col=1, line_skip=1)
+    virtual_offsets = get_tabix_chrom_virtual_offsets(gz_filepath + '.tbi')
+    assert list(virtual_offsets) == ['1', '2', 'X']
+    for chrom, virtual_offset in virtual_offsets.items():
+        with pysam.BGZFile(gz_filepath, 'rb') as f:
+            f.seek(virtual_offset)
+            assert f.readline() == '{}\t1\tA\tG\t0.5'.format(chrom).encode()
+
+
+def test_read_maybe_gzip_threaded(tmpdir):
+    text = ''.join('{}\t{}\tA\tG\t0.5\n'.format(chrom, pos) for chrom in ['1', '2', 'X'] for pos in range(1, 200000, 7))
+    tsv_filepath = str(tmpdir / 'pheno.tsv')
+    with open(tsv_filepath, 'w') as f: f.write(text)
+    pysam.tabix_compress(tsv_filepath, str(tmpdir / 'bgzf.gz'))
+    with open(str(tmpdir / 'multi.gz'), 'wb') as f:  # two members, then zero-padding
+        f.write(gzip.compress(text[:1000].encode()) + gzip.compress(text[1000:].encode()) + b'\x00' * 10)
+    for filename in ['pheno.tsv', 'bgzf.gz', 'multi.gz']:
+        for num_threads in [1, 3]:
+            with read_maybe_gzip_threaded(str(tmpdir / filename), num_threads=num_threads) as f:
+                assert f.read() == text
+            with read_maybe_gzip_threaded(str(tmpdir / filename), num_threads=num_threads) as f:
+                assert next(f) == text.split('\n')[0] + '\n'  # stops early
+
+    with open(str(tmpdir / 'bgzf.gz'), 'rb') as f: data = f.read()
+    with open(str(tmpdir / 'truncated.gz'), 'wb') as f: f.write(data[:len(data)//2])
+    for reader in [read_maybe_gzip, read_maybe_gzip_threaded]:
+        with pytest.raises(EOFError):
+            with reader(str(tmpdir / 'truncated.gz')) as f: f.read()
+
+
+def test_indexed_variant_file_writer(tmpdir, monkeypatch):
+    monkeypatch.setattr(pheweb.file_utils._BgzfWriter, '_NUM_BLOCKS_PER_TASK', 2)
+    rng = random.Random(0)
+    variants = []
+    for chrom in ['1', '2', 'X']:
+        pos = 0
+        for _ in range(20000):
+            pos += rng.choice([0, 1, 30, 2000, 40000])
+            variants.append({'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G', 'pval': rng.random()})
+    with VariantFileWriter(str(tmpdir / 'pheno.tsv'), use_gzip=False) as writer:
+        writer.write_all(variants)
+    convert_VariantFile_to_IndexedVariantFile(str(tmpdir / 'pheno.tsv'), str(tmpdir / 'expected.gz'))
+    with IndexedVariantFileWriter(str(tmpdir / 'pheno.gz'), num_threads=3) as writer:
+        writer.write_all(variants)
+
+    with gzip.open(str(tmpdir / 'pheno.gz'), 'rb') as f, gzip.open(str(tmpdir / 'expected.gz'), 'rb') as f_expected:
+        assert f.read() == f_expected.read()
+    with gzip.open(str(tmpdir / 'pheno.gz.tbi'), 'rb') as f, gzip.open(str(tmpdir / 'expected.gz.tbi'), 'rb') as f_expected:
+        assert len(f.read()) == len(f_expected.read())  # htslib writes the bins in hash order, so only the queries are compared
+    assert get_tabix_chrom_virtual_offsets(str(tmpdir / 'pheno.gz.tbi')) == get_tabix_chrom_virtual_offsets(str(tmpdir / 'expected.gz.tbi'))
+    with pysam.TabixFile(str(tmpdir / 'pheno.gz')) as tabix_file:
+        for _ in range(100):
+            chrom, start = rng.choice(['1', '2', 'X']), rng.randrange(0, 20000 * 8000)
+            end = start + rng.choice([1, 1000, 10**6])
+            expected = ['{chrom}\t{pos}'.format(**v) for v in variants if v['chrom'] == chrom and start < v['pos'] <= end]
+            assert ['\t'.join(line.split('\t')[:2]) for line in tabix_file.fetch(chrom, start, end)] == expected
+
+
+def test_variant_file_reader_chroms(tmpdir):
+    variants = [{'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G', 'pval': 0.5} for chrom in ['1', '2', '5', 'X'] for pos in range(1, 60000, 3)]
+    with IndexedVariantFileWriter(str(tmpdir / 'pheno.gz')) as writer:
+        writer.write_all(variants)
+    for chroms in [['1'], ['2', '3', '4', '5'], ['3', '4'], ['6', '7', '8', '9', '10', '11', '12', '13', '14', '15', '16', '17', '18', '19', '20', '21', '22', 'X', 'Y', 'MT']]:
+        expected = [v for v in variants if v['chrom'] in chroms]
+        with VariantFileReader(str(tmpdir / 'pheno.gz'), chroms=chroms) as reader:
+            assert reader.fields == list(variants[0])
+            assert list(reader) == expected
+    os.remove(str(tmpdir / 'pheno.gz.tbi'))  # without an index, the whole file is read
+    with VariantFileReader(str(tmpdir / 'pheno.gz'), chroms=['2', '3', '4', '5']) as reader:
+        assert list(reader) == [v for v in variants if v['chrom'] in ['2', '5']]
+
+
+def _write_tabixed_file(filepath, pval):
+    with IndexedVariantFileWriter(filepath) as writer:
+        writer.write_all([{'chrom': '1', 'pos': pos, 'ref': 'A', 'alt': 'G', 'pval': pval} for pos in range(1, 100)])
+
+def test_tabix_file_pool_reopens_changed_files(tmpdir):
+    filepath = str(tmpdir / 'pheno.gz')
+    _write_tabixed_file(filepath, 0.5)
+    pool = TabixFilePool(max_num_files=10)
+    with pool.open(filepath) as tabix_file: pass
+    with pool.open(filepath) as same_tabix_file:
+        assert same_tabix_file is tabix_file
+    assert pool.get_header_fields(filepath) == ['chrom', 'pos', 'ref', 'alt', 'pval']
+
+    os.utime(filepath, ns=(0, os.stat(filepath).st_mtime_ns + 10**9))  # a new mtime
+    with pool.open(filepath) as new_tabix_file:
+        assert new_tabix_file is not tabix_file
+    assert tabix_file.is_closed and pool._num_open == 1
+    tabix_file = new_tabix_file
+
+    os.replace(filepath + '.tbi', str(tmpdir / 'old.tbi'))  # a new inode for the index
+    shutil.copy(str(tmpdir / 'old.tbi'), filepath + '.tbi')
+    os.utime(filepath + '.tbi', ns=(0, os.stat(str(tmpdir / 'old.tbi')).st_mtime_ns))
+    with pool.open(filepath) as new_tabix_file:
+        assert new_tabix_file is not tabix_file
+    assert tabix_file.is_closed and pool._num_open == 1
+    tabix_file = new_tabix_file
+
+    _write_tabixed_file(filepath, 0.25)  # a new file, renamed into place
+    with pool.open(filepath) as new_tabix_file:
+        assert new_tabix_file is not tabix_file
+        assert next(new_tabix_file.fetch('1', 0, 1)).split('\t')[4] == '0.25'
+    assert pool.get_header_fields(filepath) == ['chrom', 'pos', 'ref', 'alt', 'pval']
+    assert tabix_file.is_closed and pool._num_open == 1
+
+def test_tabix_file_pool_keeps_at_most_max_num_files_open(tmpdir):
+    filepaths = [str(tmpdir / 'pheno{}.gz'.format(i)) for i in range(4)]
+    for filepath in filepaths: _write_tabixed_file(filepath, 0.5)
+    pool = TabixFilePool(max_num_files=2)
+    tabix_files = []
+    for filepath in filepaths[:3]:
+        with pool.open(filepath) as tabix_file: tabix_files.append(tabix_file)
+    assert pool._num_open == 2
+    assert tabix_files[0].is_closed and not tabix_files[1].is_closed and not tabix_files[2].is_closed  # least-recently-used first
+    with pool.open(filepaths[1]): pass  # now filepaths[2] is the least recently used
+    with pool.open(filepaths[3]): pass
+    assert tabix_files[2].is_closed and not tabix_files[1].is_closed
+    # Handles in use are never closed, so there can be more than `max_num_files` open until they're returned.
+    with contextlib.ExitStack() as stack:
+        in_use = [stack.enter_context(pool.open(filepath)) for filepath in filepaths]
+        assert pool._num_open == 4 and not any(tabix_file.is_closed for tabix_file in in_use)
+    assert pool._num_open == 2 and sum(not tabix_file.is_closed for tabix_file in in_use) == 2
+
+def test_tabix_file_pool_resets_after_fork(tmpdir, monkeypatch):
+    filepath = str(tmpdir / 'pheno.gz')
+    _write_tabixed_file(filepath, 0.5)
+    pool = TabixFilePool(max_num_files=10)
+    with pool.open(filepath) as tabix_file: pass
+    pool.get_header_fields(filepath)
+    parent_pid = os.getpid()
+    monkeypatch.setattr(os, 'getpid', lambda: parent_pid + 1)  # like a forked child
+    with pool.open(filepath) as child_tabix_file:
+        assert child_tabix_file is not tabix_file
+        assert pool._header_fields == {}
+    assert not tabix_file.is_closed  # it belongs to the parent, so the child doesn't close it
+    assert pool._num_open == 1
+    with pool.open(filepath) as same_tabix_file:
+        assert same_tabix_file is child_tabix_file
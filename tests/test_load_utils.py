@@ -0,0 +1,70 @@
+from pheweb.load.load_utils import Parallelizer, _TaskBatch
+
+
+def test_schedule_longest_first_with_batches():
+    tasks = ['big', 'tiny1', 'medium', 'tiny2', 'tiny3', 'bigger']
+    costs = [100, 1, 50, 1, 2, 200]
+    scheduled = Parallelizer._schedule(tasks, costs, num_procs=2)  # tasks costing less than 354/32 are batched
+    assert scheduled == ['bigger', 'big', 'medium', ['tiny3', 'tiny1', 'tiny2']]
+    assert isinstance(scheduled[-1], _TaskBatch)
+    assert Parallelizer._schedule(tasks, [0] * len(tasks), num_procs=2) == tasks
+
+
+def test_process_steps_come_after_their_deps():
+    from pheweb.load.process_assoc_files import steps, get_streaming_steps
+    import importlib
+    for mysteps in [steps, get_streaming_steps(steps)]:
+        upstream_scripts = {}  # like {script: every step that must finish before it}
+        for step in mysteps:
+            assert set(step.deps) <= set(upstream_scripts), step
+            if step.per_pheno: assert hasattr(importlib.import_module('pheweb.load.' + step.script), 'pheno_stage'), step
+            upstream_scripts[step.script] = set(step.deps).union(*(upstream_scripts[dep] for dep in step.deps))
+        # `gather_pvalues_for_each_gene` reads the genes file, so it must come after a step that downloads it.
+        assert upstream_scripts['gather_pvalues_for_each_gene'] & {'make_gene_aliases_sqlite3', 'add_genes'}
+
+
+def test_check_sites_file(tmp_path):
+    from pheweb.load.sites import check_sites_file
+    from pheweb.utils import PheWebError
+    import pytest
+    filepath = str(tmp_path / 'sites.tsv')
+    for header, is_ok in [('chrom pos ref alt rsids nearest_genes', True),
+                          ('chrom pos ref alt rsids nearest_genes consequence', True),
+                          ('chrom pos ref alt', False),
+                          ('pos chrom ref alt rsids nearest_genes', False),
+                          ('chrom pos ref alt rsids nearest_genes pval', False)]:
+        with open(filepath, 'w') as f: f.write(header.replace(' ', '\t') + '\n')
+        if is_ok: check_sites_file(filepath)
+        else:
+            with pytest.raises(PheWebError): check_sites_file(filepath)
+    with pytest.raises(PheWebError): check_sites_file(str(tmp_path / 'missing.tsv'))
+
+
+def test_sites_merge_opens_one_file_per_input(tmp_path):
+    import gzip, os
+    from pheweb.file_utils import IndexedVariantFileWriter
+    from pheweb.load.sites import get_cpras, merge
+    from pheweb.utils import chrom_order
+    filepaths, expected = [], set()
+    for i in range(5):
+        variants = [{'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': 'G', 'pval': 0.5} for chrom in ['1', '2', '3', 'X'] for pos in range(1+i, 30000, 2+i)]
+        filepaths.append(str(tmp_path / 'parsed{}'.format(i)))
+        with IndexedVariantFileWriter(filepaths[-1]) as writer:
+            writer.write_all(variants)
+        expected.update((v['chrom'], str(v['pos']), v['ref'], v['alt']) for v in variants if v['chrom'] in ['2', '3'])
+    expected_rows = sorted(expected, key=lambda cpra: (chrom_order[cpra[0]], int(cpra[1])))
+
+    for fp in filepaths[1:]:  # copies without tabix indexes, which are read from the start
+        with gzip.open(fp, 'rb') as f_in, gzip.open(fp + '.plain.gz', 'wb') as f_out: f_out.write(f_in.read())
+
+    for filepaths_to_read in [filepaths, filepaths[:1] + [fp + '.plain.gz' for fp in filepaths[1:]]]:
+        num_fds = len(os.listdir('/proc/self/fd'))
+        cpras = [get_cpras(fp, ['2', '3']) for fp in filepaths_to_read]
+        for gen in cpras: next(gen)
+        assert len(os.listdir('/proc/self/fd')) == num_fds + len(filepaths_to_read)  # `merge()` counts on one open file per input
+        for gen in cpras: gen.close()
+
+        out_filepath = str(tmp_path / 'sites.gz')
+        assert merge(filepaths_to_read, ['2', '3'], out_filepath, max_num_files=2) == len(expected_rows)
+        with gzip.open(out_filepath, 'rt') as f:
+            assert [tuple(line.rstrip('\n').split('\t')) for line in f] == expected_rows
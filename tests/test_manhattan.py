@@ -0,0 +1,125 @@
+"""
+Checks that `VectorizedBinner` (and `Binner`s of groups of chroms, merged) make the same manhattan data as `Binner`,
+and that `pheweb manhattan-qq` makes the same data when it splits a phenotype into groups of chroms or reads a pheno_bin file.
+"""
+import copy
+import glob
+import json
+import os
+import pickle
+
+import pytest
+
+from pheweb import conf
+import pheweb.file_utils
+from pheweb.utils import chrom_order
+from pheweb.file_utils import IndexedVariantFileWriter, BinaryVariantFileWriter, BinaryVariantFileReader, get_pheno_filepath, make_basedir
+from pheweb.load import read_input_file, manhattan_qq, best_of_pheno
+from pheweb.load.manhattan import Binner, VectorizedBinner
+from pheweb.load.sites import get_chrom_groups
+
+
+ASSOC_FILES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'input_files/assoc-files/*')))
+
+
+@pytest.mark.parametrize('filepath', ASSOC_FILES, ids=os.path.basename)
+@pytest.mark.parametrize('num_unbinned', [500, 5])
+def test_vectorized_binner_matches_binner(filepath, num_unbinned, monkeypatch):
+    monkeypatch.setitem(conf.overrides, 'manhattan_num_unbinned', num_unbinned)
+    monkeypatch.setitem(conf.overrides, 'manhattan_peak_pval_threshold', 1e-2)  # make more peaks
+    monkeypatch.setitem(conf.overrides, 'manhattan_peak_variant_counting_pval_threshold', 1e-3)
+    variants = list(read_input_file.PhenoReader({'phenocode': 'pheno', 'assoc_files': [filepath]}).get_variants())
+
+    binner = Binner()
+    for variant in copy.deepcopy(variants):
+        binner.process_variant(variant)
+    vectorized_binner = VectorizedBinner()
+    variants = copy.deepcopy(variants)
+    for start in range(0, len(variants), 7):  # exercise chunk boundaries
+        vectorized_binner.process_variants(variants[start:start+7])
+    assert json.dumps(vectorized_binner.get_result()) == json.dumps(binner.get_result())
+
+
+@pytest.mark.parametrize('filepath', ASSOC_FILES, ids=os.path.basename)
+@pytest.mark.parametrize('num_unbinned', [500, 5])
+def test_merged_binners_match_binner(filepath, num_unbinned, monkeypatch):
+    monkeypatch.setitem(conf.overrides, 'manhattan_num_unbinned', num_unbinned)
+    monkeypatch.setitem(conf.overrides, 'manhattan_peak_pval_threshold', 1e-2)  # make more peaks
+    monkeypatch.setitem(conf.overrides, 'manhattan_peak_variant_counting_pval_threshold', 1e-3)
+    variants = list(read_input_file.PhenoReader({'phenocode': 'pheno', 'assoc_files': [filepath]}).get_variants())
+    variants.sort(key=lambda v: (chrom_order[v['chrom']], v['pos']))  # like pheno_gz
+    for variant in variants: variant['pval'] = float('{:.1g}'.format(variant['pval']))  # make many tied pvals
+
+    binner = Binner()
+    for variant in copy.deepcopy(variants):
+        binner.process_variant(variant)
+    merged_binner = None
+    for chroms in get_chrom_groups(3):
+        chrom_binner = Binner()
+        for variant in copy.deepcopy(variants):
+            if variant['chrom'] in chroms: chrom_binner.process_variant(variant)
+        if merged_binner is None: merged_binner = chrom_binner
+        else: merged_binner.merge(pickle.loads(pickle.dumps(chrom_binner)))
+    assert json.dumps(merged_binner.get_result()) == json.dumps(binner.get_result())
+
+
+@pytest.mark.parametrize('filepath', ASSOC_FILES, ids=os.path.basename)
+@pytest.mark.parametrize('approximate_qq', [False, True])
+def test_split_pheno_summary_matches_unsplit(filepath, approximate_qq, tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmp_path))
+    monkeypatch.setitem(conf.overrides, 'approximate_qq', approximate_qq)
+    monkeypatch.setitem(conf.overrides, 'show_manhattan_filter_button', True)
+    monkeypatch.setitem(conf.overrides, 'manhattan_num_unbinned', 5)
+    monkeypatch.setattr(best_of_pheno, 'NUM_VARIANTS', 5)
+    monkeypatch.setattr(manhattan_qq, 'MIN_BYTES_PER_PART', 1)
+    variants = list(read_input_file.PhenoReader({'phenocode': 'pheno', 'assoc_files': [filepath]}).get_variants())
+    if len(variants) < 10: pytest.skip("QQ data needs more variants")
+    variants.sort(key=lambda v: (chrom_order[v['chrom']], v['pos']))
+    for variant in variants: variant['pval'] = float('{:.1g}'.format(variant['pval']))  # make many tied pvals
+    pheno = {'phenocode': 'pheno'}
+    pheno_gz_filepath = get_pheno_filepath('pheno_gz', 'pheno', must_exist=False)
+    make_basedir(pheno_gz_filepath)
+    with IndexedVariantFileWriter(pheno_gz_filepath) as writer: writer.write_all(variants)
+    assert manhattan_qq.split_pheno(pheno, 3) != [None]
+
+    summary = manhattan_qq._PhenoSummary(pheno)
+    summary.read(pheno_gz_filepath)
+    summaries = []
+    for chroms in get_chrom_groups(3):
+        part = manhattan_qq._PhenoSummary(pheno)
+        part.read(pheno_gz_filepath, chroms=chroms)
+        summaries.append(pickle.loads(pickle.dumps(part)))
+    for part in summaries[1:]: summaries[0].merge(part)
+    assert _get_summary_data(summaries[0]) == _get_summary_data(summary)
+
+
+@pytest.mark.parametrize('filepath', ASSOC_FILES, ids=os.path.basename)
+@pytest.mark.parametrize('approximate_qq', [False, True])
+def test_binary_pheno_summary_matches_text(filepath, approximate_qq, tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, 'approximate_qq', approximate_qq)
+    monkeypatch.setitem(conf.overrides, 'show_manhattan_filter_button', True)
+    monkeypatch.setitem(conf.overrides, 'manhattan_num_unbinned', 5)
+    monkeypatch.setattr(best_of_pheno, 'NUM_VARIANTS', 5)
+    monkeypatch.setattr(pheweb.file_utils, 'BINARY_BLOCK_NUM_VARIANTS', 7)  # exercise block boundaries
+    variants = list(read_input_file.PhenoReader({'phenocode': 'pheno', 'assoc_files': [filepath]}).get_variants())
+    if len(variants) < 10: pytest.skip("QQ data needs more variants")
+    variants.sort(key=lambda v: (chrom_order[v['chrom']], v['pos']))
+    for variant in variants: variant['pval'] = float('{:.1g}'.format(variant['pval']))  # make many tied pvals
+    pheno_bin_filepath, pheno_gz_filepath = str(tmp_path / 'pheno.bin'), str(tmp_path / 'pheno.gz')
+    with BinaryVariantFileWriter(pheno_bin_filepath) as writer: writer.write_all(variants)
+    with BinaryVariantFileReader(pheno_bin_filepath) as reader: variants = list(reader)  # so that both files have the same values
+    with IndexedVariantFileWriter(pheno_gz_filepath) as writer: writer.write_all(variants)
+
+    pheno = {'phenocode': 'pheno'}
+    summary = manhattan_qq._PhenoSummary(pheno)
+    summary.read(pheno_gz_filepath)
+    monkeypatch.setitem(conf.overrides, 'binary_variant_files', True)
+    binary_summary = manhattan_qq._PhenoSummary(pheno)
+    binary_summary.read(pheno_bin_filepath)
+    assert binary_summary.fields == summary.fields
+    assert _get_summary_data(binary_summary) == _get_summary_data(summary)
+
+def _get_summary_data(summary):
+    # Like `_PhenoSummary.write()`, only the original fields of best-of-pheno variants are kept.
+    best_assocs = [{field: v[field] for field in summary.fields} for v in best_of_pheno.pop_all_in_order(summary.best_of_pheno_q)]
+    return json.dumps([summary.binner.get_result(), summary.get_qq_data(), best_assocs], default=pheweb.file_utils._json_writer_default)
@@ -0,0 +1,113 @@
+"""
+Checks `pheweb matrix` and the readers of what it writes, on a small data_dir.
+"""
+import json
+import os
+
+import pytest
+
+from pheweb import conf
+from pheweb.file_utils import VariantFileWriter, IndexedVariantFileWriter, MatrixReader, ShardedMatrixReader, VariantStoreReader
+from pheweb.file_utils import get_matrix_reader, get_variant_reader, get_filepath, get_pheno_filepath
+from pheweb.load import matrix
+
+
+SITES = [{'chrom': chrom, 'pos': pos, 'ref': 'A', 'alt': alt, 'rsids': 'rs{}'.format(pos), 'nearest_genes': 'GENE{}'.format(chrom)}
+         for chrom in ['1', '2', '10', 'X'] for pos in range(100, 2000, 100) for alt in ['G', 'T']]
+
+def _get_pheno_variants(phenocode):
+    '''Each phenotype has a different subset of the sites, so that each one's last variant is in a different place.'''
+    if phenocode == 'all': chosen_sites = SITES
+    elif phenocode == 'odd': chosen_sites = SITES[1::2]
+    elif phenocode == 'few': chosen_sites = [site for site in SITES if site['chrom'] == '2' and site['pos'] % 300 == 0]
+    else: raise Exception(phenocode)
+    return [dict(site, pval=(i+1)/1000, beta=i/10) for i, site in enumerate(chosen_sites)]
+PHENOCODES = ['all', 'few', 'odd']
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmp_path))
+    monkeypatch.setitem(conf.overrides, 'num_procs', 3)
+    with open(get_filepath('phenolist', must_exist=False), 'w') as f:
+        json.dump([{'phenocode': phenocode, 'assoc_files': []} for phenocode in PHENOCODES], f)
+    with VariantFileWriter(get_filepath('sites', must_exist=False)) as writer:
+        writer.write_all(SITES)
+    for phenocode in PHENOCODES:
+        with IndexedVariantFileWriter(get_pheno_filepath('pheno_gz', phenocode, must_exist=False)) as writer:
+            writer.write_all(_get_pheno_variants(phenocode))
+    return tmp_path
+
+def _get_expected_phenos():
+    '''Returns `{(chrom, pos, ref, alt): {phenocode: {field: value}}}` for every site.'''
+    expected = {(site['chrom'], site['pos'], site['ref'], site['alt']): {} for site in SITES}
+    for phenocode in PHENOCODES:
+        for v in _get_pheno_variants(phenocode):
+            expected[v['chrom'], v['pos'], v['ref'], v['alt']][phenocode] = {'pval': v['pval'], 'beta': v['beta'], 'phenocode': phenocode}
+    return expected
+
+
+def test_matrix_has_last_variant_of_each_pheno(data_dir):
+    matrix.run([])
+    with MatrixReader().context() as reader:
+        for phenocode in PHENOCODES:
+            last_variant = _get_pheno_variants(phenocode)[-1]
+            variant = reader.get_variant(last_variant['chrom'], last_variant['pos'], last_variant['ref'], last_variant['alt'])
+            assert variant is not None
+            assert variant['phenos'][phenocode]['pval'] == last_variant['pval']
+
+
+def test_sharded_matrix_reader_matches_matrix_reader(data_dir, monkeypatch):
+    monkeypatch.setitem(conf.overrides, 'matrix_num_shards', 2)
+    matrix.run([])
+    matrix_reader, sharded_reader = MatrixReader(), get_matrix_reader()
+    assert isinstance(sharded_reader, ShardedMatrixReader)
+    assert sharded_reader.get_phenocodes() == matrix_reader.get_phenocodes() == PHENOCODES
+    expected = _get_expected_phenos()
+    with matrix_reader.context() as mr, sharded_reader.context() as smr:
+        for (chrom, pos, ref, alt), expected_phenos in expected.items():
+            sharded_variant = smr.get_variant(chrom, pos, ref, alt)
+            assert sharded_variant == mr.get_variant(chrom, pos, ref, alt)
+            assert sharded_variant['rsids'] == 'rs{}'.format(pos)
+            assert sharded_variant['phenos'] == expected_phenos
+        assert smr.get_variant('1', 150, 'A', 'G') is None
+        assert smr.get_variant('1', 100, 'A', 'C') is None
+        assert smr.get_variant('3', 100, 'A', 'G') is None
+        assert list(smr.get_region('2', 300, 500)) == list(mr.get_region('2', 300, 500))
+        assert [v['pos'] for v in smr.get_region('2', 300, 500)] == [300, 300, 400, 400]
+
+    monkeypatch.setitem(conf.overrides, 'matrix_num_shards', 0)
+    assert isinstance(get_matrix_reader(), MatrixReader)
+    monkeypatch.setitem(conf.overrides, 'matrix_num_shards', 2)
+    os.remove(os.path.join(get_filepath('matrix_sharded'), 'shards.json'))
+    assert isinstance(get_matrix_reader(), MatrixReader)  # the shards are incomplete without shards.json
+
+
+def test_variant_store_reader_matches_matrix_reader(data_dir, monkeypatch):
+    monkeypatch.setitem(conf.overrides, 'variant_store', True)
+    matrix.run([])
+    matrix_reader, store_reader = MatrixReader(), get_variant_reader()
+    assert isinstance(store_reader, VariantStoreReader)
+    assert store_reader.get_phenocodes() == matrix_reader.get_phenocodes() == PHENOCODES
+    expected = _get_expected_phenos()
+    first_cpra, last_cpra = list(expected)[0], list(expected)[-1]
+    absent_cpras = [
+        ('1', first_cpra[1]-1, 'A', 'G'),  # before the first variant
+        ('1', first_cpra[1], 'A', 'C'),  # same position as the first variant
+        ('1', 150, 'A', 'G'),
+        ('3', 100, 'A', 'G'),  # a chrom without variants
+        ('X', last_cpra[1], 'A', 'C'),  # same position as the last variant
+        ('X', last_cpra[1]+1, 'A', 'G'),  # after the last variant
+        ('Y', 100, 'A', 'G'),
+    ]
+    with matrix_reader.context() as mr, store_reader.context() as vsr:
+        for cpra, expected_phenos in expected.items():
+            variant = vsr.get_variant(*cpra)
+            assert variant == mr.get_variant(*cpra)
+            assert variant['phenos'] == expected_phenos
+        assert vsr.get_variant(*first_cpra)['pos'] == first_cpra[1]
+        assert vsr.get_variant(*last_cpra)['pos'] == last_cpra[1]
+        for cpra in absent_cpras:
+            assert vsr.get_variant(*cpra) is None
+            assert mr.get_variant(*cpra) is None
+        assert list(vsr.get_region('2', 300, 500)) == list(mr.get_region('2', 300, 500))
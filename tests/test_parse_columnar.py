@@ -0,0 +1,46 @@
+"""
+Checks that the columnar parser produces exactly the same variants as the row-by-row parser,
+and that the specialized per-field parsers match `Field.parse()`.
+"""
+import glob
+import os
+
+import pytest
+
+from pheweb import parse_utils
+from pheweb.load import read_input_file
+
+
+ASSOC_FILES = sorted(glob.glob(os.path.join(os.path.dirname(__file__), 'input_files/assoc-files/*')))
+
+
+def _rows_from_columns(chunks):
+    for columns in chunks:
+        for values in zip(*columns.values()):
+            yield dict(zip(columns.keys(), values))
+
+
+@pytest.mark.parametrize('filepath', ASSOC_FILES, ids=os.path.basename)
+@pytest.mark.parametrize('minimum_maf', [0, 0.3])
+def test_columnar_matches_rows(filepath, minimum_maf, monkeypatch):
+    monkeypatch.setattr(read_input_file, 'COLUMNAR_CHUNK_NUM_LINES', 7)  # exercise chunk boundaries
+    pheno = {'phenocode': 'pheno', 'assoc_files': [filepath]}
+    rows = list(read_input_file.PhenoReader(pheno, minimum_maf=minimum_maf).get_variants())
+    columns = read_input_file.PhenoReader(pheno, minimum_maf=minimum_maf).get_variant_columns()
+    assert [repr(v) for v in _rows_from_columns(columns)] == [repr(v) for v in rows]
+
+
+def _parse_or_exception_type(parse, value):
+    try:
+        return repr(parse(value))
+    except Exception as exc:
+        return type(exc)
+
+
+@pytest.mark.parametrize('field', list(parse_utils.fields), ids=str)
+@pytest.mark.parametrize('pval_is_neglog10', [False, True])
+def test_make_parser_matches_parse(field, pval_is_neglog10):
+    field_obj = parse_utils._field_objs[field]
+    parse = field_obj.make_parser(pval_is_neglog10)
+    for value in ['', 'NA', 'nan', 'A', '0', '1', '-1', '0.25', '0.5', '0.75', '0.123456789', '3.5e-12', '12345', '1.2e3', '7', '400']:
+        assert _parse_or_exception_type(parse, value) == _parse_or_exception_type(lambda v: field_obj.parse(v, pval_is_neglog10), value), value
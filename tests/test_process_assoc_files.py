@@ -0,0 +1,121 @@
+"""
+Checks how `pheweb process` schedules its steps with `num_procs > 1`, using stub steps that log when each of their jobs starts and ends.
+"""
+import json
+import os
+import sys
+import time
+import types
+
+import pytest
+
+from pheweb import conf
+from pheweb.file_utils import get_filepath
+from pheweb.load.load_utils import PhenoStage
+from pheweb.load.process_assoc_files import Step, _StepRunner
+from pheweb.utils import PheWebError
+
+
+PHENOCODES = ['p1', 'p2', 'p3', 'p4']
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmp_path))
+    with open(get_filepath('phenolist', must_exist=False), 'w') as f:
+        json.dump([{'phenocode': phenocode, 'assoc_files': []} for phenocode in PHENOCODES], f)
+    return tmp_path
+
+def _log(data_dir, event, name):
+    with open(os.path.join(data_dir, 'log'), 'a') as f:
+        f.write('{} {} {}\n'.format(event, name, conf.get_num_procs()))
+
+def _read_log(data_dir):
+    '''Returns a list of `(event, job_name, num_procs)`, in the order that they happened.'''
+    with open(os.path.join(data_dir, 'log')) as f:
+        return [(event, name, int(num_procs)) for event, name, num_procs in (line.split() for line in f)]
+
+def _add_stub_step(monkeypatch, data_dir, script, *, seconds=0.1, input_dir=None, failing_phenocode=None):
+    '''Adds a module `pheweb.load.<script>` that writes `<data_dir>/<script>/<phenocode>` for each pheno, and has a `pheno_stage` if `input_dir` is set.'''
+    output_dir = os.path.join(str(data_dir), script)
+    def do_work(name):
+        _log(data_dir, 'start', name)
+        time.sleep(seconds)
+        _log(data_dir, 'end', name)
+    def run(argv):
+        do_work(script)
+        os.makedirs(output_dir, exist_ok=True)
+        for phenocode in PHENOCODES:
+            with open(os.path.join(output_dir, phenocode), 'w') as f: f.write(script)
+    def convert(pheno):
+        if pheno['phenocode'] == failing_phenocode:
+            _log(data_dir, 'start', '{}:{}'.format(script, pheno['phenocode']))
+            raise Exception('failed on purpose')
+        do_work('{}:{}'.format(script, pheno['phenocode']))
+        os.makedirs(output_dir, exist_ok=True)
+        with open(os.path.join(output_dir, pheno['phenocode']), 'w') as f: f.write(script)
+    module = types.ModuleType('pheweb.load.' + script)
+    module.run = run  # type: ignore
+    if input_dir is not None:
+        module.pheno_stage = PhenoStage(  # type: ignore
+            cmd=script,
+            get_input_filepaths=lambda pheno: [os.path.join(str(data_dir), input_dir, pheno['phenocode'])],
+            get_output_filepaths=lambda pheno: [os.path.join(output_dir, pheno['phenocode'])],
+            convert=convert)
+    monkeypatch.setitem(sys.modules, module.__name__, module)
+
+
+def test_step_runner_runs_each_pheno_after_its_deps_within_num_procs(data_dir, monkeypatch):
+    _add_stub_step(monkeypatch, data_dir, 'stub_parse', seconds=0.3)
+    _add_stub_step(monkeypatch, data_dir, 'stub_augment', input_dir='stub_parse')
+    _add_stub_step(monkeypatch, data_dir, 'stub_plot', input_dir='stub_augment')
+    _add_stub_step(monkeypatch, data_dir, 'stub_other')
+    _add_stub_step(monkeypatch, data_dir, 'stub_last')
+    _StepRunner([
+        Step('stub_parse', []),
+        Step('stub_other', []),
+        Step('stub_augment', ['stub_parse'], parallel=True, per_pheno=True),
+        Step('stub_plot', ['stub_augment'], parallel=True, per_pheno=True),
+        Step('stub_last', ['stub_plot', 'stub_other'], parallel=True),
+    ], num_procs=2).run()
+
+    log = _read_log(data_dir)
+    position = {(event, name): i for i, (event, name, _) in enumerate(log)}
+    expected_names = ['stub_parse', 'stub_other', 'stub_last'] + ['{}:{}'.format(script, phenocode) for script in ['stub_augment', 'stub_plot'] for phenocode in PHENOCODES]
+    assert sorted(name for event, name, _ in log if event == 'start') == sorted(expected_names)
+
+    # Each job starts after its deps end: all of `stub_parse` for each pheno of `stub_augment`, but only the same pheno of `stub_augment` for `stub_plot`.
+    for phenocode in PHENOCODES:
+        assert position['end', 'stub_parse'] < position['start', 'stub_augment:' + phenocode]
+        assert position['end', 'stub_augment:' + phenocode] < position['start', 'stub_plot:' + phenocode]
+        assert position['end', 'stub_plot:' + phenocode] < position['start', 'stub_last']
+    assert position['end', 'stub_other'] < position['start', 'stub_last']
+    # A pheno's plot starts as soon as it's augmented, before the other phenos are augmented.
+    assert position['start', 'stub_plot:p1'] < max(position['start', 'stub_augment:' + phenocode] for phenocode in PHENOCODES)
+
+    # At most `num_procs` processes run at once, and `stub_last` (a parallel step running alone) gets all of them.
+    num_running_procs = 0
+    for event, name, num_procs in log:
+        num_running_procs += num_procs if event == 'start' else -num_procs
+        assert 0 <= num_running_procs <= 2
+    assert [num_procs for event, name, num_procs in log if name == 'stub_last'] == [2, 2]
+    assert all(num_procs == 1 for event, name, num_procs in log if ':' in name)
+
+
+def test_step_runner_stops_starting_jobs_after_a_failure(data_dir, monkeypatch):
+    _add_stub_step(monkeypatch, data_dir, 'stub_parse')
+    _add_stub_step(monkeypatch, data_dir, 'stub_augment', seconds=0.5, input_dir='stub_parse', failing_phenocode='p1')
+    _add_stub_step(monkeypatch, data_dir, 'stub_plot', input_dir='stub_augment')
+    with pytest.raises(PheWebError, match='stub-augment p1'):
+        _StepRunner([
+            Step('stub_parse', []),
+            Step('stub_augment', ['stub_parse'], parallel=True, per_pheno=True),
+            Step('stub_plot', ['stub_augment'], parallel=True, per_pheno=True),
+        ], num_procs=2).run()
+    # `stub_augment:p1` fails right away, while `stub_augment:p2` is running.
+    # No more jobs start (not even `stub_plot:p2`, once its input is ready), but `stub_augment:p2` is allowed to finish.
+    log = _read_log(data_dir)
+    started_names = [name for event, name, _ in log if event == 'start']
+    assert started_names[0] == 'stub_parse'
+    assert sorted(started_names[1:]) == ['stub_augment:p1', 'stub_augment:p2']
+    assert log[-1][:2] == ('end', 'stub_augment:p2')
+    assert os.path.exists(os.path.join(str(data_dir), 'stub_augment', 'p2'))
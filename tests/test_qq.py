@@ -0,0 +1,135 @@
+"""
+Checks the vectorized QQ binning against the per-variant loop that it replaced,
+and `QQSketch` (for `approximate_qq`) against the exact QQ data, within its documented error bounds.
+"""
+import math
+
+import numpy as np
+import pytest
+
+from pheweb.load import qq
+from pheweb.load.qq import NUM_BINS
+
+
+def _get_reference_packed_bins(qvals, max_exp_qval, max_obs_qval):
+    '''Bins each variant one at a time with numpy scalars, like the original `compute_qq()` did.'''
+    packed_bins = set()
+    for i, obs_qval in enumerate(qvals):
+        if obs_qval > max_obs_qval: continue
+        exp_qval = -math.log10((i+0.5) / len(qvals))
+        exp_bin = int(exp_qval / max_exp_qval * NUM_BINS)
+        obs_bin = int(obs_qval / max_obs_qval * NUM_BINS)
+        packed_bins.add(exp_bin * (NUM_BINS+1) + obs_bin)
+    return packed_bins
+
+def _get_boundary_qvals(dtype, max_obs_qval, num_variants, seed):
+    '''Returns `num_variants` decreasing qvals of type `dtype`, with many right next to the boundaries between `obs_bin`s.'''
+    rng = np.random.RandomState(seed)
+    boundaries = np.arange(NUM_BINS, dtype=dtype) * dtype(max_obs_qval) / dtype(NUM_BINS)
+    qvals = np.concatenate([
+        np.array([3 * max_obs_qval, 2 * max_obs_qval, max_obs_qval], dtype=dtype),  # the first two aren't shown
+        boundaries, np.nextafter(boundaries, dtype(np.inf)), np.nextafter(boundaries, dtype(-np.inf)),
+        rng.uniform(0, max_obs_qval, size=num_variants).astype(dtype),
+    ])[:num_variants]
+    qvals = np.maximum(qvals, 0)
+    return -np.sort(-qvals)
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+@pytest.mark.parametrize('num_variants', [1300, 5000])
+def test_packed_bins_match_reference_loop(dtype, num_variants):
+    max_exp_qval = -math.log10(0.5 / num_variants)
+    qvals = _get_boundary_qvals(dtype, max_exp_qval * 1.5, num_variants, seed=num_variants)
+    max_obs_qval = qq._get_max_obs_qval(qvals, max_exp_qval)
+    assert max_obs_qval == qvals[2]  # the largest qval that's shown
+    expected = _get_reference_packed_bins(qvals, max_exp_qval, max_obs_qval)
+    for chunk_size in [num_variants, 97]:
+        packed_bins = np.concatenate([qq._get_packed_bins(qvals, start, min(start + chunk_size, num_variants), max_exp_qval, max_obs_qval)
+                                      for start in range(0, num_variants, chunk_size)])
+        assert set(packed_bins.tolist()) == expected
+
+@pytest.mark.parametrize('num_variants', [1, 2, 5, 50, 500, 1000, 12345, 5 * 10**5])
+def test_exp_bins_match_reference_loop(num_variants):
+    # With 5*10^k variants, the first variant's exp_qval is exactly `max_exp_qval`, so it's right on the boundary of the last bin.
+    max_exp_qval = -math.log10(0.5 / num_variants)
+    idxs = np.arange(num_variants)
+    expected = [int(-math.log10((i+0.5) / num_variants) / max_exp_qval * NUM_BINS) for i in range(num_variants)]
+    assert qq._get_exp_bins(idxs, num_variants, max_exp_qval).tolist() == expected
+
+@pytest.mark.parametrize('dtype', [np.float32, np.float64])
+def test_compute_qq_matches_reference_loop(dtype, monkeypatch):
+    monkeypatch.setattr(qq, 'QQ_CHUNK_SIZE', 1000)  # exercise chunk boundaries
+    num_variants = 4321
+    max_exp_qval = -math.log10(0.5 / num_variants)
+    qvals = _get_boundary_qvals(dtype, max_exp_qval * 1.7, num_variants, seed=0)
+    max_obs_qval = qq._get_max_obs_qval(qvals, max_exp_qval)
+    expected_bins = sorted((packed // (NUM_BINS+1) / NUM_BINS * max_exp_qval, packed % (NUM_BINS+1) / NUM_BINS * max_obs_qval)
+                           for packed in _get_reference_packed_bins(qvals, max_exp_qval, max_obs_qval))
+    assert qq.compute_qq(qvals) == {'bins': expected_bins, 'max_exp_qval': max_exp_qval}
+
+
+def _get_variants_df(num_variants, seed):
+    rng = np.random.RandomState(seed)
+    variants = np.empty(num_variants, dtype=[('maf',np.float32),('qval',np.float32)])
+    pvals = rng.uniform(size=num_variants)
+    pvals[:num_variants//100] **= 30  # some strong associations, above `APPROX_QQ_QVAL_CUTOFF`
+    variants['qval'] = -np.log10(pvals)
+    variants['maf'] = 10 ** rng.uniform(-4, math.log10(0.5), size=num_variants)
+    variants['maf'][:num_variants//50] = 0
+    variants['maf'][num_variants//50:num_variants//10] = 0.01  # a tie at the boundary between two strata
+    rng.shuffle(variants)
+    return variants
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_qq_sketch_matches_exact_qq_within_its_error_bounds(seed):
+    variants = _get_variants_df(20000, seed)
+    sketch = qq.QQSketch(has_maf=True)
+    for start in range(0, len(variants), 3000):
+        sketch.add(variants['qval'][start:start+3000], variants['maf'][start:start+3000])
+    sketch_data = sketch.get_qq_data()
+    exact_data = qq.get_qq_data(variants.copy())
+    half_bin_width = qq.APPROX_QQ_QVAL_BIN_WIDTH / 2 + 1e-6  # plus float32 rounding
+
+    # Each qval is off by at most half a bin, so the i-th strongest qval is too.
+    hist_qvals = np.arange(sketch._num_qval_bins) * qq.APPROX_QQ_QVAL_BIN_WIDTH
+    sketch_qvals = np.concatenate([np.repeat(hist_qvals, sketch._hist.sum(axis=0)), np.frombuffer(sketch._tail_qvals, dtype=np.float32)])
+    exact_qvals = np.sort(variants['qval'].astype(np.float64))
+    assert np.all(np.abs(np.sort(sketch_qvals) - exact_qvals) <= half_bin_width)
+    is_tail = exact_qvals >= qq.APPROX_QQ_QVAL_CUTOFF
+    assert np.array_equal(np.sort(sketch_qvals)[is_tail], exact_qvals[is_tail])  # the strong ones are exact
+
+    # So each gc_lambda is from a qval within half a bin of the exact one.
+    assert sketch_data['overall']['count'] == exact_data['overall']['count']
+    for quantile, gc_lambda in exact_data['overall']['gc_lambda'].items():
+        exact_qval = exact_qvals[::-1][int(len(exact_qvals) * float(quantile))]
+        bounds = sorted(qq.gc_value(10 ** -(exact_qval + delta), float(quantile)) for delta in [-half_bin_width, half_bin_width])
+        assert bounds[0] * (1 - 1e-4) <= sketch_data['overall']['gc_lambda'][quantile] <= bounds[1] * (1 + 1e-4)
+
+    # Each stratum has the same count, and its maf_range is off by at most one maf bin.
+    maf_bin_ratio = 10 ** (1 / qq.APPROX_QQ_MAF_BINS_PER_DECADE) * (1 + 1e-6)
+    assert sketch_data['ci'] == exact_data['ci']
+    for sketch_stratum, exact_stratum in zip(sketch_data['by_maf'], exact_data['by_maf']):
+        assert sketch_stratum['count'] == exact_stratum['count']
+        for sketch_maf, exact_maf in zip(sketch_stratum['maf_range'], exact_stratum['maf_range']):
+            if exact_maf == 0: assert sketch_maf == 0
+            else: assert exact_maf / maf_bin_ratio <= sketch_maf <= exact_maf * maf_bin_ratio
+
+def test_qq_sketch_merge_matches_one_sketch():
+    variants = _get_variants_df(10000, seed=2)
+    sketch = qq.QQSketch(has_maf=True)
+    sketch.add(variants['qval'], variants['maf'])
+    merged_sketch = qq.QQSketch(has_maf=True)
+    for start in range(0, len(variants), 3333):
+        part_sketch = qq.QQSketch(has_maf=True)
+        part_sketch.add(variants['qval'][start:start+3333], variants['maf'][start:start+3333])
+        merged_sketch.merge(part_sketch)
+    assert merged_sketch.get_qq_data() == sketch.get_qq_data()
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_compute_qq_from_counts_matches_compute_qq(seed):
+    rng = np.random.RandomState(seed)
+    # Distinct qvals, including some above the shown range and a 0, each repeated up to 5000 times (like the histogram of a `QQSketch`).
+    qvals = np.unique(np.concatenate([np.round(rng.uniform(0, 2, size=150), 2), -np.log10(rng.uniform(size=50) ** 20), [0, 60, 80]]))[::-1]
+    counts = np.where(rng.uniform(size=len(qvals)) < 0.5, 1, rng.randint(1, 5000, size=len(qvals)))
+    assert qq.compute_qq_from_counts(qvals, counts) == qq.compute_qq(np.repeat(qvals, counts))
+    assert qq.compute_qq_from_counts(qvals[:1], counts[:1]) == qq.compute_qq(np.repeat(qvals[:1], counts[:1]))
+    assert qq.compute_qq_from_counts(qvals[-1:], counts[-1:]) == qq.compute_qq(np.repeat(qvals[-1:], counts[-1:])) == {}  # only qval 0
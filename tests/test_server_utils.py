@@ -0,0 +1,66 @@
+import json
+import os
+
+from pheweb import conf
+from pheweb.file_utils import get_pheno_filepath, make_basedir
+from pheweb.serve import server_utils
+from pheweb.serve.server_utils import LRUCache, _estimate_num_bytes
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(max_num_bytes=3 * _estimate_num_bytes('x'*10))
+    for key in 'abc': cache.put(key, key*10)
+    assert cache.get('a', None) == 'a'*10  # now 'b' is the least recently used
+    cache.put('d', 'd'*10)
+    assert cache.get('b', None) is None
+    assert [cache.get(key, None) for key in 'acd'] == ['a'*10, 'c'*10, 'd'*10]
+    cache.put('c', 'C'*10)  # replacing a value makes it the most recently used
+    cache.put('e', 'e'*10)
+    assert cache.get('a', None) is None
+    assert [cache.get(key, None) for key in 'cde'] == ['C'*10, 'd'*10, 'e'*10]
+    stats = cache.get_stats()
+    assert (stats['num_hits'], stats['num_misses'], stats['num_entries']) == (7, 2, 3)
+
+
+def test_lru_cache_keeps_to_its_byte_budget():
+    cache = LRUCache(max_num_bytes=1000)
+    for i in range(100):
+        cache.put(i, 'x' * (i % 30))
+        assert cache.get_stats()['num_bytes'] <= 1000
+    assert cache.get(99, None) == 'x' * 9
+    cache.put('big', 'x' * 2000)  # bigger than the whole cache, so it isn't cached and doesn't evict anything
+    assert cache.get('big', None) is None
+    assert cache.get(99, None) == 'x' * 9
+
+    cache = LRUCache(max_num_bytes=0)
+    cache.put('a', 'a')
+    assert cache.get('a', None) is None
+    assert cache.get_stats()['num_bytes'] == 0
+
+
+def test_estimate_num_bytes_is_close_to_json_length():
+    variants = [{'chrom': '1', 'pos': 1000 + i, 'ref': 'A', 'alt': 'G' * (i % 5 + 1), 'pval': 10**-(i % 30), 'rsids': 'rs{}'.format(i)}
+                for i in range(5000)]
+    for value in [variants, {'data': {field: [v[field] for v in variants] for field in variants[0]}, 'lastpage': None}, variants[0]]:
+        assert 0.7 < _estimate_num_bytes(value) / len(json.dumps(value)) < 1.3
+
+
+def test_cache_keys_with_mtime_miss_after_file_changes(tmp_path, monkeypatch):
+    monkeypatch.setitem(conf.overrides, 'data_dir', str(tmp_path))
+    monkeypatch.setattr(server_utils, 'cache', LRUCache(max_num_bytes=10**6))
+    filepath = get_pheno_filepath('pheno_gz', 'a', must_exist=False)
+    make_basedir(filepath)
+    with open(filepath, 'w'): pass
+    os.utime(filepath, (1000, 1000))
+    calls = []
+    def get_pheno_region(phenocode, chrom, pos_start, pos_end):
+        calls.append(phenocode)
+        return {'data': {}, 'lastpage': len(calls)}
+    monkeypatch.setattr(server_utils._Get_Pheno_Region, '_get_pheno_region', staticmethod(get_pheno_region))
+
+    assert server_utils.get_pheno_region('a', '1', 1, 100)['lastpage'] == 1
+    assert server_utils.get_pheno_region('a', '1', 1, 100)['lastpage'] == 1
+    os.utime(filepath, (2000, 2000))
+    assert server_utils.get_pheno_region('a', '1', 1, 100)['lastpage'] == 2
+    assert server_utils.get_pheno_region('a', '1', 1, 100)['lastpage'] == 2
+    assert len(calls) == 2